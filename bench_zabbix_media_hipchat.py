@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+Benchmark parsing, serializing and sending alerts.
+
+Measures the cold start of the alert script, the throughput of turning the
+commandline arguments into requests, and the throughput and latency of
+delivering alerts to :class:`zabbix_media_hipchat_mock.MockHipChatServer`,
+along with the time the mock took to respond, then writes the results as
+JSON so that runs can be compared.
+
+HTTPS needs a certificate for ``localhost`` trusted by the client, e.g.::
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost \\
+        -addext subjectAltName=DNS:localhost -keyout key.pem -out cert.pem
+    SSL_CERT_FILE=cert.pem python bench_zabbix_media_hipchat.py \\
+        --certfile cert.pem --keyfile key.pem
+"""
+
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import zabbix_media_hipchat
+from zabbix_media_hipchat_mock import LATENCY_DISTRIBUTIONS
+from zabbix_media_hipchat_mock import MockHipChatServer
+
+DESTINATION = 'room=%s,auth_token=' + 'a' * 40
+
+METADATA = 'status=PROBLEM,nseverity=4,notify=true'
+
+ALERT = 'Zabbix agent on host-%d is unreachable for 5 minutes'
+
+
+def main():
+    """Main function.
+
+    Runs every benchmark and writes the results to stdout, or to
+    ``--output``.
+    """
+
+    option_parser = get_option_parser()
+    (options, _) = option_parser.parse_args()
+
+    server = MockHipChatServer(
+        latency=options.latency,
+        error_rate=options.error_rate,
+        throttle_rate=options.throttle_rate,
+        certfile=options.certfile,
+        keyfile=options.keyfile,
+        seed=0,
+        reset_rate=options.reset_rate,
+        latency_distribution=options.latency_distribution,
+    )
+    server.start()
+
+    try:
+        results = {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'started': time.time(),
+            'cold_start': bench_cold_start(server.endpoint, options.runs),
+            'pipeline': bench_pipeline(options.iterations),
+            'delivery': bench_delivery(
+                server.endpoint,
+                options.alerts,
+                options.concurrency,
+            ),
+            'server': {
+                'latency': options.latency,
+                'latency_distribution': options.latency_distribution,
+                'error_rate': options.error_rate,
+                'throttle_rate': options.throttle_rate,
+                'reset_rate': options.reset_rate,
+                'statuses': dict([
+                    (str(status).lower(), count)
+                    for (status, count) in server.statuses.items()
+                ]),
+                'elapsed': get_percentiles([
+                    timing['elapsed'] for timing in server.timings
+                ]),
+            },
+        }
+    finally:
+        server.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+def get_option_parser():
+    """Build commandline option parser.
+
+    Returns:
+        optparse.OptionParser. Option parser for the commandline.
+    """
+
+    option_parser = optparse.OptionParser(
+        description='Benchmark zabbix-media-hipchat against a mock HipChat.',
+    )
+
+    option_parser.add_option(
+        '--runs',
+        dest='runs',
+        type='int',
+        default=20,
+        help='number of alert script processes to start.',
+    )
+    option_parser.add_option(
+        '--iterations',
+        dest='iterations',
+        type='int',
+        default=10000,
+        help='number of alerts to parse and serialize.',
+    )
+    option_parser.add_option(
+        '--alerts',
+        dest='alerts',
+        type='int',
+        default=1000,
+        help='number of alerts to deliver.',
+    )
+    option_parser.add_option(
+        '--concurrency',
+        dest='concurrency',
+        type='int',
+        default=8,
+        help='number of alerts delivered at once.',
+    )
+    option_parser.add_option(
+        '--latency',
+        dest='latency',
+        type='float',
+        default=0.0,
+        metavar='SECONDS',
+        help='latency of the mock HipChat.',
+    )
+    option_parser.add_option(
+        '--latency-distribution',
+        dest='latency_distribution',
+        type='choice',
+        choices=LATENCY_DISTRIBUTIONS,
+        default='constant',
+        metavar='|'.join(LATENCY_DISTRIBUTIONS),
+        help='distribution of the latency of the mock HipChat. '
+             '[default: %default]',
+    )
+    option_parser.add_option(
+        '--error-rate',
+        dest='error_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests the mock HipChat fails with 5xx.',
+    )
+    option_parser.add_option(
+        '--reset-rate',
+        dest='reset_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests the mock HipChat resets the connection '
+             'of.',
+    )
+    option_parser.add_option(
+        '--throttle-rate',
+        dest='throttle_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests the mock HipChat fails with 429.',
+    )
+    option_parser.add_option(
+        '--certfile',
+        dest='certfile',
+        metavar='PATH',
+        help='serve the mock HipChat over HTTPS with this certificate.',
+    )
+    option_parser.add_option(
+        '--keyfile',
+        dest='keyfile',
+        metavar='PATH',
+        help='private key of `--certfile`.',
+    )
+    option_parser.add_option(
+        '--output',
+        dest='output',
+        metavar='PATH',
+        help='write the results to PATH instead of stdout.',
+    )
+
+    return option_parser
+
+
+def get_percentiles(samples):
+    """Summarize samples.
+
+    Args:
+        samples (list): Measured values.
+
+    Returns:
+        dict. Number of samples, their mean, minimum, maximum and the 50th,
+        90th and 99th percentiles. None for the values when there was no
+        sample.
+    """
+
+    samples = sorted(samples)
+    summary = {'count': len(samples)}
+
+    if not samples:
+        for key in ('mean', 'min', 'max', 'p50', 'p90', 'p99'):
+            summary[key] = None
+        return summary
+
+    summary['mean'] = sum(samples) / len(samples)
+    summary['min'] = samples[0]
+    summary['max'] = samples[-1]
+    for percentile in (50, 90, 99):
+        index = min(len(samples) - 1, len(samples) * percentile // 100)
+        summary['p%d' % percentile] = samples[index]
+
+    return summary
+
+
+def bench_cold_start(endpoint, runs):
+    """Measure the time the alert script takes to send an alert.
+
+    Every run is a process of its own of the entry script, as Zabbix server
+    starts one for every alert.
+
+    Args:
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+        runs (int): Number of processes to start.
+
+    Returns:
+        dict. Summary of seconds per run as returned by
+        :func:`get_percentiles`, plus ``failures``, the number of runs
+        exiting with an error.
+    """
+
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(zabbix_media_hipchat.__file__)),
+        'zabbix-media-hipchat',
+    )
+
+    samples = []
+    failures = 0
+
+    for run in range(runs):
+        command = [
+            sys.executable,
+            script,
+            '--endpoint',
+            endpoint,
+            DESTINATION % '123456',
+            METADATA,
+            ALERT % run,
+        ]
+        started = time.time()
+        if subprocess.call(command, stderr=open(os.devnull, 'w')):
+            failures += 1
+        samples.append(time.time() - started)
+
+    summary = get_percentiles(samples)
+    summary['failures'] = failures
+    return summary
+
+
+def bench_pipeline(iterations):
+    """Measure the throughput of turning arguments into requests.
+
+    Args:
+        iterations (int): Number of alerts to parse and serialize.
+
+    Returns:
+        dict. ``iterations``, ``elapsed`` seconds and ``per_second``.
+    """
+
+    started = time.time()
+
+    for iteration in range(iterations):
+        args = {}
+        args.update(zabbix_media_hipchat.parse_destination(
+            DESTINATION % '123456',
+        ))
+        args.update(zabbix_media_hipchat.parse_metadata(METADATA))
+        args.update(zabbix_media_hipchat.parse_alert(ALERT % iteration))
+        zabbix_media_hipchat.get_request(
+            args,
+            zabbix_media_hipchat.API_ENDPOINT_ROOM,
+        )
+
+    elapsed = time.time() - started
+
+    return {
+        'iterations': iterations,
+        'elapsed': elapsed,
+        'per_second': iterations / elapsed if elapsed else None,
+    }
+
+
+def bench_delivery(endpoint, alerts, concurrency):
+    """Measure throughput and latency of delivering alerts.
+
+    Alerts are delivered by ``concurrency`` threads sharing a dispatcher
+    over a connection pool, as the delivery daemon does.
+
+    Args:
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+        alerts (int): Number of alerts to deliver.
+        concurrency (int): Number of alerts delivered at once.
+
+    Returns:
+        dict. ``alerts``, ``elapsed`` seconds, ``per_second``, ``latency``
+        in seconds as returned by :func:`get_percentiles`, and ``statuses``,
+        the number of responses by HTTP status, ``none`` for requests which
+        got none.
+    """
+
+    opener_director = zabbix_media_hipchat.ConnectionPool(
+        maxsize=concurrency,
+        connect_timeout=5.0,
+        timeout=30.0,
+    )
+    dispatcher = zabbix_media_hipchat.Dispatcher(opener_director, endpoint)
+
+    pending = list(range(alerts))
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def deliver():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index = pending.pop()
+
+            args = {}
+            args.update(zabbix_media_hipchat.parse_destination(
+                DESTINATION % (index % 10),
+            ))
+            args.update(zabbix_media_hipchat.parse_metadata(METADATA))
+            args.update(zabbix_media_hipchat.parse_alert(ALERT % index))
+
+            for result in dispatcher.deliver(args):
+                with lock:
+                    latencies.append(result['elapsed'])
+                    status = str(result['status']).lower()
+                    statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.time()
+
+    threads = []
+    for _ in range(concurrency):
+        thread = threading.Thread(target=deliver)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - started
+    dispatcher.close()
+
+    return {
+        'alerts': alerts,
+        'elapsed': elapsed,
+        'per_second': alerts / elapsed if elapsed else None,
+        'latency': get_percentiles(latencies),
+        'statuses': statuses,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,582 @@
+#!/usr/bin/env python
+
+"""
+Replay alerts recorded by ``--record`` of the alert script.
+
+Sends every recorded alert again, at the pace it was recorded at sped up
+``--speed`` times, to :class:`zabbix_media_hipchat_mock.MockHipChatServer`
+or to ``--endpoint``, then writes the throughput, the latency and the
+outcome of the alerts as JSON, so that changes to the send path can be
+compared on the alert storms of real incidents.
+
+Alerts are sent by an alert script process each, as Zabbix server does
+(``--mode process``), by alert script processes handing them to the
+delivery daemon (``--mode daemon``), or by a single alert script in bulk
+mode (``--mode bulk``). Options after ``--`` are passed to every alert
+script, e.g.::
+
+    python replay_zabbix_media_hipchat.py --speed 10 --mode daemon \\
+        storm.jsonl -- --coalesce 5 --dedup 300
+
+The latency of an alert is the time from when it was due until its alert
+script exited, or its result was reported in bulk mode, so that alerts
+waiting for one of ``--max-processes`` count as late.
+"""
+
+import optparse
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import zabbix_media_hipchat
+from bench_zabbix_media_hipchat import get_percentiles
+from zabbix_media_hipchat_mock import LATENCY_DISTRIBUTIONS
+from zabbix_media_hipchat_mock import MockHipChatServer
+
+MODES = ('process', 'daemon', 'bulk')
+
+
+def main():
+    """Main function.
+
+    Replays the recording and writes the results to stdout, or to
+    ``--output``.
+    """
+
+    option_parser = get_option_parser()
+    (options, args) = option_parser.parse_args()
+
+    if not args:
+        option_parser.error('no recording given')
+    if options.speed <= 0:
+        option_parser.error('--speed must be positive')
+
+    with open(args[0]) as stream:
+        (records, unreadable) = read_recording(stream)
+
+    server = None
+    endpoint = options.endpoint
+    if endpoint is None:
+        server = MockHipChatServer(
+            latency=options.latency,
+            error_rate=options.error_rate,
+            throttle_rate=options.throttle_rate,
+            seed=0,
+            reset_rate=options.reset_rate,
+            latency_distribution=options.latency_distribution,
+        )
+        server.start()
+        endpoint = server.endpoint
+
+    command = get_command(endpoint, args[1:])
+
+    try:
+        results = replay(
+            records,
+            options.speed,
+            options.mode,
+            command,
+            options.max_processes,
+        )
+        results.update({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'recording': args[0],
+            'unreadable': unreadable,
+            'options': args[1:],
+        })
+        if server is not None:
+            results['server'] = {
+                'latency': options.latency,
+                'latency_distribution': options.latency_distribution,
+                'error_rate': options.error_rate,
+                'throttle_rate': options.throttle_rate,
+                'reset_rate': options.reset_rate,
+                'statuses': dict([
+                    (str(status).lower(), count)
+                    for (status, count) in server.statuses.items()
+                ]),
+                'elapsed': get_percentiles([
+                    timing['elapsed'] for timing in server.timings
+                ]),
+            }
+    finally:
+        if server is not None:
+            server.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+def get_option_parser():
+    """Build commandline option parser.
+
+    Returns:
+        optparse.OptionParser. Option parser for the commandline.
+    """
+
+    option_parser = optparse.OptionParser(
+        usage='%prog [options] RECORDING [-- ALERT_SCRIPT_OPTIONS]',
+        description='Replay alerts recorded by zabbix-media-hipchat '
+                    '--record.',
+    )
+
+    option_parser.add_option(
+        '--speed',
+        dest='speed',
+        type='float',
+        default=1.0,
+        metavar='FACTOR',
+        help='replay FACTOR times as fast as recorded, e.g. 10 or 100. '
+             '[default: %default]',
+    )
+    option_parser.add_option(
+        '--mode',
+        dest='mode',
+        type='choice',
+        choices=MODES,
+        default='process',
+        metavar='|'.join(MODES),
+        help='send alerts by a process each, through the delivery daemon, '
+             'or by a single process in bulk mode. [default: %default]',
+    )
+    option_parser.add_option(
+        '--max-processes',
+        dest='max_processes',
+        type='int',
+        default=16,
+        metavar='N',
+        help='number of alert scripts running at once, as StartAlerters of '
+             'Zabbix server. [default: %default]',
+    )
+    option_parser.add_option(
+        '--endpoint',
+        dest='endpoint',
+        metavar='URL',
+        help='URL of the room notification API, with %s for the room. '
+             'Defaults to a mock HipChat started for the replay.',
+    )
+    option_parser.add_option(
+        '--latency',
+        dest='latency',
+        type='float',
+        default=0.0,
+        metavar='SECONDS',
+        help='latency of the mock HipChat.',
+    )
+    option_parser.add_option(
+        '--latency-distribution',
+        dest='latency_distribution',
+        type='choice',
+        choices=LATENCY_DISTRIBUTIONS,
+        default='constant',
+        metavar='|'.join(LATENCY_DISTRIBUTIONS),
+        help='distribution of the latency of the mock HipChat. '
+             '[default: %default]',
+    )
+    option_parser.add_option(
+        '--error-rate',
+        dest='error_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests the mock HipChat fails with 5xx.',
+    )
+    option_parser.add_option(
+        '--reset-rate',
+        dest='reset_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests the mock HipChat resets the connection '
+             'of.',
+    )
+    option_parser.add_option(
+        '--throttle-rate',
+        dest='throttle_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests the mock HipChat fails with 429.',
+    )
+    option_parser.add_option(
+        '--output',
+        dest='output',
+        metavar='PATH',
+        help='write the results to PATH instead of stdout.',
+    )
+
+    return option_parser
+
+
+def read_recording(stream):
+    """Read the records of a recording.
+
+    Args:
+        stream: Iterable of lines written by
+            :func:`zabbix_media_hipchat.record_alert`.
+
+    Returns:
+        tuple. The records as dicts, in the order they were recorded, and
+        the number of lines which are not JSON objects, such as one cut
+        short by a full disk. Blank lines are skipped.
+    """
+
+    records = []
+    unreadable = 0
+
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            unreadable += 1
+            continue
+        if not isinstance(record, dict):
+            unreadable += 1
+            continue
+        records.append(record)
+
+    return (records, unreadable)
+
+
+def get_schedule(records, speed):
+    """Get when to send every record.
+
+    Args:
+        records (list): Records as returned by :func:`read_recording`.
+        speed (float): How many times as fast as recorded to replay.
+
+    Returns:
+        list. Seconds from the start of the replay until each record is
+        due. Records without a ``time`` are due along with the one before.
+    """
+
+    schedule = []
+    first = None
+    offset = 0.0
+
+    for record in records:
+        recorded = record.get('time')
+        if isinstance(recorded, (int, float)):
+            if first is None:
+                first = recorded
+            offset = max(offset, (recorded - first) / speed)
+        schedule.append(offset)
+
+    return schedule
+
+
+def get_command(endpoint, options):
+    """Build the commandline of the alert script.
+
+    Args:
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+        options (list): Further options of the alert script.
+
+    Returns:
+        list. The entry script of the alert script run by this interpreter,
+        without the positional arguments.
+    """
+
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(zabbix_media_hipchat.__file__)),
+        'zabbix-media-hipchat',
+    )
+
+    return [sys.executable, script, '--endpoint', endpoint] + list(options)
+
+
+def replay(records, speed, mode, command, max_processes=16):
+    """Replay records and summarize the outcome.
+
+    Args:
+        records (list): Records as returned by :func:`read_recording`.
+        speed (float): How many times as fast as recorded to replay.
+        mode (str): One of :data:`MODES`.
+        command (list): Commandline of the alert script as returned by
+            :func:`get_command`.
+        max_processes (int): Number of alert scripts running at once in the
+            ``process`` and ``daemon`` modes.
+
+    Returns:
+        dict. As returned by :func:`summarize`, plus ``mode`` and
+        ``speed``.
+    """
+
+    schedule = get_schedule(records, speed)
+
+    if mode == 'bulk':
+        (outcomes, elapsed) = replay_bulk(records, schedule, command)
+    elif mode == 'daemon':
+        (outcomes, elapsed) = replay_daemon(
+            records,
+            schedule,
+            command,
+            max_processes,
+        )
+    else:
+        (outcomes, elapsed) = replay_processes(
+            records,
+            schedule,
+            command,
+            max_processes,
+        )
+
+    results = summarize(outcomes, elapsed)
+    results['mode'] = mode
+    results['speed'] = speed
+    return results
+
+
+def replay_processes(records, schedule, command, max_processes=16):
+    """Replay records by running an alert script for each.
+
+    Records are taken in order by ``max_processes`` threads, each waiting
+    until the record it took is due, so that a record is late only when
+    every thread is busy with one before it.
+
+    Args:
+        records (list): Records as returned by :func:`read_recording`.
+        schedule (list): Offsets as returned by :func:`get_schedule`.
+        command (list): Commandline of the alert script, without the
+            positional arguments.
+        max_processes (int): Number of alert scripts running at once.
+
+    Returns:
+        tuple. The latency and exit status of every record, and the
+        seconds the replay took.
+    """
+
+    pending = list(range(len(records)))
+    pending.reverse()
+    outcomes = [None] * len(records)
+    lock = threading.Lock()
+    devnull = open(os.devnull, 'w')
+    started = time.time()
+
+    def run():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index = pending.pop()
+
+            due = started + schedule[index]
+            time.sleep(max(0.0, due - time.time()))
+
+            record = records[index]
+            exit_status = subprocess.call(
+                command + [
+                    record.get('destination', ''),
+                    record.get('metadata', ''),
+                    record.get('alert', ''),
+                ],
+                stdout=devnull,
+                stderr=devnull,
+            )
+            outcomes[index] = (time.time() - due, exit_status)
+
+    threads = []
+    for _ in range(max(1, max_processes)):
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        devnull.close()
+
+    return (outcomes, time.time() - started)
+
+
+def replay_daemon(records, schedule, command, max_processes=16,
+                  startup_timeout=10.0):
+    """Replay records through the delivery daemon.
+
+    The daemon is started with ``command`` on a socket of its own, and
+    interrupted once every record has been handed to it, so that the alerts
+    it coalesced are sent before the replay ends.
+
+    Args:
+        records (list): Records as returned by :func:`read_recording`.
+        schedule (list): Offsets as returned by :func:`get_schedule`.
+        command (list): Commandline of the alert script, without the
+            positional arguments.
+        max_processes (int): Number of alert scripts running at once.
+        startup_timeout (float): Seconds to wait for the daemon to listen.
+
+    Returns:
+        tuple. As returned by :func:`replay_processes`, the seconds
+        including the time the daemon took to stop.
+
+    Raises:
+        * RuntimeError: Raised when the daemon does not start listening.
+    """
+
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'daemon.sock')
+    devnull = open(os.devnull, 'w')
+
+    daemon = subprocess.Popen(
+        command + ['--serve', '--socket', socket_path],
+        stdout=devnull,
+        stderr=devnull,
+    )
+
+    try:
+        deadline = time.time() + startup_timeout
+        while not os.path.exists(socket_path):
+            if daemon.poll() is not None or time.time() > deadline:
+                raise RuntimeError('The delivery daemon did not start')
+            time.sleep(0.05)
+
+        started = time.time()
+        (outcomes, _) = replay_processes(
+            records,
+            schedule,
+            command + ['--socket', socket_path],
+            max_processes,
+        )
+    finally:
+        if daemon.poll() is None:
+            daemon.send_signal(signal.SIGINT)
+        daemon.wait()
+        devnull.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return (outcomes, time.time() - started)
+
+
+def replay_bulk(records, schedule, command):
+    """Replay records through a single alert script in bulk mode.
+
+    Records are written to the standard input of the alert script as they
+    fall due, and its results read as they are reported.
+
+    Args:
+        records (list): Records as returned by :func:`read_recording`.
+        schedule (list): Offsets as returned by :func:`get_schedule`.
+        command (list): Commandline of the alert script, without the
+            positional arguments.
+
+    Returns:
+        tuple. As returned by :func:`replay_processes`. The exit status of a
+        record sent to several rooms is the highest of them, and its latency
+        that of the last one reported. Records without a result, such as
+        coalesced ones reported at once, have the latency of the end of the
+        replay.
+    """
+
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen(
+        command + ['--bulk', '-'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=devnull,
+        universal_newlines=True,
+        bufsize=1,
+    )
+    started = time.time()
+    dues = [started + offset for offset in schedule]
+
+    def write():
+        try:
+            for (record, due) in zip(records, dues):
+                time.sleep(max(0.0, due - time.time()))
+                process.stdin.write(json.dumps({
+                    'destination': record.get('destination', ''),
+                    'metadata': record.get('metadata', ''),
+                    'alert': record.get('alert', ''),
+                }) + '\n')
+                process.stdin.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    reported = {}
+    try:
+        for line in iter(process.stdout.readline, ''):
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            index = result.get('record', 0) - 1
+            if not 0 <= index < len(records):
+                continue
+            exit_status = result.get('exit', 1)
+            if index in reported:
+                exit_status = max(exit_status, reported[index][1])
+            reported[index] = (time.time() - dues[index], exit_status)
+    finally:
+        writer.join()
+        process.wait()
+        devnull.close()
+
+    finished = time.time()
+    outcomes = [
+        reported.get(index, (finished - due, process.returncode))
+        for (index, due) in enumerate(dues)
+    ]
+
+    return (outcomes, finished - started)
+
+
+def summarize(outcomes, elapsed):
+    """Summarize the outcome of a replay.
+
+    Args:
+        outcomes (list): Latency and exit status of every record.
+        elapsed (float): Seconds the replay took.
+
+    Returns:
+        dict. ``alerts``, ``elapsed`` seconds, ``per_second``, ``latency``
+        in seconds as returned by :func:`get_percentiles`, ``exits``, the
+        number of records by exit status, ``dropped``, those which failed
+        to be sent (exit status 1), and ``malformed``, those which were
+        rejected (exit status 2).
+    """
+
+    exits = {}
+    for (_, exit_status) in outcomes:
+        exits[str(exit_status)] = exits.get(str(exit_status), 0) + 1
+
+    return {
+        'alerts': len(outcomes),
+        'elapsed': elapsed,
+        'per_second': len(outcomes) / elapsed if elapsed else None,
+        'latency': get_percentiles([latency for (latency, _) in outcomes]),
+        'exits': exits,
+        'dropped': exits.get('1', 0),
+        'malformed': exits.get('2', 0),
+    }
+
+
+if __name__ == '__main__':
+    main()
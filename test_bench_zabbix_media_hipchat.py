@@ -0,0 +1,42 @@
+from bench_zabbix_media_hipchat import bench_delivery
+from bench_zabbix_media_hipchat import bench_pipeline
+from bench_zabbix_media_hipchat import get_percentiles
+from zabbix_media_hipchat_mock import MockHipChatServer
+
+
+class TestGetPercentiles(object):
+    def test_samples(self):
+        samples = [float(value) for value in range(100, 0, -1)]
+        summary = get_percentiles(samples)
+        assert summary['count'] == 100
+        assert summary['min'] == 1.0
+        assert summary['max'] == 100.0
+        assert summary['mean'] == 50.5
+        assert summary['p50'] == 51.0
+        assert summary['p90'] == 91.0
+        assert summary['p99'] == 100.0
+
+    def test_empty(self):
+        summary = get_percentiles([])
+        assert summary['count'] == 0
+        assert summary['p99'] is None
+
+
+class TestBenchPipeline(object):
+    def test_iterations(self):
+        result = bench_pipeline(10)
+        assert result['iterations'] == 10
+        assert result['elapsed'] > 0
+
+
+class TestBenchDelivery(object):
+    def test_statuses(self):
+        server = MockHipChatServer(throttle_rate=0.5, seed=0)
+        server.start()
+        try:
+            result = bench_delivery(server.endpoint, 20, 4)
+        finally:
+            server.stop()
+        assert result['latency']['count'] == 20
+        assert sum(result['statuses'].values()) == 20
+        assert set(result['statuses']) == set(['204', '429'])
@@ -0,0 +1,98 @@
+import io
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from replay_zabbix_media_hipchat import get_command
+from replay_zabbix_media_hipchat import get_schedule
+from replay_zabbix_media_hipchat import read_recording
+from replay_zabbix_media_hipchat import replay
+from replay_zabbix_media_hipchat import summarize
+from zabbix_media_hipchat_mock import MockHipChatServer
+
+RECORDS = [
+    {
+        'time': 100.0,
+        'destination': 'room=1,auth_token=a',
+        'metadata': 'nseverity=4',
+        'alert': 'first',
+    },
+    {
+        'time': 100.5,
+        'destination': 'room=2,room=3,auth_token=a',
+        'metadata': 'status=OK',
+        'alert': 'second',
+    },
+    {
+        'time': 101.0,
+        'destination': 'room',
+        'metadata': '',
+        'alert': 'malformed',
+    },
+]
+
+
+class TestReadRecording(object):
+    def test_unreadable(self):
+        stream = io.StringIO(u'\n'.join([
+            json.dumps(RECORDS[0]),
+            '',
+            '{"time": 1',
+            '[]',
+            json.dumps(RECORDS[1]),
+        ]))
+        (records, unreadable) = read_recording(stream)
+        assert records == RECORDS[:2]
+        assert unreadable == 2
+
+
+class TestGetSchedule(object):
+    def test_speed(self):
+        assert get_schedule(RECORDS, 10.0) == [0.0, 0.05, 0.1]
+
+    def test_untimed(self):
+        records = [{}, {'time': 5.0}, {}, {'time': 4.0}, {'time': 7.0}]
+        assert get_schedule(records, 1.0) == [0.0, 0.0, 0.0, 0.0, 2.0]
+
+
+class TestSummarize(object):
+    def test_exits(self):
+        summary = summarize([(0.1, 0), (0.3, 1), (0.2, 2), (0.4, 0)], 2.0)
+        assert summary['alerts'] == 4
+        assert summary['per_second'] == 2.0
+        assert summary['latency']['max'] == 0.4
+        assert summary['exits'] == {'0': 2, '1': 1, '2': 1}
+        assert summary['dropped'] == 1
+        assert summary['malformed'] == 1
+
+
+class TestReplay(object):
+    def replay(self, mode, error_rate=0.0):
+        server = MockHipChatServer(error_rate=error_rate, seed=0)
+        server.start()
+        try:
+            command = get_command(server.endpoint, ['--timeout', '5'])
+            results = replay(RECORDS, 100.0, mode, command, 2)
+        finally:
+            server.stop()
+        return (results, server.statuses)
+
+    def test_process(self):
+        (results, statuses) = self.replay('process')
+        assert results['mode'] == 'process'
+        assert results['exits'] == {'0': 2, '2': 1}
+        assert results['latency']['count'] == 3
+        assert sum(statuses.values()) == 3
+
+    def test_bulk(self):
+        (results, statuses) = self.replay('bulk', error_rate=1.0)
+        assert results['exits'] == {'1': 2, '2': 1}
+        assert results['dropped'] == 2
+        assert sum(statuses.values()) == 3
+
+    def test_daemon(self):
+        (results, statuses) = self.replay('daemon')
+        assert results['exits'] == {'0': 2, '2': 1}
+        assert sum(statuses.values()) == 3
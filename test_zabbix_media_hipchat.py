@@ -1,17 +1,187 @@
+import io
 import optparse
+import os
 import pytest
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zabbix_media_hipchat
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+
+try:
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import HTTPServer
+
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+try:
+    from urllib2 import HTTPError
+except ImportError:
+    from urllib.error import HTTPError
+
+try:
+    from urllib2 import URLError
+except ImportError:
+    from urllib.error import URLError
+
+from zabbix_media_hipchat import API_ENDPOINT_ROOM
+from zabbix_media_hipchat import AsyncSender
+from zabbix_media_hipchat import CircuitBreaker
+from zabbix_media_hipchat import CircuitBreakerOpener
+from zabbix_media_hipchat import Coalescer
+from zabbix_media_hipchat import ConnectionPool
+from zabbix_media_hipchat import DNSCache
+from zabbix_media_hipchat import Deduplicator
+from zabbix_media_hipchat import DeliveryServer
+from zabbix_media_hipchat import Dispatcher
+from zabbix_media_hipchat import Metrics
+from zabbix_media_hipchat import OTLPTracer
+from zabbix_media_hipchat import Outbox
+from zabbix_media_hipchat import PayloadEncoder
+from zabbix_media_hipchat import PipeliningConnectionPool
 from zabbix_media_hipchat import PlainTextEpilogFormatter
+from zabbix_media_hipchat import RateLimitedOpener
+from zabbix_media_hipchat import RateLimiter
+from zabbix_media_hipchat import RoomCache
+from zabbix_media_hipchat import Router
+from zabbix_media_hipchat import TLSSessionContext
+from zabbix_media_hipchat import Tracer
+from zabbix_media_hipchat import add_repetitions
+from zabbix_media_hipchat import add_resolution
+from zabbix_media_hipchat import build_timed_opener
+from zabbix_media_hipchat import bulk_deliver
+from zabbix_media_hipchat import compile_routes
+from zabbix_media_hipchat import deliver
+from zabbix_media_hipchat import deliver_all
+from zabbix_media_hipchat import dump_body
 from zabbix_media_hipchat import get_arguments
+from zabbix_media_hipchat import get_options_and_arguments
+from zabbix_media_hipchat import get_pair_key
+from zabbix_media_hipchat import get_backoff
+from zabbix_media_hipchat import get_dispatcher
+from zabbix_media_hipchat import get_option_parser
+from zabbix_media_hipchat import get_destinations
 from zabbix_media_hipchat import get_request
+from zabbix_media_hipchat import get_requests
+from zabbix_media_hipchat import get_retry_after
+from zabbix_media_hipchat import is_retryable
+from zabbix_media_hipchat import join_destinations
+from zabbix_media_hipchat import load_router
+from zabbix_media_hipchat import merge_alerts
+from zabbix_media_hipchat import parse_address
 from zabbix_media_hipchat import parse_alert
 from zabbix_media_hipchat import parse_destination
 from zabbix_media_hipchat import parse_metadata
+from zabbix_media_hipchat import parse_record
+from zabbix_media_hipchat import quote_room
+from zabbix_media_hipchat import read_alert
+from zabbix_media_hipchat import record_alert
+from zabbix_media_hipchat import redact_destination
+from zabbix_media_hipchat import send_to_daemon
+from zabbix_media_hipchat import serve_metrics
+from zabbix_media_hipchat import set_tracer
+from zabbix_media_hipchat import trace
+from zabbix_media_hipchat import update_state_file
+from zabbix_media_hipchat import split_destinations
+from zabbix_media_hipchat import tokenize_pairs
+
+ARGS = {
+    'room': '123456',
+    'auth_token': 'a' * 40,
+    'color': 'red',
+    'notify': True,
+    'alert': '@all Test Alert',
+}
+
+
+class StubHipChatServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHipChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.bodies.append(body)
+            if self.server.connections.count(self.connection) == 0:
+                self.server.connections.append(self.connection)
+            if self.server.statuses:
+                status = self.server.statuses.pop(0)
+            else:
+                status = 204
+            delay = self.server.delays.pop(0) if self.server.delays else 0
+        time.sleep(delay)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_hipchat():
+    server = StubHipChatServer(('127.0.0.1', 0), StubHipChatHandler)
+    server.bodies = []
+    server.connections = []
+    server.statuses = []
+    server.delays = []
+    server.lock = threading.Lock()
+    server.endpoint = 'http://127.0.0.1:%d/v2/room/%%s/notification' % (
+        server.server_address[1]
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class StubOpenerDirector(object):
+    def __init__(self, exception=None):
+        self.exception = exception
+        self.requests = []
+
+    def open(self, request):
+        self.requests.append(request)
+        if self.exception:
+            raise self.exception
+        return StubResponse()
+
+
+class StubResponse(object):
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+    def getcode(self):
+        return 204
+
+    def info(self):
+        return self.headers
 
 
 class TestPlainTextEpilogFormatter(object):
@@ -30,6 +200,156 @@ class TestPlainTextEpilogFormatter(object):
         assert test_output == self.ptef.format_epilog(test_input)
 
 
+class TestOptionParser(object):
+    def test_help(self):
+        help_text = get_option_parser().format_help()
+        assert 'Positional arguments:' in help_text
+        assert 'ZABBIX_MEDIA_HIPCHAT_<OPTION>' in help_text
+
+    def test_endpoint(self, monkeypatch):
+        endpoint = 'http://localhost:8080/v2/room/%s/notification'
+        monkeypatch.setattr(
+            sys,
+            'argv',
+            ['zabbix_media_hipchat.py', '--endpoint', endpoint,
+             'room=1,auth_token=' + 'a' * 40, 'nseverity=1', 'Alert'],
+        )
+        (options, _) = get_options_and_arguments()
+        assert options.endpoint == endpoint
+        assert get_dispatcher(options, ARGS).endpoint == endpoint
+
+        monkeypatch.setattr(
+            sys,
+            'argv',
+            ['zabbix_media_hipchat.py', '--endpoint', 'http://localhost/',
+             'room=1,auth_token=' + 'a' * 40, 'nseverity=1', 'Alert'],
+        )
+        with pytest.raises(SystemExit):
+            get_options_and_arguments()
+
+    def test_transport(self):
+        option_parser = get_option_parser()
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,auth_token=a'))
+
+        (options, _) = option_parser.parse_args([])
+        dispatcher = get_dispatcher(options, ARGS)
+        assert not isinstance(dispatcher.opener_director, ConnectionPool)
+        assert type(get_dispatcher(options, args).opener_director) is \
+            ConnectionPool
+
+        (options, _) = option_parser.parse_args(['--transport', 'pipeline'])
+        dispatcher = get_dispatcher(options, ARGS)
+        assert isinstance(dispatcher.opener_director, PipeliningConnectionPool)
+
+        (options, _) = option_parser.parse_args(['--transport', 'urllib'])
+        dispatcher = get_dispatcher(options, args)
+        assert not isinstance(dispatcher.opener_director, ConnectionPool)
+
+    def test_circuit_breaker(self, capsys):
+        option_parser = get_option_parser()
+
+        (options, _) = option_parser.parse_args(
+            ['--circuit-breaker', '5/60', '--rate-limit', '100/300'],
+        )
+        dispatcher = get_dispatcher(options, ARGS)
+        opener_director = dispatcher.opener_director.opener_director
+        assert isinstance(opener_director, CircuitBreakerOpener)
+        assert opener_director.breaker.threshold == 5
+        assert opener_director.breaker.cooldown == 60.0
+
+        (options, _) = option_parser.parse_args(['--circuit-breaker', '5'])
+        with pytest.raises(SystemExit):
+            get_dispatcher(options, ARGS)
+        assert 'Malformed --circuit-breaker' in capsys.readouterr()[1]
+
+    def test_epilog_not_built(self, monkeypatch):
+        def fail():
+            raise AssertionError
+
+        monkeypatch.setattr(zabbix_media_hipchat, 'get_epilog', fail)
+        monkeypatch.setattr(
+            zabbix_media_hipchat,
+            'PlainTextEpilogFormatter',
+            fail,
+        )
+        (options, _) = get_option_parser().parse_args(['--socket', 'path'])
+        assert options.socket == 'path'
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7),
+    reason='-X importtime needs Python 3.7',
+)
+class TestImportTime(object):
+    # Microseconds the modules imported by the alert script may take.
+    BUDGET = 50000
+
+    SLOW_MODULES = [
+        'asyncio',
+        'hashlib',
+        'http.client',
+        'random',
+        'sqlite3',
+        'ssl',
+        'urllib.request',
+    ]
+
+    def import_times(self):
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import zabbix_media_hipchat'],
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+
+        times = {}
+        for line in output.decode('utf-8').splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            (own, cumulative, module) = line.split(':', 1)[1].split('|')
+            times[module.strip()] = (int(own), int(cumulative))
+        return times
+
+    def test_slow_modules_not_imported(self):
+        times = self.import_times()
+        assert 'zabbix_media_hipchat' in times
+        for module in self.SLOW_MODULES:
+            assert module not in times
+
+    def test_budget(self, tmpdir, stub_hipchat):
+        # Installed as in the AlertScriptsPath of Zabbix server, which runs
+        # the entry script for every alert. Its own time counts, as it is
+        # compiling the module whenever no bytecode is cached.
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ('zabbix-media-hipchat', 'zabbix_media_hipchat.py'):
+            tmpdir.join(name).write_binary(
+                open(os.path.join(here, name), 'rb').read(),
+            )
+
+        environment = dict(os.environ)
+        environment.pop('PYTHONDONTWRITEBYTECODE', None)
+
+        elapsed = []
+        for _ in range(3):
+            process = subprocess.Popen(
+                [sys.executable, '-X', 'importtime', 'zabbix-media-hipchat',
+                 '--endpoint', stub_hipchat.endpoint, 'room=1,auth_token=a',
+                 '', 'Test Alert'],
+                stderr=subprocess.PIPE,
+                cwd=str(tmpdir),
+                env=environment,
+            )
+            output = process.communicate()[1].decode('utf-8')
+            assert process.returncode == 0
+            for line in output.splitlines():
+                if line.endswith('| zabbix_media_hipchat'):
+                    elapsed.append(int(line.split('|')[1]))
+
+        assert len(stub_hipchat.bodies) == 3
+        assert min(elapsed) < self.BUDGET
+
+
 class TestGetArguments(object):
     def test_success(self, monkeypatch):
         output = {
@@ -37,6 +357,7 @@ class TestGetArguments(object):
             'auth_token': 'a' * 40,
             'color': 'red',
             'notify': True,
+            'nseverity': 5,
             'alert': '@all Test Alert',
         }
 
@@ -62,6 +383,2339 @@ class TestGetArguments(object):
             get_arguments()
 
 
+class TestGetOptionsAndArguments(object):
+    def test_serve(self, monkeypatch):
+        def mock_get_args(self, args):
+            return ['--serve', '--socket', '/tmp/hipchat.sock']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (options, args) = get_options_and_arguments()
+        assert options.serve
+        assert options.socket == '/tmp/hipchat.sock'
+        assert options.workers is None
+        assert args == {}
+
+    def test_workers(self, monkeypatch):
+        workers = ['4']
+
+        def mock_get_args(self, args):
+            return ['--serve', '--socket', '/tmp/hipchat.sock', '--workers',
+                    workers[0]]
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (options, _) = get_options_and_arguments()
+        assert options.workers == 4
+
+        workers[0] = '0'
+        with pytest.raises(SystemExit):
+            get_options_and_arguments()
+
+    def test_environment(self, monkeypatch):
+        def mock_get_args(self, args):
+            return ['room=1,auth_token=a', '', 'Test Alert']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+        monkeypatch.setenv('ZABBIX_MEDIA_HIPCHAT_SOCKET', '/tmp/hipchat.sock')
+
+        (options, _) = get_options_and_arguments()
+        assert options.socket == '/tmp/hipchat.sock'
+        assert not options.serve
+
+    def test_routing(self, monkeypatch, tmpdir):
+        config = tmpdir.join('routing.json')
+        config.write(json.dumps({'rules': [{'action': 'silent'}]}))
+
+        def mock_get_args(self, args):
+            return ['--routing', str(config), 'room=1,auth_token=a', '',
+                    'Alert']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (_, args) = get_options_and_arguments()
+        assert args['alert'] == 'Alert'
+        assert not args['notify']
+
+        config.write('[')
+        os.utime(str(config), (0, 0))
+        with pytest.raises(SystemExit):
+            get_options_and_arguments()
+
+        config.write(json.dumps({'rules': [{'severities': 5}]}))
+        os.utime(str(config), (1, 1))
+        with pytest.raises(SystemExit):
+            get_options_and_arguments()
+
+    def test_alert_file(self, monkeypatch, tmpdir):
+        alert = tmpdir.join('alert.txt')
+        alert.write('Test Alert')
+
+        def mock_get_args(self, args):
+            return ['--alert-file', str(alert), 'room=1,auth_token=a', '']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (_, args) = get_options_and_arguments()
+        assert args['alert'] == '@all Test Alert'
+
+    def test_alert_stdin(self, monkeypatch):
+        def mock_get_args(self, args):
+            return ['--alert-file', '-', 'room=1,auth_token=a', '']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+        monkeypatch.setattr(sys, 'stdin', io.StringIO(u'x' * 20000))
+
+        (_, args) = get_options_and_arguments()
+        assert args['alert'] == '@all %s ...' % ('x' * 9990)
+        assert not sys.stdin.read()
+
+    def test_record(self, monkeypatch, tmpdir):
+        recording = tmpdir.join('recording.jsonl')
+
+        def mock_get_args(self, args):
+            return ['--record', str(recording), 'room=1,auth_token=a',
+                    'nseverity=5', 'Alert']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (_, args) = get_options_and_arguments()
+        get_options_and_arguments()
+
+        assert args['alert'] == '@all Alert'
+        records = [json.loads(line) for line in recording.readlines()]
+        assert len(records) == 2
+        assert records[0]['metadata'] == 'nseverity=5'
+        assert records[0]['alert'] == 'Alert'
+        assert 'auth_token=a,' not in records[0]['destination']
+
+    def test_record_unwritable(self, monkeypatch, tmpdir, capsys):
+        def mock_get_args(self, args):
+            return ['--record', str(tmpdir.join('missing', 'recording')),
+                    'room=1,auth_token=a', '', 'Alert']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (_, args) = get_options_and_arguments()
+        assert args['alert'] == '@all Alert'
+        assert 'Unwritable --record' in capsys.readouterr()[1]
+
+    def test_alert_file_latin_1(self, monkeypatch, tmpdir):
+        alert = tmpdir.join('alert.txt')
+        alert.write_binary(u'Caf\xe9 down'.encode('latin-1'))
+
+        def mock_get_args(self, args):
+            return ['--alert-file', str(alert), 'room=1,auth_token=a', '']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        (_, args) = get_options_and_arguments()
+        assert args['alert'] == u'@all Caf\ufffd down'
+
+    def test_alert_stdin_latin_1(self, monkeypatch):
+        def mock_get_args(self, args):
+            return ['--alert-file', '-', 'room=1,auth_token=a', '']
+
+        stdin = io.TextIOWrapper(io.BytesIO(u'Caf\xe9'.encode('latin-1')))
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+        monkeypatch.setattr(sys, 'stdin', stdin)
+
+        (_, args) = get_options_and_arguments()
+        assert args['alert'] == u'@all Caf\ufffd'
+        assert not stdin.closed
+
+    def test_alert_file_with_alert(self, monkeypatch):
+        def mock_get_args(self, args):
+            return ['--alert-file', '-', 'room=1,auth_token=a', '', 'Alert']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+
+        with pytest.raises(SystemExit):
+            get_options_and_arguments()
+
+    def test_timeouts(self, monkeypatch):
+        def mock_get_args(self, args):
+            return ['--timeout', '2.5', 'room=1,auth_token=a', '', 'Alert']
+
+        monkeypatch.setattr(optparse.OptionParser, '_get_args', mock_get_args)
+        monkeypatch.setenv('ZABBIX_MEDIA_HIPCHAT_CONNECT_TIMEOUT', '0.5')
+
+        (options, _) = get_options_and_arguments()
+        assert options.connect_timeout == 0.5
+        assert options.timeout == 2.5
+
+
+class TestDeliver(object):
+    def test_success(self):
+        result = deliver(ARGS, StubOpenerDirector(), API_ENDPOINT_ROOM)
+        assert result['room'] == '123456'
+        assert result['status'] == 204
+        assert result['error'] is None
+        assert result['elapsed'] >= 0
+
+    def test_http_error(self):
+        error = HTTPError('url', 401, 'Unauthorized', {}, None)
+        result = deliver(ARGS, StubOpenerDirector(error), API_ENDPOINT_ROOM)
+        assert result['status'] == 401
+        assert 'Unauthorized' in result['error']
+
+    def test_url_error(self):
+        error = URLError('unreachable')
+        result = deliver(ARGS, StubOpenerDirector(error), API_ENDPOINT_ROOM)
+        assert result['status'] is None
+        assert 'unreachable' in result['error']
+
+    def test_rooms(self):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,auth_token=a'))
+        with pytest.raises(ValueError):
+            deliver(args, StubOpenerDirector(), API_ENDPOINT_ROOM)
+
+
+class TestDeliverAll(object):
+    def test_single_room(self):
+        opener_director = StubOpenerDirector()
+        results = deliver_all(ARGS, opener_director, API_ENDPOINT_ROOM)
+        assert [r['room'] for r in results] == ['123456']
+
+    def test_rooms(self, stub_hipchat):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2|b,room=3,auth_token=a'))
+        pool = ConnectionPool()
+
+        results = deliver_all(args, pool, stub_hipchat.endpoint)
+        pool.close()
+
+        assert [r['room'] for r in results] == ['1', '2', '3']
+        assert [r['status'] for r in results] == [204, 204, 204]
+        assert len(stub_hipchat.bodies) == 3
+        assert len(set(stub_hipchat.bodies)) == 1
+
+    def test_rooms_mismatching_first(self):
+        args = dict(ARGS)
+        args['rooms'] = [
+            {'room': '1', 'auth_token': 'a'},
+            {'room': '2', 'auth_token': 'b'},
+        ]
+        opener_director = StubOpenerDirector()
+
+        results = deliver_all(args, opener_director, API_ENDPOINT_ROOM)
+
+        assert [r['room'] for r in results] == ['1', '2']
+        assert sorted(
+            (r.get_full_url(), r.get_header('Authorization'))
+            for r in opener_director.requests
+        ) == [
+            (API_ENDPOINT_ROOM % '1', 'Bearer a'),
+            (API_ENDPOINT_ROOM % '2', 'Bearer b'),
+        ]
+
+    def test_max_workers(self):
+        opener_director = SlowOpenerDirector(0.02)
+        args = dict(ARGS)
+        args.update(parse_destination(
+            ','.join('room=%d' % i for i in range(6)) + ',auth_token=a'
+        ))
+
+        results = deliver_all(
+            args,
+            opener_director,
+            API_ENDPOINT_ROOM,
+            max_workers=2,
+        )
+
+        assert [r['room'] for r in results] == [str(i) for i in range(6)]
+        assert opener_director.max_in_flight == 2
+
+    def test_partial_failure(self, stub_hipchat):
+        stub_hipchat.statuses = [204, 401]
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,auth_token=a'))
+
+        results = deliver_all(args, ConnectionPool(), stub_hipchat.endpoint)
+
+        assert sorted(r['status'] for r in results) == [204, 401]
+        assert len([r for r in results if r['error']]) == 1
+
+
+class TestBuildTimedOpener(object):
+    def test_open(self, stub_hipchat):
+        opener_director = build_timed_opener(5.0, 5.0)
+        result = deliver(ARGS, opener_director, stub_hipchat.endpoint)
+        assert result['status'] == 204
+
+    def test_read_timeout(self, stub_hipchat):
+        stub_hipchat.delays.append(2.0)
+        opener_director = build_timed_opener(5.0, 0.2)
+
+        result = deliver(ARGS, opener_director, stub_hipchat.endpoint)
+
+        assert result['status'] is None
+        assert 'timed out' in result['error']
+        assert result['elapsed'] < 2.0
+
+
+class TestConnectionPool(object):
+    def test_keep_alive(self, stub_hipchat):
+        pool = ConnectionPool()
+        for _ in range(3):
+            result = deliver(ARGS, pool, stub_hipchat.endpoint)
+            assert result['status'] == 204
+        pool.close()
+
+        assert len(stub_hipchat.bodies) == 3
+        assert len(stub_hipchat.connections) == 1
+
+    def test_metrics(self, stub_hipchat):
+        metrics = Metrics()
+        pool = ConnectionPool(metrics=metrics)
+        for _ in range(2):
+            assert deliver(ARGS, pool, stub_hipchat.endpoint)['status'] == 204
+        pool.close()
+
+        histograms = metrics._histograms
+        assert histograms['dns']['count'] == 1
+        assert histograms['connect']['count'] == 1
+        assert histograms['response']['count'] == 2
+        assert 'tls' not in histograms
+
+    def test_resolver(self, stub_hipchat):
+        resolver = DNSCache(60.0)
+        resolver.resolve('127.0.0.1', stub_hipchat.server_address[1])
+        pool = ConnectionPool(resolver=resolver)
+
+        assert deliver(ARGS, pool, stub_hipchat.endpoint)['status'] == 204
+        pool.close()
+
+    def test_stale_resolver(self, stub_hipchat):
+        port = stub_hipchat.server_address[1]
+        resolver = DNSCache(60.0)
+        resolver._entries['127.0.0.1:%d' % port] = {
+            'addresses': [[
+                socket.AF_INET,
+                socket.SOCK_STREAM,
+                0,
+                '',
+                ['127.0.0.1', 1],
+            ]],
+            'expires': time.time() + 60,
+        }
+        pool = ConnectionPool(resolver=resolver)
+
+        assert deliver(ARGS, pool, stub_hipchat.endpoint)['status'] == 204
+        pool.close()
+        address = resolver.resolve('127.0.0.1', port)[0][4]
+        assert tuple(address[:2]) == ('127.0.0.1', port)
+
+    def test_http_error(self, stub_hipchat):
+        stub_hipchat.statuses = [429]
+        request = get_request(ARGS, stub_hipchat.endpoint)
+
+        with pytest.raises(HTTPError):
+            ConnectionPool().open(request)
+
+    def test_url_error(self):
+        request = get_request(ARGS, 'http://127.0.0.1:1/%s')
+
+        with pytest.raises(URLError):
+            ConnectionPool().open(request)
+
+    def test_retry_closed_idle_connection(self, stub_hipchat):
+        pool = ConnectionPool()
+        assert deliver(ARGS, pool, stub_hipchat.endpoint)['status'] == 204
+
+        for connections in pool._idle.values():
+            for connection in connections:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+
+        assert deliver(ARGS, pool, stub_hipchat.endpoint)['status'] == 204
+        assert len(stub_hipchat.bodies) == 2
+
+    def test_no_retry_after_read_timeout(self, stub_hipchat):
+        pool = ConnectionPool(timeout=0.1)
+        assert deliver(ARGS, pool, stub_hipchat.endpoint)['status'] == 204
+        stub_hipchat.delays = [0.3]
+
+        result = deliver(ARGS, pool, stub_hipchat.endpoint)
+
+        assert result['status'] is None
+        assert result['error']
+        time.sleep(0.3)
+        assert len(stub_hipchat.bodies) == 2
+
+
+class TestPipeliningConnectionPool(object):
+    def test_open_many(self, stub_hipchat):
+        stub_hipchat.statuses = [204, 429, 204]
+        pool = PipeliningConnectionPool()
+        requests = [
+            get_request(dict(ARGS, room=room), stub_hipchat.endpoint)
+            for room in ('1', '2', '3')
+        ]
+
+        responses = pool.open_many(requests)
+        pool.close()
+
+        assert responses[0].getcode() == 204
+        assert isinstance(responses[1], HTTPError)
+        assert responses[1].code == 429
+        assert responses[2].getcode() == 204
+        assert len(stub_hipchat.connections) == 1
+
+    def test_depth(self, stub_hipchat):
+        pool = PipeliningConnectionPool(depth=2)
+        requests = [
+            get_request(dict(ARGS, room=str(room)), stub_hipchat.endpoint)
+            for room in range(5)
+        ]
+
+        responses = pool.open_many(requests)
+        assert [r.getcode() for r in responses] == [204] * 5
+        assert len(stub_hipchat.bodies) == 5
+        assert len(stub_hipchat.connections) == 1
+
+        for connections in pool._idle.values():
+            for connection in connections:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+
+        responses = pool.open_many(requests[:2])
+        pool.close()
+        assert [r.getcode() for r in responses] == [204] * 2
+
+    def test_url_error(self):
+        requests = [get_request(ARGS, 'http://127.0.0.1:1/%s')] * 2
+
+        responses = PipeliningConnectionPool().open_many(requests)
+
+        assert [type(r) for r in responses] == [URLError] * 2
+
+    def test_deliver_all(self, stub_hipchat):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,room=3,auth_token=a'))
+        pool = PipeliningConnectionPool()
+
+        results = deliver_all(args, pool, stub_hipchat.endpoint)
+        pool.close()
+
+        assert [r['room'] for r in results] == ['1', '2', '3']
+        assert [r['status'] for r in results] == [204, 204, 204]
+        assert len(stub_hipchat.connections) == 1
+
+
+class TestDeliveryServer(object):
+    @pytest.fixture
+    def server(self, tmpdir):
+        server = DeliveryServer(
+            str(tmpdir.join('hipchat.sock')),
+            Dispatcher(StubOpenerDirector(), API_ENDPOINT_ROOM),
+        )
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def test_deliver(self, server):
+        [result] = send_to_daemon(server.server_address, ARGS)
+        assert result['status'] == 204
+        assert result['error'] is None
+        assert len(server.dispatcher.opener_director.requests) == 1
+
+    def test_deliver_rooms(self, server):
+        args = dict(ARGS)
+        args['rooms'] = [
+            {'room': '1', 'auth_token': 'a'},
+            {'room': '2', 'auth_token': 'b'},
+        ]
+        results = send_to_daemon(server.server_address, args)
+        assert [r['room'] for r in results] == ['1', '2']
+        assert len(server.dispatcher.opener_director.requests) == 2
+
+    def test_malformed(self, server):
+        [result] = send_to_daemon(server.server_address, {'room': '1'})
+        assert result['status'] is None
+        assert result['error'].startswith('Malformed request')
+
+    def test_daemon_already_running(self, server):
+        with pytest.raises(socket.error):
+            DeliveryServer(
+                server.server_address,
+                Dispatcher(StubOpenerDirector(), API_ENDPOINT_ROOM),
+            )
+        [result] = send_to_daemon(server.server_address, ARGS)
+        assert result['status'] == 204
+
+    def test_stale_socket(self, tmpdir):
+        socket_path = str(tmpdir.join('hipchat.sock'))
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(socket_path)
+        stale.close()
+
+        server = DeliveryServer(
+            socket_path,
+            Dispatcher(StubOpenerDirector(), API_ENDPOINT_ROOM),
+        )
+        server.server_close()
+
+    def test_daemon_closes_connection(self, tmpdir):
+        socket_path = str(tmpdir.join('hipchat.sock'))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(1)
+
+        def accept_and_close():
+            (connection, _) = listener.accept()
+            connection.makefile('rb').readline()
+            connection.close()
+
+        thread = threading.Thread(target=accept_and_close)
+        thread.start()
+        results = send_to_daemon(socket_path, ARGS, timeout=5)
+        thread.join()
+        listener.close()
+
+        assert [r['room'] for r in results] == ['123456']
+        assert 'closed the connection' in results[0]['error']
+
+    def test_socket_removed(self, server):
+        server.shutdown()
+        server.server_close()
+        assert not os.path.exists(server.server_address)
+
+    def test_socket_kept_by_worker(self, server):
+        server.pid = -1
+        server.shutdown()
+        server.server_close()
+        assert os.path.exists(server.server_address)
+
+    def test_shared_socket(self, server):
+        server.socket.setblocking(False)
+        for _ in range(3):
+            [result] = send_to_daemon(server.server_address, ARGS, timeout=5)
+            assert result['status'] == 204
+
+    def test_wait_idle(self, server):
+        server.dispatcher.opener_director = SlowOpenerDirector(0.5)
+        thread = threading.Thread(
+            target=send_to_daemon,
+            args=(server.server_address, ARGS),
+        )
+        thread.start()
+        while not server.active:
+            time.sleep(0.01)
+
+        assert not server.wait_idle(0.01)
+        assert server.wait_idle(5)
+        assert server.dispatcher.opener_director.log[-1][0] == 'end'
+        thread.join()
+
+    def test_not_running(self, tmpdir):
+        with pytest.raises(IOError):
+            send_to_daemon(str(tmpdir.join('hipchat.sock')), ARGS)
+
+
+class TestSupervise(object):
+    @pytest.fixture
+    def daemon(self, tmpdir, stub_hipchat):
+        socket_path = str(tmpdir.join('hipchat.sock'))
+        process = subprocess.Popen(
+            [sys.executable, 'zabbix_media_hipchat.py', '--serve',
+             '--socket', socket_path, '--workers', '2', '--coalesce', '60',
+             '--endpoint', stub_hipchat.endpoint],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE,
+        )
+        while len(self.workers(process)) < 2:
+            assert process.poll() is None
+            time.sleep(0.05)
+        process.socket_path = socket_path
+        yield process
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stderr.close()
+
+    def workers(self, process):
+        try:
+            output = subprocess.check_output(['pgrep', '-P', str(process.pid)])
+        except subprocess.CalledProcessError:
+            return []
+        return [int(pid) for pid in output.split()]
+
+    def test_restart(self, daemon):
+        [worker, _] = self.workers(daemon)
+        os.kill(worker, 9)
+        while True:
+            workers = self.workers(daemon)
+            if len(workers) == 2 and worker not in workers:
+                break
+            time.sleep(0.05)
+
+        [result] = send_to_daemon(daemon.socket_path, ARGS, timeout=5)
+        assert result['coalesced']
+
+        daemon.terminate()
+        assert daemon.wait() == 0
+        assert b'Worker 0 was killed by signal 9' in daemon.stderr.read()
+
+    def test_drain(self, daemon, stub_hipchat):
+        for _ in range(4):
+            [result] = send_to_daemon(daemon.socket_path, ARGS, timeout=5)
+            assert result['coalesced']
+        assert not stub_hipchat.bodies
+
+        daemon.terminate()
+        assert daemon.wait() == 0
+        assert not os.path.exists(daemon.socket_path)
+        # Every worker sends the digest of the alerts it took.
+        assert 1 <= len(stub_hipchat.bodies) <= 2
+
+
+class SlowOpenerDirector(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.log = []
+
+    def open(self, request):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.log.append(('start', request.get_full_url(), request.data))
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+            self.log.append(('end', request.get_full_url(), request.data))
+        return StubResponse()
+
+
+class TestAsyncSender(object):
+    @pytest.fixture
+    def loop(self):
+        asyncio = pytest.importorskip('asyncio')
+        loop = asyncio.new_event_loop()
+        yield loop
+        loop.close()
+
+    def args(self, room, alert):
+        args = dict(ARGS)
+        args['room'] = room
+        args['alert'] = alert
+        return args
+
+    def test_send(self, loop):
+        sender = AsyncSender(StubOpenerDirector(), loop=loop)
+        [result] = loop.run_until_complete(sender.send(ARGS))
+        sender.close()
+        assert result['status'] == 204
+
+    def test_send_rooms(self, loop):
+        opener_director = StubOpenerDirector()
+        sender = AsyncSender(opener_director, loop=loop)
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,auth_token=a'))
+
+        results = loop.run_until_complete(sender.send(args))
+        sender.close()
+
+        assert [r['room'] for r in results] == ['1', '2']
+        assert len(opener_director.requests) == 2
+
+    def test_limit(self, loop):
+        opener_director = SlowOpenerDirector(0.05)
+        sender = AsyncSender(opener_director, limit=3, loop=loop)
+        args_list = [self.args(str(room), 'a') for room in range(9)]
+
+        results = loop.run_until_complete(sender.send_many(args_list))
+        sender.close()
+
+        assert [r['room'] for [r] in results] == [str(i) for i in range(9)]
+        assert opener_director.max_in_flight == 3
+
+    def test_room_order(self, loop):
+        opener_director = SlowOpenerDirector(0.01)
+        sender = AsyncSender(opener_director, limit=4, loop=loop)
+        args_list = [
+            self.args(room, str(i)) for i in range(5) for room in '12'
+        ]
+
+        loop.run_until_complete(sender.send_many(args_list))
+        sender.close()
+
+        for room in '12':
+            url = API_ENDPOINT_ROOM % room
+            events = [
+                (event, json.loads(data.decode('utf-8'))['message'])
+                for (event, event_url, data) in opener_director.log
+                if event_url == url
+            ]
+            expected = []
+            for i in range(5):
+                expected.extend([('start', str(i)), ('end', str(i))])
+            assert events == expected
+
+    def test_pool_size(self, loop):
+        pool = ConnectionPool(maxsize=2)
+        sender = AsyncSender(pool, limit=10, loop=loop)
+        sender.close()
+        assert pool.maxsize == 10
+
+    def test_send_many_empty(self, loop):
+        sender = AsyncSender(StubOpenerDirector(), loop=loop)
+        assert loop.run_until_complete(sender.send_many([])) == []
+        sender.close()
+
+
+class TestOutbox(object):
+    @pytest.fixture
+    def outbox(self, tmpdir):
+        outbox = Outbox(str(tmpdir.join('spool.db')), max_entries=3)
+        yield outbox
+        outbox.close()
+
+    def test_put(self, outbox):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2|b,auth_token=a'))
+
+        entries = outbox.put(args)
+
+        assert len(outbox) == 2
+        assert [e['args']['room'] for e in entries] == ['1', '2']
+        assert [e['args']['auth_token'] for e in entries] == ['a', 'b']
+        assert 'rooms' not in entries[0]['args']
+
+    def test_put_leases(self, outbox):
+        outbox.put(ARGS)
+        assert outbox.claim() == []
+
+    def test_max_entries(self, outbox):
+        for room in '12345':
+            args = dict(ARGS)
+            args['room'] = room
+            outbox.put(args)
+
+        outbox.lease = 0
+        outbox.put(ARGS)
+        assert len(outbox) == 3
+
+    def test_claim_due(self, outbox):
+        [entry] = outbox.put(ARGS)
+        assert outbox.retry(entry, retry_after=0)
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+
+        [claimed] = outbox.claim()
+
+        assert claimed['id'] == entry['id']
+        assert claimed['attempts'] == 1
+        assert claimed['args'] == ARGS
+        assert outbox.claim() == []
+
+    def test_retry_after(self, outbox):
+        [entry] = outbox.put(ARGS)
+        outbox.retry(entry, retry_after=120)
+        assert outbox.next_due() >= time.time() + 119
+
+    def test_max_attempts(self, outbox):
+        outbox.max_attempts = 1
+        [entry] = outbox.put(ARGS)
+        assert not outbox.retry(entry)
+        assert len(outbox) == 0
+
+    def test_max_age(self, outbox):
+        outbox.put(ARGS)
+        outbox._connection.execute('UPDATE outbox SET created = 0, due = 0')
+        assert outbox.claim() == []
+        assert len(outbox) == 0
+
+    def test_done_and_compact(self, outbox):
+        [entry] = outbox.put(ARGS)
+        outbox.done(entry['id'])
+        outbox.compact(threshold=1)
+        assert len(outbox) == 0
+        assert outbox.next_due() is None
+
+    def test_max_entries_severity(self, outbox):
+        for color in ('red', 'gray', 'yellow', 'gray'):
+            args = dict(ARGS)
+            args['color'] = color
+            outbox.put(args)
+
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        claimed = outbox.claim()
+
+        assert [e['args']['color'] for e in claimed] == \
+            ['red', 'yellow', 'gray']
+        assert claimed[2]['id'] == 4
+
+    def test_claim_severity(self, outbox):
+        outbox.max_entries = 100
+        for color in ('gray', 'purple', 'yellow', 'red', 'gray'):
+            args = dict(ARGS)
+            args['color'] = color
+            outbox.put(args)
+
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        claimed = outbox.claim()
+
+        assert [e['args']['color'] for e in claimed] == \
+            ['red', 'yellow', 'purple', 'gray', 'gray']
+        assert [e['id'] for e in claimed[3:]] == [1, 5]
+
+    def test_claim_nseverity(self, outbox):
+        # Average, High and Disaster are all red.
+        outbox.max_entries = 100
+        for metadata in ('nseverity=3', 'nseverity=5', 'nseverity=4',
+                         'nseverity=2'):
+            args = dict(ARGS)
+            args.update(parse_metadata(metadata))
+            outbox.put(args)
+        outbox.put(dict(ARGS, color='purple'))
+
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        claimed = outbox.claim()
+
+        assert [e['args'].get('nseverity') for e in claimed] == \
+            [5, 4, 3, 2, None]
+        assert claimed[-1]['args']['color'] == 'purple'
+
+    def test_claim_aging(self, outbox):
+        for color in ('gray', 'red'):
+            args = dict(ARGS)
+            args['color'] = color
+            outbox.put(args)
+
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        outbox._connection.execute(
+            'UPDATE outbox SET rank = rank - ? WHERE id = 1',
+            (5 * outbox.aging + 1,),
+        )
+        claimed = outbox.claim()
+
+        assert [e['args']['color'] for e in claimed] == ['gray', 'red']
+
+    def test_claim_recovery_lane(self, outbox):
+        outbox.max_entries = 100
+        for color in ['red'] * 10 + ['green'] * 3:
+            args = dict(ARGS)
+            args['color'] = color
+            outbox.put(args)
+
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+
+        claimed = outbox.claim(limit=8)
+        assert [e['args']['color'] for e in claimed] == \
+            ['red'] * 6 + ['green'] * 2
+
+        claimed = outbox.claim(limit=8)
+        assert [e['args']['color'] for e in claimed] == \
+            ['red'] * 4 + ['green']
+
+    def test_claim_backlog(self, outbox):
+        outbox.max_entries = 2000
+        for _ in range(1000):
+            args = dict(ARGS)
+            args['color'] = 'gray'
+            outbox.put(args)
+        outbox.put(ARGS)
+
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        [claimed] = outbox.claim(limit=1)
+
+        assert claimed['id'] == 1001
+
+    def test_cancel(self, outbox):
+        problem = dict(ARGS, eventid='42')
+        recovery = dict(ARGS, eventid='42', color='green')
+        [entry] = outbox.put(problem)
+        assert outbox.cancel(recovery) is None
+
+        outbox.retry(entry, retry_after=120)
+        assert outbox.cancel(dict(recovery, room='654321')) is None
+        assert outbox.cancel(dict(recovery, eventid='43')) is None
+        assert outbox.cancel(recovery) == entry['created']
+        assert len(outbox) == 0
+
+    def test_cancel_expired_lease(self, outbox):
+        outbox.put(dict(ARGS, triggerid='13'))
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        assert outbox.cancel(dict(ARGS, triggerid='13', color='green'))
+        assert len(outbox) == 0
+
+    def test_cancel_claimed(self, outbox):
+        [entry] = outbox.put(dict(ARGS, eventid='42'))
+        outbox.retry(entry, retry_after=0)
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        assert outbox.claim()
+        assert outbox.cancel(dict(ARGS, eventid='42', color='green')) is None
+
+    def test_migrate(self, tmpdir):
+        import sqlite3
+
+        path = str(tmpdir.join('spool.db'))
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'created REAL NOT NULL, '
+            'due REAL NOT NULL, '
+            'attempts INTEGER NOT NULL, '
+            'args TEXT NOT NULL)'
+        )
+        connection.execute(
+            'INSERT INTO outbox (created, due, attempts, args) '
+            "VALUES (?, 0, 0, '{}')",
+            (time.time(),),
+        )
+        connection.commit()
+        connection.close()
+
+        outbox = Outbox(path)
+        outbox.put(ARGS)
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        claimed = outbox.claim()
+        outbox.close()
+
+        assert [e['id'] for e in claimed] == [2, 1]
+
+    def test_persistent(self, tmpdir):
+        path = str(tmpdir.join('spool.db'))
+        outbox = Outbox(path)
+        outbox.put(ARGS)
+        outbox.close()
+
+        outbox = Outbox(path, lease=0)
+        assert len(outbox) == 1
+        outbox.close()
+
+
+class TestGetBackoff(object):
+    def test_exponential(self):
+        for attempts in range(1, 6):
+            delay = get_backoff(attempts, base=2.0)
+            assert 2.0 ** attempts / 2 <= delay <= 2.0 ** attempts
+
+    def test_cap(self):
+        assert get_backoff(100, cap=10.0) <= 10.0
+
+    def test_retry_after(self):
+        assert get_backoff(1, base=2.0, retry_after=30) == 30
+
+
+class TestIsRetryable(object):
+    def test_statuses(self):
+        assert is_retryable({'status': None})
+        assert is_retryable({'status': 429})
+        assert is_retryable({'status': 503})
+        assert not is_retryable({'status': 401})
+        assert not is_retryable({'status': 404})
+
+
+class TestGetRetryAfter(object):
+    def test_seconds(self):
+        error = HTTPError('url', 429, 'Too Many', {'Retry-After': '7'}, None)
+        assert get_retry_after(error) == 7.0
+
+    def test_missing(self):
+        error = HTTPError('url', 429, 'Too Many', {}, None)
+        assert get_retry_after(error) is None
+
+    def test_date(self):
+        error = HTTPError(
+            'url',
+            429,
+            'Too Many',
+            {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+            None,
+        )
+        assert get_retry_after(error) is None
+
+
+class TestDispatcher(object):
+    @pytest.fixture
+    def outbox(self, tmpdir):
+        outbox = Outbox(str(tmpdir.join('spool.db')))
+        yield outbox
+        outbox.close()
+
+    def test_without_outbox(self):
+        [result] = Dispatcher(StubOpenerDirector()).deliver(ARGS)
+        assert result['status'] == 204
+        assert not result['queued']
+
+    def test_success_removed(self, outbox):
+        dispatcher = Dispatcher(StubOpenerDirector(), outbox=outbox)
+        [result] = dispatcher.deliver(ARGS)
+        assert not result['queued']
+        assert len(outbox) == 0
+
+    def test_retryable_queued(self, outbox):
+        error = HTTPError('url', 503, 'Unavailable', {}, None)
+        dispatcher = Dispatcher(StubOpenerDirector(error), outbox=outbox)
+        [result] = dispatcher.deliver(ARGS)
+        assert result['queued']
+        assert len(outbox) == 1
+
+    def test_not_retryable_dropped(self, outbox):
+        error = HTTPError('url', 401, 'Unauthorized', {}, None)
+        dispatcher = Dispatcher(StubOpenerDirector(error), outbox=outbox)
+        [result] = dispatcher.deliver(ARGS)
+        assert not result['queued']
+        assert len(outbox) == 0
+
+    def test_dropped(self):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,room=3,auth_token=a'))
+        args['rooms'][0]['dropped'] = True
+        args['rooms'][2]['dropped'] = True
+        opener_director = StubOpenerDirector()
+        metrics = Metrics()
+
+        results = Dispatcher(opener_director, metrics=metrics).deliver(args)
+
+        assert [r['room'] for r in results] == ['1', '2', '3']
+        assert [r['dropped'] for r in results] == [True, False, True]
+        assert results[1]['status'] == 204
+        assert len(opener_director.requests) == 1
+        assert 'outcome="dropped"' in metrics.format_prometheus()
+
+    def test_all_dropped(self):
+        opener_director = StubOpenerDirector()
+        args = dict(ARGS, dropped=True)
+
+        [result] = Dispatcher(opener_director).deliver(args)
+
+        assert result['dropped']
+        assert not result['error']
+        assert not opener_director.requests
+
+    def test_drain(self, outbox, monkeypatch):
+        monkeypatch.setattr(
+            zabbix_media_hipchat,
+            'get_backoff',
+            lambda *args, **kwargs: 0.0,
+        )
+        opener_director = StubOpenerDirector(URLError('unreachable'))
+        dispatcher = Dispatcher(opener_director, outbox=outbox)
+        dispatcher.deliver(ARGS)
+        assert dispatcher.drain() == 0
+        assert len(outbox) == 1
+
+        opener_director.exception = None
+        assert dispatcher.drain() == 1
+        assert len(outbox) == 0
+        assert len(opener_director.requests) == 3
+
+    def test_coalesce(self):
+        opener_director = StubOpenerDirector()
+        dispatcher = Dispatcher(opener_director, coalesce=60.0)
+        [result] = dispatcher.deliver(ARGS)
+        assert result['coalesced']
+        assert result['error'] is None
+        dispatcher.deliver(ARGS)
+        assert opener_director.requests == []
+
+        dispatcher.close()
+        [request] = opener_director.requests
+        body = json.loads(request.data.decode('utf-8'))
+        assert body['message'].startswith('@all 2 alerts (red: 2)')
+
+    def test_pairing_collapse(self, outbox, monkeypatch):
+        monkeypatch.setattr(
+            zabbix_media_hipchat,
+            'get_backoff',
+            lambda *args, **kwargs: 60.0,
+        )
+        opener_director = StubOpenerDirector(URLError('unreachable'))
+        dispatcher = Dispatcher(
+            opener_director,
+            outbox=outbox,
+            pairing='collapse',
+        )
+        dispatcher.deliver(dict(ARGS, eventid='42'))
+        assert len(outbox) == 1
+
+        opener_director.exception = None
+        [result] = dispatcher.deliver(dict(ARGS, eventid='42', color='green'))
+
+        assert not result['cancelled']
+        assert result['status'] == 204
+        assert len(outbox) == 0
+        body = json.loads(opener_director.requests[-1].data.decode('utf-8'))
+        assert body['color'] == 'green'
+        assert body['message'].endswith('before the problem was sent)')
+
+    def test_pairing_drop(self):
+        opener_director = StubOpenerDirector()
+        metrics = Metrics()
+        dispatcher = Dispatcher(
+            opener_director,
+            coalesce=60.0,
+            metrics=metrics,
+            pairing='drop',
+        )
+        args = dict(ARGS, rooms=[
+            {'room': '123456', 'auth_token': 'a' * 40},
+            {'room': '654321', 'auth_token': 'b' * 40},
+        ])
+        dispatcher.deliver(dict(ARGS, triggerid='13'))
+
+        results = dispatcher.deliver(dict(args, triggerid='13', color='green'))
+
+        assert [r['cancelled'] for r in results] == [True, False]
+        assert results[1]['coalesced']
+        dispatcher.close()
+        [request] = opener_director.requests
+        assert '/654321/' in request.get_full_url()
+        assert 'outcome="cancelled"' in metrics.format_prometheus()
+
+    def test_pairing_digest(self, outbox, monkeypatch):
+        monkeypatch.setattr(
+            zabbix_media_hipchat,
+            'get_backoff',
+            lambda *args, **kwargs: 60.0,
+        )
+        opener_director = StubOpenerDirector(URLError('unreachable'))
+        dispatcher = Dispatcher(
+            opener_director,
+            outbox=outbox,
+            coalesce=60.0,
+            pairing='drop',
+        )
+        for (eventid, alert) in [('1', 'disk full'), ('2', 'db down'),
+                                 ('3', 'cpu load')]:
+            dispatcher.deliver(dict(ARGS, eventid=eventid, alert=alert))
+
+        # Waiting to be coalesced, the problem alone is cancelled.
+        [result] = dispatcher.deliver(dict(ARGS, eventid='3', color='green'))
+        assert result['cancelled']
+
+        dispatcher.coalescer.flush()
+        assert len(outbox) == 1
+
+        # The digest of the others is not cancelled by either recovery.
+        for eventid in ('1', '2'):
+            [result] = dispatcher.deliver(
+                dict(ARGS, eventid=eventid, color='green'),
+            )
+            assert not result['cancelled']
+        assert len(outbox) == 1
+
+        opener_director.exception = None
+        outbox._connection.execute('UPDATE outbox SET due = 0')
+        dispatcher.drain()
+        body = json.loads(opener_director.requests[-1].data.decode('utf-8'))
+        assert body['message'].endswith('- disk full\n- db down')
+        dispatcher.close()
+
+    def test_pairing_unpaired(self):
+        opener_director = StubOpenerDirector()
+        dispatcher = Dispatcher(opener_director, pairing='drop')
+        [result] = dispatcher.deliver(dict(ARGS, color='green'))
+        assert not result['cancelled']
+        assert result['status'] == 204
+
+    def test_room_cache(self, outbox):
+        opener_director = StubRoomsOpenerDirector({'Ops': 42})
+        metrics = Metrics()
+        dispatcher = Dispatcher(
+            opener_director,
+            outbox=outbox,
+            metrics=metrics,
+            room_cache=RoomCache(60.0),
+        )
+        args = dict(ARGS)
+        args.update(parse_destination('room=Ops,room=Nope,auth_token=a'))
+
+        results = dispatcher.deliver(args)
+
+        assert [r['room'] for r in results] == ['Ops', 'Nope']
+        assert [r['status'] for r in results] == [204, 404]
+        assert results[1]['error'] == 'Unknown room: Nope'
+        assert not results[1]['queued']
+        [request] = opener_director.requests
+        assert request.get_full_url() == API_ENDPOINT_ROOM % '42'
+        assert len(outbox) == 0
+        assert 'outcome="failure"' in metrics.format_prometheus()
+
+    def test_dedup(self):
+        opener_director = StubOpenerDirector()
+        dispatcher = Dispatcher(
+            opener_director,
+            deduplicator=Deduplicator(60.0),
+        )
+        args = dict(ARGS, rooms=[
+            {'room': '123456', 'auth_token': 'a' * 40},
+            {'room': '654321', 'auth_token': 'b' * 40},
+        ])
+
+        [result] = dispatcher.deliver(ARGS)
+        assert not result['suppressed']
+        results = dispatcher.deliver(args)
+        assert [result['suppressed'] for result in results] == [True, False]
+        assert len(opener_director.requests) == 2
+        dispatcher.close()
+
+
+class TestDeduplicator(object):
+    def test_repetition(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        deduplicator = Deduplicator(60.0)
+
+        assert deduplicator.check(ARGS) == 0
+        assert deduplicator.check(ARGS) is None
+        assert deduplicator.check(ARGS) is None
+        assert deduplicator.check(dict(ARGS, color='green')) == 0
+        assert deduplicator.check(dict(ARGS, room='654321')) == 0
+
+        now[0] += 61.0
+        assert deduplicator.check(ARGS) == 2
+        assert deduplicator.check(ARGS) is None
+        deduplicator.close()
+
+    def test_eviction(self):
+        deduplicator = Deduplicator(60.0, slots=8)
+        for index in range(9):
+            assert deduplicator.check(dict(ARGS, alert=str(index))) == 0
+        assert deduplicator.check(dict(ARGS, alert='0')) == 0
+        assert deduplicator.check(dict(ARGS, alert='8')) is None
+        deduplicator.close()
+
+    def test_shared(self, tmpdir):
+        path = str(tmpdir.join('dedup'))
+        first = Deduplicator(60.0, path)
+        second = Deduplicator(60.0, path)
+        assert first.check(ARGS) == 0
+        assert second.check(ARGS) is None
+        first.close()
+        second.close()
+
+    def test_resized(self, tmpdir):
+        path = str(tmpdir.join('dedup'))
+        first = Deduplicator(60.0, path, slots=8)
+        first.check(ARGS)
+        first.close()
+        second = Deduplicator(60.0, path, slots=16)
+        assert second.check(ARGS) == 0
+        second.close()
+
+    def test_resized_while_mapped(self, tmpdir):
+        path = str(tmpdir.join('dedup'))
+        first = Deduplicator(60.0, path, slots=16)
+        first.check(ARGS)
+        second = Deduplicator(60.0, path, slots=8)
+        # The table mapped by the first is left whole, in a file of its own.
+        assert first.check(dict(ARGS, alert=str(1))) == 0
+        assert first.check(ARGS) is None
+        assert second.check(ARGS) == 0
+        assert os.path.getsize(path) == 8 * second._slot.size
+        assert os.listdir(str(tmpdir)) == ['dedup']
+        first.close()
+        second.close()
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            Deduplicator(0)
+        with pytest.raises(ValueError):
+            Deduplicator(60.0, slots=4)
+
+
+class TestAddRepetitions(object):
+    def test_suffix(self):
+        args = add_repetitions(ARGS, 3)
+        assert args['alert'] == '@all Test Alert\n(repeated 3 times)'
+        assert ARGS['alert'] == '@all Test Alert'
+
+    def test_limit(self):
+        args = add_repetitions(dict(ARGS, alert='x' * 9999), 12)
+        assert len(args['alert']) == 9999
+        assert args['alert'].endswith(' ...\n(repeated 12 times)')
+
+
+class TestAddResolution(object):
+    def test_suffix(self):
+        args = add_resolution(dict(ARGS, color='green'), 42.7)
+        assert args['alert'] == '@all Test Alert\n' \
+            '(resolved after 42s, before the problem was sent)'
+        assert args['color'] == 'green'
+
+
+class TestGetPairKey(object):
+    def test_eventid(self):
+        args = dict(ARGS, eventid='42', triggerid='13')
+        assert get_pair_key(args) == 'eventid:42'
+
+    def test_triggerid(self):
+        assert get_pair_key(dict(ARGS, triggerid='13')) == 'triggerid:13'
+
+    def test_none(self):
+        assert get_pair_key(ARGS) is None
+
+
+class TestJoinDestinations(object):
+    def test_join(self):
+        args = dict(ARGS, rooms=[
+            {'room': '123456', 'auth_token': 'a' * 40},
+            {'room': '654321', 'auth_token': 'b' * 40},
+        ])
+        assert join_destinations(split_destinations(args)) == args
+
+    def test_single(self):
+        assert join_destinations([ARGS]) is ARGS
+
+    def test_differing(self):
+        args = dict(ARGS, rooms=[
+            {'room': '123456', 'auth_token': 'a' * 40},
+            {'room': '654321', 'auth_token': 'b' * 40, 'notify': False},
+        ])
+        alerts = split_destinations(args)
+        assert not alerts[1]['notify']
+        assert join_destinations(alerts) == args
+
+
+class TestMergeAlerts(object):
+    def test_single(self):
+        assert merge_alerts([ARGS]) is ARGS
+
+    def test_digest(self):
+        alerts = [
+            dict(ARGS, color='yellow', notify=False, alert='@all One'),
+            dict(ARGS, color='red', notify=True, alert='Two'),
+            dict(ARGS, color='green', notify=False, alert='Three'),
+            dict(ARGS, color='red', notify=False, alert='Four'),
+        ]
+        digest = merge_alerts(alerts)
+        assert digest['color'] == 'red'
+        assert digest['notify'] is True
+        assert digest['room'] == ARGS['room']
+        assert digest['alert'] == (
+            '@all 4 alerts (red: 2, yellow: 1, green: 1)\n'
+            '- One\n'
+            '- Two\n'
+            '- Three\n'
+            '- Four'
+        )
+
+    def test_nseverity(self):
+        digest = merge_alerts([
+            dict(ARGS, nseverity=3),
+            dict(ARGS, nseverity=5),
+            dict(ARGS, color='green'),
+        ])
+        assert digest['nseverity'] == 5
+
+        digest = merge_alerts([dict(ARGS, nseverity=3), dict(ARGS)])
+        assert digest['nseverity'] == 5
+
+    def test_unpaired(self):
+        digest = merge_alerts([
+            dict(ARGS, eventid='1'),
+            dict(ARGS, eventid='2', triggerid='13'),
+        ])
+        assert 'eventid' not in digest
+        assert 'triggerid' not in digest
+
+    def test_limit(self):
+        alerts = [dict(ARGS, alert='x' * 9000) for _ in range(3)]
+        digest = merge_alerts(alerts)
+        assert len(digest['alert']) < 10000
+        assert digest['alert'].endswith('\n... and 2 more')
+
+        alerts = [dict(ARGS, alert='x' * 10) for _ in range(2000)]
+        digest = merge_alerts(alerts)
+        assert len(digest['alert']) < 10000
+        assert digest['alert'].startswith('@all 2000 alerts (red: 2000)')
+        assert digest['alert'].endswith(' more')
+
+
+class TestCoalescer(object):
+    def test_window(self):
+        delivered = []
+        coalescer = Coalescer(lambda args: delivered.append(args) or [], 0.1)
+        coalescer.add(ARGS)
+        coalescer.add(dict(ARGS, alert='Other'))
+        coalescer.add(dict(ARGS, room='654321'))
+        assert len(coalescer) == 3
+        assert delivered == []
+
+        deadline = time.time() + 5.0
+        while len(delivered) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(coalescer) == 0
+        assert sorted([args['room'] for args in delivered]) == [
+            '123456',
+            '654321',
+        ]
+
+    def test_flush(self):
+        delivered = []
+        coalescer = Coalescer(lambda args: delivered.append(args) or [], 60.0)
+        coalescer.add(ARGS)
+        coalescer.flush()
+        assert delivered == [ARGS]
+        assert len(coalescer) == 0
+
+    def test_cancel(self):
+        delivered = []
+        coalescer = Coalescer(lambda args: delivered.append(args) or [], 60.0)
+        problem = dict(ARGS, eventid='42')
+        recovery = dict(ARGS, eventid='42', color='green')
+        coalescer.add(problem)
+        coalescer.add(dict(ARGS, eventid='43'))
+
+        assert coalescer.cancel(dict(recovery, room='654321')) is None
+        assert coalescer.cancel(recovery) <= time.time()
+        assert coalescer.cancel(recovery) is None
+        assert len(coalescer) == 1
+
+        coalescer.flush()
+        assert [args['eventid'] for args in delivered] == ['43']
+
+    def test_cancel_last(self):
+        delivered = []
+        coalescer = Coalescer(lambda args: delivered.append(args) or [], 60.0)
+        coalescer.add(dict(ARGS, triggerid='13'))
+
+        assert coalescer.cancel(dict(ARGS, triggerid='13', color='green'))
+        assert len(coalescer) == 0
+        coalescer.flush()
+        assert delivered == []
+
+
+class TestMetrics(object):
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.observe('response', 0.02)
+        metrics.observe('response', 20.0)
+        metrics.count({'room': 'a "b"', 'status': 204, 'error': None})
+        metrics.count({'room': '1', 'status': None, 'error': 'x'})
+        metrics.count({'room': '1', 'status': 503, 'error': 'x',
+                       'queued': True})
+        metrics.count({'room': '1', 'status': None, 'error': None,
+                       'suppressed': True})
+        metrics.track_queue('outbox', lambda: 3)
+
+        lines = metrics.format_prometheus().splitlines()
+        prefix = 'zabbix_media_hipchat_'
+        assert prefix + \
+            'phase_seconds_bucket{phase="response",le="0.01"} 0' in lines
+        assert prefix + \
+            'phase_seconds_bucket{phase="response",le="0.025"} 1' in lines
+        assert prefix + \
+            'phase_seconds_bucket{phase="response",le="+Inf"} 2' in lines
+        assert prefix + 'phase_seconds_count{phase="response"} 2' in lines
+        assert prefix + 'deliveries_total{room="a \\"b\\"",status="204",' \
+            'outcome="success"} 1' in lines
+        assert prefix + 'deliveries_total{room="1",status="none",' \
+            'outcome="failure"} 1' in lines
+        assert prefix + 'deliveries_total{room="1",status="503",' \
+            'outcome="queued"} 1' in lines
+        assert prefix + 'deliveries_total{room="1",status="none",' \
+            'outcome="suppressed"} 1' in lines
+        assert prefix + 'queue_depth{queue="outbox"} 3' in lines
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5.0)
+
+        metrics = Metrics(server.getsockname())
+        metrics.observe('dns', 0.0015)
+        metrics.count({'room': 'Ops Room', 'status': 204, 'error': None})
+        metrics.track_queue('coalescer', lambda: 0)
+        metrics.push()
+
+        packet = server.recvfrom(512)[0].decode('utf-8')
+        server.close()
+        assert packet.split('\n') == [
+            'zabbix_media_hipchat.phase.dns:1.500|ms',
+            'zabbix_media_hipchat.deliveries.success.204.Ops_Room:1|c',
+            'zabbix_media_hipchat.queue.coalescer:0|g',
+        ]
+        assert metrics.pop_statsd() == [
+            'zabbix_media_hipchat.queue.coalescer:0|g',
+        ]
+
+    def test_not_kept_without_statsd(self):
+        metrics = Metrics()
+        metrics.observe('dns', 0.001)
+        assert metrics.pop_statsd() == []
+
+    def test_dispatcher(self, tmpdir):
+        metrics = Metrics()
+        outbox = Outbox(str(tmpdir.join('spool.db')))
+        error = HTTPError('url', 503, 'Unavailable', {}, None)
+        dispatcher = Dispatcher(
+            StubOpenerDirector(error),
+            outbox=outbox,
+            metrics=metrics,
+        )
+        dispatcher.deliver(ARGS)
+
+        assert metrics._counters == {('123456', '503', 'queued'): 1}
+        assert metrics._histograms['request']['count'] == 1
+        assert 'queue_depth{queue="outbox"} 1' in metrics.format_prometheus()
+        dispatcher.close()
+
+    def test_serve(self):
+        metrics = Metrics()
+        metrics.observe('parse', 0.001)
+        server = serve_metrics(('127.0.0.1', 0), metrics)
+        try:
+            connection = socket.create_connection(server.server_address)
+            connection.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                response += data
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert response.startswith(b'HTTP/1.0 200')
+        assert b'phase_seconds_count{phase="parse"} 1' in response
+
+
+class ListTracer(Tracer):
+    def __init__(self, trace_id=None):
+        Tracer.__init__(self, trace_id)
+        self.exported = []
+
+    def export(self, spans):
+        self.exported.append(spans)
+
+
+@pytest.fixture
+def tracer():
+    tracer = ListTracer()
+    set_tracer(tracer)
+    yield tracer
+    set_tracer(None)
+
+
+class TestTrace(object):
+    def test_not_tracing(self):
+        with trace('stage') as span:
+            span.set_attribute('key', 'value')
+            span.set_error('error')
+
+    def test_nesting(self, tracer):
+        with trace('root', {'zabbix.event_id': '42'}):
+            with trace('child'):
+                pass
+        [[child, root]] = tracer.exported
+        assert root.parent_id is None
+        assert child.parent_id == root.span_id
+        assert child.trace_id == root.trace_id
+        assert root.attributes == {'zabbix.event_id': '42'}
+
+    def test_exception(self, tracer):
+        with pytest.raises(ValueError):
+            with trace('root'):
+                raise ValueError('malformed')
+        [[root]] = tracer.exported
+        assert root.error == 'ValueError: malformed'
+
+    def test_deliver_all(self, tracer):
+        args = dict(ARGS, eventid='42', rooms=[
+            {'room': '123456', 'auth_token': 'a' * 40},
+            {'room': '654321', 'auth_token': 'b' * 40},
+        ])
+        error = HTTPError('url', 404, 'Not Found', {}, None)
+        deliver_all(args, StubOpenerDirector(error), API_ENDPOINT_ROOM)
+
+        [spans] = tracer.exported
+        names = sorted([span.name for span in spans])
+        assert names == ['deliver', 'get_request', 'open', 'open']
+        root = spans[-1]
+        assert root.name == 'deliver'
+        assert root.attributes == {
+            'hipchat.rooms': 2,
+            'zabbix.event_id': '42',
+        }
+        for span in spans[:-1]:
+            assert span.parent_id == root.span_id
+        opens = [span for span in spans if span.name == 'open']
+        assert opens[0].attributes['http.status_code'] == 404
+        assert opens[0].error
+
+    def test_get_options_and_arguments(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join('spans.json'))
+        monkeypatch.setattr(
+            sys,
+            'argv',
+            ['zabbix_media_hipchat.py', '--trace', path,
+             'room=1,auth_token=' + 'a' * 40, 'nseverity=1,eventid=42',
+             'Alert'],
+        )
+        try:
+            (_, args) = get_options_and_arguments()
+            assert args['eventid'] == '42'
+            deliver(args, StubOpenerDirector(), API_ENDPOINT_ROOM)
+        finally:
+            set_tracer(None)
+
+        [first, second] = [json.loads(line) for line in open(path)]
+        first = first['resourceSpans'][0]['scopeSpans'][0]['spans']
+        second = second['resourceSpans'][0]['scopeSpans'][0]['spans']
+        assert [span['name'] for span in first] == [
+            'parse_destination',
+            'parse_metadata',
+            'parse_alert',
+            'get_arguments',
+        ]
+        assert first[-1]['attributes'] == [
+            {'key': 'zabbix.event_id', 'value': {'stringValue': '42'}},
+        ]
+        assert second[-1]['name'] == 'deliver'
+        assert second[-1]['traceId'] == first[-1]['traceId']
+
+
+class TestOTLPTracer(object):
+    def test_format_span(self):
+        tracer = OTLPTracer('unused', trace_id='1' * 32)
+        span = tracer.span('open', {'http.status_code': 204, 'ok': True,
+                                    'room': 'Ops', 'ratio': 0.5},
+                           start=1.5, kind='client')
+        span.end = 2.0
+        span.set_error('failed')
+        formatted = tracer.format_span(span)
+
+        assert formatted['traceId'] == '1' * 32
+        assert len(formatted['spanId']) == 16
+        assert 'parentSpanId' not in formatted
+        assert formatted['kind'] == 3
+        assert formatted['startTimeUnixNano'] == '1500000000'
+        assert formatted['endTimeUnixNano'] == '2000000000'
+        assert formatted['status'] == {'code': 2, 'message': 'failed'}
+        assert formatted['attributes'] == [
+            {'key': 'http.status_code', 'value': {'intValue': '204'}},
+            {'key': 'ok', 'value': {'boolValue': True}},
+            {'key': 'ratio', 'value': {'doubleValue': 0.5}},
+            {'key': 'room', 'value': {'stringValue': 'Ops'}},
+        ]
+
+    def test_collector(self, stub_hipchat):
+        tracer = OTLPTracer(stub_hipchat.endpoint % 'traces')
+        set_tracer(tracer)
+        try:
+            with trace('root'):
+                pass
+        finally:
+            set_tracer(None)
+
+        [body] = stub_hipchat.bodies
+        spans = json.loads(body.decode('utf-8'))
+        spans = spans['resourceSpans'][0]['scopeSpans'][0]['spans']
+        assert spans[0]['name'] == 'root'
+
+
+class TestParseAddress(object):
+    def test_port(self):
+        assert parse_address('8125') == ('127.0.0.1', 8125)
+
+    def test_host_and_port(self):
+        assert parse_address('statsd:8125') == ('statsd', 8125)
+
+    def test_malformed(self):
+        with pytest.raises(ValueError):
+            parse_address('statsd')
+
+
+class TestRateLimiter(object):
+    def test_bucket(self):
+        limiter = RateLimiter(2, 10.0)
+        assert limiter.acquire('a') == 0
+        assert limiter.acquire('a') == 0
+        assert 4.9 < limiter.acquire('a') <= 5.0
+        assert 9.9 < limiter.acquire('a') <= 10.0
+
+    def test_per_auth_token(self):
+        limiter = RateLimiter(1, 10.0)
+        assert limiter.acquire('a') == 0
+        assert limiter.acquire('b') == 0
+
+    def test_max_wait(self):
+        limiter = RateLimiter(1, 10.0)
+        assert limiter.acquire('a') == 0
+        assert limiter.acquire('a', max_wait=1.0) > 1.0
+        assert 9.9 < limiter.acquire('a') <= 10.0
+
+    def test_calibrate_remaining(self):
+        limiter = RateLimiter(100, 300.0)
+        limiter.calibrate('a', {'X-Ratelimit-Remaining': '1'})
+        assert limiter.acquire('a') == 0
+        assert limiter.acquire('a') > 0
+
+    def test_calibrate_reset(self):
+        limiter = RateLimiter(100, 300.0)
+        limiter.calibrate('a', {
+            'X-Ratelimit-Remaining': '0',
+            'X-Ratelimit-Reset': str(time.time() + 30),
+        })
+        assert 29 < limiter.acquire('a') <= 33
+
+    def test_calibrate_without_headers(self):
+        limiter = RateLimiter(1, 10.0)
+        limiter.calibrate('a', {})
+        assert limiter.acquire('a') == 0
+
+    def test_shared_state(self, tmpdir):
+        path = str(tmpdir.join('ratelimit.json'))
+        assert RateLimiter(1, 10.0, path).acquire('secret') == 0
+        assert RateLimiter(1, 10.0, path).acquire('secret') > 9.9
+        assert 'secret' not in tmpdir.join('ratelimit.json').read()
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            RateLimiter(0, 10.0)
+
+
+class TestCircuitBreaker(object):
+    @pytest.fixture
+    def now(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        return now
+
+    def test_open(self, now):
+        breaker = CircuitBreaker(2, 60.0)
+        assert breaker.allow('host', 5.0) == 0
+        breaker.record('host', False)
+        assert breaker.allow('host', 5.0) == 0
+        breaker.record('host', False)
+        assert breaker.allow('host', 5.0) == 60.0
+        assert breaker.allow('other', 5.0) == 0
+
+    def test_success_resets(self, now):
+        breaker = CircuitBreaker(2, 60.0)
+        breaker.record('host', False)
+        breaker.record('host', True)
+        breaker.record('host', False)
+        assert breaker.allow('host', 5.0) == 0
+
+    def test_half_open(self, now):
+        breaker = CircuitBreaker(1, 60.0)
+        breaker.record('host', False)
+
+        now[0] += 60.0
+        assert breaker.allow('host', 5.0) == 0
+        assert breaker.allow('host', 5.0) == 5.0
+
+        breaker.record('host', True)
+        assert breaker.allow('host', 5.0) == 0
+        assert breaker.allow('host', 5.0) == 0
+
+    def test_probe_failed(self, now):
+        breaker = CircuitBreaker(3, 60.0)
+        for _ in range(3):
+            breaker.record('host', False)
+
+        now[0] += 60.0
+        assert breaker.allow('host', 5.0) == 0
+        breaker.record('host', False)
+        assert breaker.allow('host', 5.0) == 60.0
+
+    def test_probe_timed_out(self, now):
+        breaker = CircuitBreaker(1, 60.0)
+        breaker.record('host', False)
+
+        now[0] += 60.0
+        assert breaker.allow('host', 5.0) == 0
+        now[0] += 5.0
+        assert breaker.allow('host', 5.0) == 0
+
+    def test_shared_state(self, tmpdir):
+        path = str(tmpdir.join('breaker.json'))
+        CircuitBreaker(1, 60.0, path).record('host', False)
+        assert CircuitBreaker(1, 60.0, path).allow('host', 5.0) > 59.0
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            CircuitBreaker(0, 60.0)
+        with pytest.raises(ValueError):
+            CircuitBreaker(1, 0)
+
+
+class TestCircuitBreakerOpener(object):
+    def test_fail_fast(self):
+        opener_director = StubOpenerDirector(URLError('unreachable'))
+        opener = CircuitBreakerOpener(
+            opener_director,
+            CircuitBreaker(2, 60.0),
+        )
+        request = get_request(ARGS, API_ENDPOINT_ROOM)
+
+        for _ in range(3):
+            with pytest.raises(URLError):
+                opener.open(request)
+
+        assert len(opener_director.requests) == 2
+        breaker = opener.breaker
+        assert breaker.allow('api.hipchat.com', 5.0) > 59.0
+
+    def test_errors(self):
+        breaker = CircuitBreaker(1, 60.0)
+        request = get_request(ARGS, API_ENDPOINT_ROOM)
+
+        for status in (401, 429):
+            error = HTTPError('url', status, 'Error', {}, None)
+            opener = CircuitBreakerOpener(StubOpenerDirector(error), breaker)
+            with pytest.raises(HTTPError):
+                opener.open(request)
+            assert breaker.allow('api.hipchat.com', 5.0) == 0
+
+        error = HTTPError('url', 502, 'Bad Gateway', {}, None)
+        opener = CircuitBreakerOpener(StubOpenerDirector(error), breaker)
+        with pytest.raises(HTTPError):
+            opener.open(request)
+        assert breaker.allow('api.hipchat.com', 5.0) > 0
+
+    def test_spooled(self, tmpdir):
+        outbox = Outbox(str(tmpdir.join('spool.db')))
+        opener_director = StubOpenerDirector(URLError('unreachable'))
+        opener = CircuitBreakerOpener(
+            opener_director,
+            CircuitBreaker(1, 60.0),
+        )
+        dispatcher = Dispatcher(opener, outbox=outbox)
+
+        dispatcher.deliver(ARGS)
+        [result] = dispatcher.deliver(ARGS)
+        dispatcher.close()
+
+        assert result['queued']
+        assert result['error'].startswith('<urlopen error Circuit open')
+        assert len(opener_director.requests) == 1
+
+
+class StubRoomsOpenerDirector(StubOpenerDirector):
+    def __init__(self, rooms, status=None):
+        StubOpenerDirector.__init__(self)
+        self.rooms = rooms
+        self.status = status
+        self.lookups = []
+
+    def open(self, request):
+        if request.get_method() == 'POST':
+            return StubOpenerDirector.open(self, request)
+
+        self.lookups.append(request.get_full_url())
+        if self.status is not None:
+            raise HTTPError('url', self.status, 'Error', {}, None)
+        name = request.get_full_url().rpartition('/')[2]
+        if name not in self.rooms:
+            raise HTTPError('url', 404, 'Not Found', {}, None)
+        return io.BytesIO(
+            json.dumps({'id': self.rooms[name]}).encode('utf-8'),
+        )
+
+
+class TestQuoteRoom(object):
+    def test_id(self):
+        assert quote_room('123456') == '123456'
+
+    def test_name(self):
+        assert quote_room('a b/c%d') == 'a%20b%2Fc%25d'
+
+    def test_non_ascii_digits(self):
+        assert quote_room(u'\u0661\u0662') == '%D9%A1%D9%A2'
+
+
+class TestRoomCache(object):
+    def test_resolve(self):
+        opener_director = StubRoomsOpenerDirector({'Ops%20Room': 42})
+        cache = RoomCache(60.0)
+
+        for _ in range(2):
+            room_id = cache.resolve(
+                'Ops Room',
+                'a',
+                opener_director,
+                API_ENDPOINT_ROOM,
+            )
+            assert room_id == '42'
+
+        assert opener_director.lookups == [
+            'https://api.hipchat.com/v2/room/Ops%20Room',
+        ]
+
+    def test_id(self):
+        opener_director = StubRoomsOpenerDirector({})
+        cache = RoomCache(60.0)
+        room_id = cache.resolve('123', 'a', opener_director, API_ENDPOINT_ROOM)
+        assert room_id == '123'
+        assert opener_director.lookups == []
+
+    def test_unknown(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        opener_director = StubRoomsOpenerDirector({})
+        cache = RoomCache(3600.0, negative_ttl=60.0)
+
+        for _ in range(2):
+            assert cache.resolve(
+                'Nope',
+                'a',
+                opener_director,
+                API_ENDPOINT_ROOM,
+            ) is None
+        assert len(opener_director.lookups) == 1
+
+        now[0] += 61.0
+        cache.resolve('Nope', 'a', opener_director, API_ENDPOINT_ROOM)
+        assert len(opener_director.lookups) == 2
+
+    def test_not_allowed(self):
+        opener_director = StubRoomsOpenerDirector({}, status=403)
+        cache = RoomCache(60.0)
+
+        for _ in range(2):
+            assert cache.resolve(
+                'Ops',
+                'a',
+                opener_director,
+                API_ENDPOINT_ROOM,
+            ) == 'Ops'
+        assert len(opener_director.lookups) == 1
+
+    def test_failure_not_cached(self):
+        opener_director = StubRoomsOpenerDirector({}, status=503)
+        cache = RoomCache(60.0)
+
+        for _ in range(2):
+            assert cache.resolve(
+                'Ops',
+                'a',
+                opener_director,
+                API_ENDPOINT_ROOM,
+            ) == 'Ops'
+        assert len(opener_director.lookups) == 2
+
+    def test_per_auth_token(self):
+        opener_director = StubRoomsOpenerDirector({'Ops': 42})
+        cache = RoomCache(60.0)
+        cache.resolve('Ops', 'a', opener_director, API_ENDPOINT_ROOM)
+        cache.resolve('Ops', 'b', opener_director, API_ENDPOINT_ROOM)
+        assert len(opener_director.lookups) == 2
+
+    def test_shared_state(self, tmpdir):
+        path = str(tmpdir.join('rooms.json'))
+        opener_director = StubRoomsOpenerDirector({'Ops': 42})
+
+        RoomCache(60.0, path).resolve(
+            'Ops',
+            'secret',
+            opener_director,
+            API_ENDPOINT_ROOM,
+        )
+        room_id = RoomCache(60.0, path).resolve(
+            'Ops',
+            'secret',
+            opener_director,
+            API_ENDPOINT_ROOM,
+        )
+
+        assert room_id == '42'
+        assert len(opener_director.lookups) == 1
+        assert 'secret' not in tmpdir.join('rooms.json').read()
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            RoomCache(0)
+
+
+class TestUpdateStateFile(object):
+    def test_update(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+
+        def count(state):
+            state['count'] = state.get('count', 0) + 1
+            return state['count']
+
+        assert update_state_file(path, count) == 1
+        assert update_state_file(path, count) == 2
+        assert update_state_file(path, count, write=False) == 3
+        assert json.loads(open(path).read()) == {'count': 2}
+
+    def test_prune(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        update_state_file(
+            path,
+            lambda state: state.update({'a': 1, 'b': 2}),
+            prune=lambda state: state.pop('a'),
+        )
+        assert json.loads(open(path).read()) == {'b': 2}
+
+    @pytest.mark.parametrize('content', ['{"a": ', '[1, 2]', 'null'])
+    def test_corrupt(self, tmpdir, content):
+        state_file = tmpdir.join('state.json')
+        state_file.write(content)
+        assert update_state_file(str(state_file), dict) == {}
+
+
+class TestDNSCache(object):
+    @pytest.fixture
+    def getaddrinfo(self, monkeypatch):
+        calls = []
+
+        def getaddrinfo(host, port, *args):
+            calls.append((host, port))
+            return [(
+                socket.AF_INET,
+                socket.SOCK_STREAM,
+                6,
+                '',
+                ('192.0.2.1', port),
+            )]
+
+        monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+        return calls
+
+    def test_cache(self, getaddrinfo):
+        cache = DNSCache(60.0)
+        for _ in range(2):
+            address = cache.resolve('api.hipchat.com', 443)[0][4]
+            assert tuple(address) == ('192.0.2.1', 443)
+        assert getaddrinfo == [('api.hipchat.com', 443)]
+
+        cache.resolve('api.hipchat.com', 80)
+        assert len(getaddrinfo) == 2
+
+    def test_expiry(self, getaddrinfo):
+        cache = DNSCache(0.05)
+        cache.resolve('api.hipchat.com', 443)
+        time.sleep(0.1)
+        cache.resolve('api.hipchat.com', 443)
+        assert len(getaddrinfo) == 2
+
+    def test_forget(self, getaddrinfo):
+        cache = DNSCache(60.0)
+        cache.resolve('api.hipchat.com', 443)
+        cache.forget('api.hipchat.com', 443)
+        cache.resolve('api.hipchat.com', 443)
+        assert len(getaddrinfo) == 2
+
+    def test_shared_state(self, tmpdir, getaddrinfo):
+        path = str(tmpdir.join('dns.json'))
+        DNSCache(60.0, path).resolve('api.hipchat.com', 443)
+        address = DNSCache(60.0, path).resolve('api.hipchat.com', 443)[0][4]
+        assert tuple(address) == ('192.0.2.1', 443)
+        assert len(getaddrinfo) == 1
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            DNSCache(0)
+
+
+class TestTLSSessionContext(object):
+    class StubContext(object):
+        check_hostname = True
+
+        def wrap_socket(self, sock, **kwargs):
+            return (sock, kwargs)
+
+    def test_wrap_socket(self):
+        context = TLSSessionContext(self.StubContext(), 'session')
+        assert context.check_hostname
+        assert context.wrap_socket('sock', server_hostname='a') == (
+            'sock',
+            {'server_hostname': 'a', 'session': 'session'},
+        )
+
+
+class TestRouter(object):
+    RULES = {'rules': [
+        {'severities': [0, 1], 'action': 'drop'},
+        {'status': 'OK', 'action': 'silent'},
+        {'rooms': ['ops'], 'severities': [5], 'escalate': ['oncall|b']},
+        {'rooms': ['ops'], 'action': 'silent'},
+    ]}
+
+    def route(self, destination, metadata):
+        args = {}
+        args.update(parse_destination(destination))
+        args.update(parse_metadata(metadata))
+        args.update(parse_alert('Alert'))
+        return Router(compile_routes(self.RULES)).route(args, metadata)
+
+    def test_lookup(self):
+        router = Router(compile_routes(self.RULES))
+        assert router.lookup('ops', 5, False) == ('page', ('oncall|b',))
+        assert router.lookup('ops', 3, False) == ('silent', ())
+        assert router.lookup('ops', None, True) == ('silent', ())
+        assert router.lookup('dev', 0, False) == ('drop', ())
+        assert router.lookup('dev', None, False) == ('page', ())
+
+    def test_page(self):
+        args = self.route('room=dev,auth_token=a', 'nseverity=4')
+        assert args['alert'] == '@all Alert'
+        assert args['notify']
+        assert 'rooms' not in args
+
+    def test_silent(self):
+        args = self.route('room=dev,auth_token=a', 'status=OK,nseverity=4')
+        assert args['alert'] == 'Alert'
+        assert not args['notify']
+
+    def test_drop(self):
+        args = self.route('room=dev,auth_token=a', 'nseverity=1')
+        assert args['dropped']
+
+    def test_escalate(self):
+        args = self.route('room=ops,room=dev,auth_token=a', 'nseverity=5')
+        for room_args in split_destinations(args):
+            assert room_args['alert'] == '@all Alert'
+            assert room_args['notify']
+        assert get_destinations(args) == [
+            {'room': 'ops', 'auth_token': 'a'},
+            {'room': 'dev', 'auth_token': 'a'},
+            {'room': 'oncall', 'auth_token': 'b'},
+        ]
+
+    def test_escalate_already_sent_to(self):
+        args = self.route('room=ops,room=oncall,auth_token=a', 'nseverity=5')
+        assert [d['room'] for d in get_destinations(args)] == [
+            'ops',
+            'oncall',
+        ]
+
+    def test_mixed(self):
+        args = self.route('room=ops,room=dev,auth_token=a', 'nseverity=3')
+        [ops, dev] = split_destinations(args)
+        assert (ops['alert'], ops['notify']) == ('Alert', False)
+        assert (dev['alert'], dev['notify']) == ('@all Alert', True)
+
+    @pytest.mark.parametrize('config', [
+        [],
+        {'rules': {}},
+        {'rules': ['drop']},
+        {'rules': [{'action': 'shout'}]},
+        {'rules': [{'severities': [6]}]},
+        {'rules': [{'room': ['ops']}]},
+        {'rules': [{'rooms': 'ops'}]},
+        {'rules': [{'rooms': 5}]},
+        {'rules': [{'rooms': [['ops']]}]},
+        {'rules': [{'rooms': ['x' * 101]}]},
+        {'rules': [{'severities': '45'}]},
+        {'rules': [{'severities': 5}]},
+        {'rules': [{'severities': [True]}]},
+        {'rules': [{'severities': [[5]]}]},
+        {'rules': [{'escalate': 'oncall'}]},
+        {'rules': [{'escalate': [5]}]},
+        {'rules': [{'escalate': ['|b']}]},
+        {'rules': [{'escalate': ['x' * 101 + '|b']}]},
+    ])
+    def test_malformed(self, config):
+        with pytest.raises(ValueError):
+            compile_routes(config)
+
+    def test_escalate_normalized(self):
+        table = compile_routes({
+            'rules': [{'rooms': [123], 'escalate': [' oncall | b ', 'ops']}],
+        })
+        assert table[('123', None, False)] == ('page', ('oncall|b', 'ops'))
+
+
+class TestLoadRouter(object):
+    def test_cache(self, tmpdir, monkeypatch):
+        config = tmpdir.join('routing.json')
+        config.write(json.dumps({'rules': [{'action': 'drop'}]}))
+
+        assert load_router(str(config)).lookup('1', 5, False)[0] == 'drop'
+        assert tmpdir.join('routing.json.cache').check()
+
+        def fail(*args):
+            raise AssertionError
+
+        monkeypatch.setattr(zabbix_media_hipchat, 'compile_routes', fail)
+        assert load_router(str(config)).lookup('1', 5, False)[0] == 'drop'
+
+    def test_changed(self, tmpdir):
+        config = tmpdir.join('routing.json')
+        config.write(json.dumps({'rules': [{'action': 'drop'}]}))
+        load_router(str(config))
+
+        config.write(json.dumps({'rules': [{'action': 'silent'}]}))
+        os.utime(str(config), (0, 0))
+        assert load_router(str(config)).lookup('1', 5, False)[0] == 'silent'
+
+    def test_malformed(self, tmpdir):
+        config = tmpdir.join('routing.json')
+        config.write('{')
+        with pytest.raises(ValueError):
+            load_router(str(config))
+
+
+class TestRateLimitedOpener(object):
+    def test_open(self):
+        opener_director = StubOpenerDirector()
+        opener = RateLimitedOpener(opener_director, RateLimiter(10, 1.0))
+        request = get_request(ARGS, API_ENDPOINT_ROOM)
+        assert opener.open(request).getcode() == 204
+
+    def test_too_long_wait(self):
+        opener_director = StubOpenerDirector()
+        limiter = RateLimiter(1, 60.0)
+        opener = RateLimitedOpener(opener_director, limiter, max_wait=1.0)
+        request = get_request(ARGS, API_ENDPOINT_ROOM)
+
+        opener.open(request)
+        with pytest.raises(URLError):
+            opener.open(request)
+        assert len(opener_director.requests) == 1
+
+    def test_calibrate_from_error(self):
+        error = HTTPError('url', 429, 'Too Many', {
+            'X-Ratelimit-Remaining': '0',
+            'X-Ratelimit-Reset': str(time.time() + 60),
+        }, None)
+        limiter = RateLimiter(100, 300.0)
+        opener = RateLimitedOpener(StubOpenerDirector(error), limiter)
+
+        with pytest.raises(HTTPError):
+            opener.open(get_request(ARGS, API_ENDPOINT_ROOM))
+        assert limiter.acquire('a' * 40) > 59
+
+
+class TestParseRecord(object):
+    def test_json(self):
+        test_input = json.dumps({
+            'destination': 'room=123456,auth_token=' + 'a' * 40,
+            'metadata': 'status=PROBLEM,nseverity=5,notify=true',
+            'alert': 'Test Alert',
+        })
+        assert parse_record(test_input) == dict(ARGS, nseverity=5)
+
+    def test_json_missing_key(self):
+        test_input = json.dumps({'destination': 'room=1,auth_token=a'})
+        with pytest.raises(KeyError):
+            parse_record(test_input)
+
+    def test_json_not_string(self):
+        test_input = json.dumps({
+            'destination': 5,
+            'metadata': None,
+            'alert': 'Test Alert',
+        })
+        with pytest.raises(ValueError):
+            parse_record(test_input)
+
+    def test_json_not_object(self):
+        with pytest.raises(ValueError):
+            parse_record('{')
+
+    def test_tsv(self):
+        test_input = '\t'.join([
+            'room=123456,auth_token=' + 'a' * 40,
+            'status=PROBLEM,nseverity=5,notify=true',
+            'Test Alert',
+        ])
+        assert parse_record(test_input) == dict(ARGS, nseverity=5)
+
+    def test_tsv_escapes(self):
+        test_input = 'room=1,auth_token=a\t\tTest\\tAlert\\n\\\\n\\x'
+        result = parse_record(test_input)
+        assert result['alert'] == '@all Test\tAlert\n\\n\\x'
+
+    def test_tsv_wrong_number_of_fields(self):
+        with pytest.raises(ValueError):
+            parse_record('room=1,auth_token=a\t')
+
+
+class TestBulkDeliver(object):
+    def test_results(self):
+        stream = [
+            'room=1,auth_token=a\t\tfirst\n',
+            '\n',
+            'malformed\n',
+            '{"destination": 5, "metadata": null, "alert": "x"}\n',
+            json.dumps({
+                'destination': 'room=2,auth_token=a',
+                'metadata': '',
+                'alert': 'second',
+            }) + '\n',
+        ]
+        output = io.StringIO()
+        opener_director = StubOpenerDirector()
+
+        exit_status = bulk_deliver(
+            stream,
+            Dispatcher(opener_director, API_ENDPOINT_ROOM),
+            output,
+        )
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert exit_status == 2
+        assert [r['record'] for r in results] == [1, 3, 4, 5]
+        assert [r['exit'] for r in results] == [0, 2, 2, 0]
+        assert [r['room'] for r in results] == ['1', None, None, '2']
+        assert len(opener_director.requests) == 2
+
+    def test_delivery_failure(self):
+        output = io.StringIO()
+        opener_director = StubOpenerDirector(URLError('unreachable'))
+
+        exit_status = bulk_deliver(
+            ['room=1,auth_token=a\t\tfirst'],
+            Dispatcher(opener_director, API_ENDPOINT_ROOM),
+            output,
+        )
+
+        assert exit_status == 1
+        assert json.loads(output.getvalue())['exit'] == 1
+
+    def test_empty(self):
+        output = io.StringIO()
+        assert bulk_deliver([], Dispatcher(None), output) == 0
+        assert output.getvalue() == ''
+
+
+class TestRedactDestination(object):
+    def test_auth_token(self):
+        redacted = redact_destination('room=1,auth_token=secret')
+        args = parse_destination(redacted)
+        assert args['room'] == '1'
+        assert args['auth_token'] != 'secret'
+        assert len(args['auth_token']) == 16
+        assert redacted == redact_destination('room=1,auth_token=secret')
+
+    def test_room_tokens(self):
+        args = parse_destination(redact_destination(
+            'room=a\\,b|one,room=2|two,room=3,auth_token=one',
+        ))
+        assert [room['room'] for room in args['rooms']] == ['a,b', '2', '3']
+        tokens = [room['auth_token'] for room in args['rooms']]
+        assert tokens[0] == tokens[2] != tokens[1]
+        assert 'one' not in tokens and 'two' not in tokens
+
+    def test_quoting(self):
+        redacted = redact_destination('room="x=\\"y\\"",auth_token=a')
+        assert parse_destination(redacted)['room'] == 'x="y"'
+
+    def test_malformed(self):
+        assert redact_destination('room') == ''
+
+
+class TestRecordAlert(object):
+    def test_bulk_input(self, tmpdir):
+        recording = tmpdir.join('recording.jsonl')
+        record_alert(str(recording), 'room=1,auth_token=a', '', 'first', 1.5)
+        record_alert(str(recording), 'room=2,auth_token=a', '', 'second')
+
+        lines = recording.readlines()
+        assert len(lines) == 2
+        assert json.loads(lines[0])['time'] == 1.5
+        assert parse_record(lines[1].rstrip('\n'))['alert'] == '@all second'
+        assert oct(os.stat(str(recording)).st_mode & 0o777)[-3:] == '600'
+
+
 class TestGetRequest(object):
     @classmethod
     def setup_class(cls):
@@ -104,6 +2758,21 @@ class TestGetRequest(object):
             'https://api.hipchat.com/v2/room/123456/notification'
         )
 
+    def test_url_room_name(self):
+        args = dict(self.args, room=u'Ops / \u00e9quipe?')
+        result = get_request(args, self.endpoint)
+        assert result.get_full_url() == (
+            'https://api.hipchat.com/v2/room/'
+            'Ops%20%2F%20%C3%A9quipe%3F/notification'
+        )
+
+    def test_url_room_id(self):
+        args = dict(self.args, room='Ops', room_id='42')
+        result = get_request(args, self.endpoint)
+        assert result.get_full_url() == (
+            'https://api.hipchat.com/v2/room/42/notification'
+        )
+
     def test_header_authorization(self):
         result = get_request(self.args, self.endpoint)
         assert result.get_header('Authorization') == 'Bearer %s' % ('a' * 40)
@@ -113,6 +2782,120 @@ class TestGetRequest(object):
         assert result.get_header('Content-type') == 'application/json'
 
 
+class TestPayloadEncoder(object):
+    # Characters JSON escapes, or which are encoded as more than one byte.
+    ALPHABET = (
+        [unichr(code) for code in range(0x20)] +
+        [u'"', u'\\', u'/', u'\x7f', u'\xe9', u'\u2028', u'\u20ac',
+         u'\ud83d', u'\ude00', u'\U0001f600'] +
+        list(u'abc @%s{}:,')
+    )
+
+    def test_same_as_json(self):
+        encoder = PayloadEncoder()
+        generator = random.Random(0)
+        colors = ['gray', 'purple', 'yellow', 'red', 'green', 'blue']
+
+        for _ in range(1000):
+            args = {
+                'color': generator.choice(colors),
+                'notify': generator.choice([True, False]),
+                'alert': u''.join(
+                    generator.choice(self.ALPHABET)
+                    for _ in range(generator.randint(0, 50))
+                ),
+            }
+            assert encoder.encode(args) == dump_body(args)
+
+    def test_not_bool_notify(self):
+        encoder = PayloadEncoder()
+        args = {'color': 'red', 'notify': 1, 'alert': 'Alert'}
+        assert encoder.encode(args) == dump_body(args)
+        args['notify'] = True
+        assert encoder.encode(args) == dump_body(args)
+
+    def test_uncommon_color(self):
+        encoder = PayloadEncoder()
+        args = {'color': 'blue', 'notify': True, 'alert': 'Alert'}
+        assert encoder.encode(args) == dump_body(args)
+        assert not encoder._templates
+
+
+class TestGetRequests(object):
+    def test_single_room(self):
+        [(room, request)] = get_requests(ARGS, API_ENDPOINT_ROOM)
+        assert room == '123456'
+        assert request.get_full_url() == API_ENDPOINT_ROOM % '123456'
+
+    def test_rooms(self):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2|b,auth_token=a'))
+
+        [(room_1, request_1), (room_2, request_2)] = get_requests(
+            args,
+            API_ENDPOINT_ROOM,
+        )
+
+        assert (room_1, room_2) == ('1', '2')
+        assert request_1.get_full_url() == API_ENDPOINT_ROOM % '1'
+        assert request_2.get_full_url() == API_ENDPOINT_ROOM % '2'
+        assert request_1.get_header('Authorization') == 'Bearer a'
+        assert request_2.get_header('Authorization') == 'Bearer b'
+        assert request_1.get_data() is request_2.get_data()
+
+    def test_rooms_with_own_message(self):
+        args = dict(ARGS)
+        args.update(parse_destination('room=1,room=2,room=3,auth_token=a'))
+        args['rooms'][1]['notify'] = False
+
+        requests = [r for (_, r) in get_requests(args, API_ENDPOINT_ROOM)]
+
+        assert json.loads(requests[0].get_data().decode('utf-8'))['notify']
+        assert not json.loads(
+            requests[1].get_data().decode('utf-8'),
+        )['notify']
+        assert requests[0].get_data() is requests[2].get_data()
+
+
+class TestGetDestinations(object):
+    def test_single_room(self):
+        assert get_destinations(ARGS) == [
+            {'room': '123456', 'auth_token': 'a' * 40},
+        ]
+
+    def test_rooms(self):
+        args = parse_destination('room=1,room=2,auth_token=a')
+        assert get_destinations(args) == [
+            {'room': '1', 'auth_token': 'a'},
+            {'room': '2', 'auth_token': 'a'},
+        ]
+
+
+class TestReadAlert(object):
+    class EndlessStream(object):
+        def __init__(self, length):
+            self.length = length
+            self.largest = 0
+
+        def read(self, size):
+            self.largest = max(self.largest, size)
+            size = min(size, self.length)
+            self.length -= size
+            return 'x' * size
+
+    def test_short(self):
+        assert read_alert(io.StringIO(u'Test Alert')) == 'Test Alert'
+
+    def test_long(self):
+        stream = self.EndlessStream(50 * 1024 * 1024)
+
+        alert = read_alert(stream)
+
+        assert parse_alert(alert) == parse_alert('x' * 20000)
+        assert stream.length == 0
+        assert stream.largest <= 65536
+
+
 class TestParseAlert(object):
     def test_when_short(self):
         test_input = 'a'
@@ -130,6 +2913,38 @@ class TestParseAlert(object):
         assert test_output == parse_alert(test_input)
 
 
+class TestTokenizePairs(object):
+    @pytest.mark.parametrize(('string', 'pairs'), [
+        ('', ()),
+        ('Room = 1 ,, auth_token=a,', (('room', '1'), ('auth_token', 'a'))),
+        ('room=a=b', (('room', 'a=b'),)),
+        ('room="a, b",x=1', (('room', 'a, b'), ('x', '1'))),
+        ('room=" a "', (('room', ' a '),)),
+        (r'room="a \"b\" \\"', (('room', 'a "b" \\'),)),
+        (r'room=a\,b\=c', (('room', 'a,b=c'),)),
+        (r'room=a\b', (('room', r'a\b'),)),
+        ('room="a', (('room', '"a'),)),
+    ])
+    def test_tokenize(self, string, pairs):
+        assert tokenize_pairs(string) == pairs
+
+    @pytest.mark.parametrize('string', ['room', 'room=1,a', r'room=1,a\,b'])
+    def test_no_value(self, string):
+        with pytest.raises(ValueError):
+            tokenize_pairs(string)
+
+    def test_cache(self, monkeypatch):
+        monkeypatch.setattr(zabbix_media_hipchat, 'PAIRS_CACHE', {})
+        monkeypatch.setattr(zabbix_media_hipchat, 'PAIRS_CACHE_SIZE', 2)
+
+        pairs = tokenize_pairs('room=1')
+        assert tokenize_pairs('room=1') is pairs
+
+        tokenize_pairs('room=2')
+        tokenize_pairs('room=3')
+        assert len(zabbix_media_hipchat.PAIRS_CACHE) == 1
+
+
 class TestParseDestination(object):
     def test_blank_string(self):
         test_input = ''
@@ -186,6 +3001,45 @@ class TestParseDestination(object):
         test_output = {'room': '123456', 'auth_token': 'a' * 40}
         assert test_output == parse_destination(test_input)
 
+    def test_rooms(self):
+        test_input = 'room=1,auth_token=a,room=2'
+        test_output = {
+            'room': '1',
+            'auth_token': 'a',
+            'rooms': [
+                {'room': '1', 'auth_token': 'a'},
+                {'room': '2', 'auth_token': 'a'},
+            ],
+        }
+        assert test_output == parse_destination(test_input)
+
+    def test_room_auth_token(self):
+        test_input = 'room=1|b,room=2,auth_token=a'
+        test_output = {
+            'room': '1',
+            'auth_token': 'b',
+            'rooms': [
+                {'room': '1', 'auth_token': 'b'},
+                {'room': '2', 'auth_token': 'a'},
+            ],
+        }
+        assert test_output == parse_destination(test_input)
+
+    def test_room_auth_token_only(self):
+        test_input = 'room = 1 | b '
+        test_output = {'room': '1', 'auth_token': 'b'}
+        assert test_output == parse_destination(test_input)
+
+    def test_rooms_without_auth_token(self):
+        test_input = 'room=1|b,room=2'
+        with pytest.raises(KeyError):
+            parse_destination(test_input)
+
+    def test_rooms_one_too_long(self):
+        test_input = 'room=1,room=' + 'a' * 101 + ',auth_token=a'
+        with pytest.raises(ValueError):
+            parse_destination(test_input)
+
 
 class TestParseMetadata(object):
     def test_blank_string(self):
@@ -193,6 +3047,21 @@ class TestParseMetadata(object):
         test_output = {'color': 'red', 'notify': True}
         assert test_output == parse_metadata(test_input)
 
+    def test_eventid(self):
+        test_input = 'nseverity=1,eventid=42'
+        test_output = {
+            'color': 'purple',
+            'notify': True,
+            'nseverity': 1,
+            'eventid': '42',
+        }
+        assert test_output == parse_metadata(test_input)
+
+    def test_triggerid(self):
+        test_input = 'status=OK,triggerid=13'
+        test_output = {'color': 'green', 'notify': True, 'triggerid': '13'}
+        assert test_output == parse_metadata(test_input)
+
     def test_status_with_empty_value(self):
         test_input = 'status='
         test_output = {'color': 'red', 'notify': True}
@@ -225,32 +3094,32 @@ class TestParseMetadata(object):
 
     def test_nseverity_0(self):
         test_input = 'nseverity=0'
-        test_output = {'color': 'gray', 'notify': True}
+        test_output = {'color': 'gray', 'notify': True, 'nseverity': 0}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_1(self):
         test_input = 'nseverity=1'
-        test_output = {'color': 'purple', 'notify': True}
+        test_output = {'color': 'purple', 'notify': True, 'nseverity': 1}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_2(self):
         test_input = 'nseverity=2'
-        test_output = {'color': 'yellow', 'notify': True}
+        test_output = {'color': 'yellow', 'notify': True, 'nseverity': 2}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_3(self):
         test_input = 'nseverity=3'
-        test_output = {'color': 'red', 'notify': True}
+        test_output = {'color': 'red', 'notify': True, 'nseverity': 3}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_4(self):
         test_input = 'nseverity=4'
-        test_output = {'color': 'red', 'notify': True}
+        test_output = {'color': 'red', 'notify': True, 'nseverity': 4}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_5(self):
         test_input = 'nseverity=5'
-        test_output = {'color': 'red', 'notify': True}
+        test_output = {'color': 'red', 'notify': True, 'nseverity': 5}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_else(self):
@@ -260,12 +3129,12 @@ class TestParseMetadata(object):
 
     def test_nseverity_with_status_OK(self):
         test_input = 'status=OK,nseverity=5'
-        test_output = {'color': 'green', 'notify': True}
+        test_output = {'color': 'green', 'notify': True, 'nseverity': 5}
         assert test_output == parse_metadata(test_input)
 
     def test_nseverity_with_status_else(self):
         test_input = 'status=PROBLEM,nseverity=5'
-        test_output = {'color': 'red', 'notify': True}
+        test_output = {'color': 'red', 'notify': True, 'nseverity': 5}
         assert test_output == parse_metadata(test_input)
 
     def test_notify_false(self):
@@ -295,10 +3164,10 @@ class TestParseMetadata(object):
 
     def test_blank_around_delimiters(self):
         test_input = ' status = OK , nseverity = 5 , notify = false , a = b '
-        test_output = {'color': 'green', 'notify': False}
+        test_output = {'color': 'green', 'notify': False, 'nseverity': 5}
         assert test_output == parse_metadata(test_input)
 
     def test_undefined_key(self):
         test_input = 'status=OK,nseverity=5,notify=false,a=b'
-        test_output = {'color': 'green', 'notify': False}
+        test_output = {'color': 'green', 'notify': False, 'nseverity': 5}
         assert test_output == parse_metadata(test_input)
@@ -0,0 +1,195 @@
+import pytest
+
+from zabbix_media_hipchat import ConnectionPool
+from zabbix_media_hipchat import Dispatcher
+from zabbix_media_hipchat import RateLimitedOpener
+from zabbix_media_hipchat import RateLimiter
+from zabbix_media_hipchat import RoomCache
+from zabbix_media_hipchat import build_request
+from zabbix_media_hipchat import send_request
+from zabbix_media_hipchat_mock import MockHipChatServer
+
+ARGS = {
+    'room': '123456',
+    'auth_token': 'a' * 40,
+    'color': 'red',
+    'notify': True,
+    'alert': '@all Test Alert',
+}
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher(ConnectionPool(maxsize=1, timeout=5.0))
+    yield dispatcher
+    dispatcher.close()
+
+
+def serve(**kwargs):
+    server = MockHipChatServer(seed=0, **kwargs)
+    server.start()
+    return server
+
+
+class TestMockHipChatServer(object):
+    def test_success(self, dispatcher):
+        server = serve()
+        dispatcher.endpoint = server.endpoint
+        try:
+            [result] = dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        assert result['status'] == 204
+        assert server.statuses == {204: 1}
+
+    def test_throttle(self, dispatcher):
+        server = serve(throttle_rate=1.0)
+        dispatcher.endpoint = server.endpoint
+        try:
+            [result] = dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        assert result['status'] == 429
+        assert result['retry_after'] == 1.0
+
+    def test_error(self, dispatcher):
+        server = serve(error_rate=1.0)
+        dispatcher.endpoint = server.endpoint
+        try:
+            [result] = dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        assert result['status'] in MockHipChatServer.ERROR_STATUSES
+
+    def test_not_found(self, dispatcher):
+        server = serve()
+        dispatcher.endpoint = server.endpoint.replace('/room/', '/user/')
+        try:
+            [result] = dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        assert result['status'] == 404
+
+    def test_latency(self, dispatcher):
+        server = serve(latency=0.1)
+        dispatcher.endpoint = server.endpoint
+        try:
+            [result] = dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        assert result['elapsed'] >= 0.1
+
+    def test_latency_distribution(self, dispatcher):
+        server = serve(latency=0.01, latency_distribution='exponential')
+        dispatcher.endpoint = server.endpoint
+        try:
+            for _ in range(5):
+                dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        elapsed = [timing['elapsed'] for timing in server.timings]
+        assert len(elapsed) == 5
+        assert len(set([round(value, 3) for value in elapsed])) > 1
+
+    def test_unknown_distribution(self):
+        with pytest.raises(ValueError):
+            MockHipChatServer(latency_distribution='normal')
+
+    def test_timings(self, dispatcher):
+        server = serve()
+        dispatcher.endpoint = server.endpoint
+        try:
+            dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        [timing] = server.timings
+        assert timing['method'] == 'POST'
+        assert timing['path'] == '/v2/room/123456/notification'
+        assert timing['status'] == 204
+        assert timing['elapsed'] >= 0
+
+    def test_token(self, dispatcher):
+        server = serve(tokens=['b' * 40])
+        dispatcher.endpoint = server.endpoint
+        try:
+            [result] = dispatcher.deliver(ARGS)
+            [other] = dispatcher.deliver(dict(ARGS, auth_token='b' * 40))
+        finally:
+            server.stop()
+        assert result['status'] == 401
+        assert other['status'] == 204
+
+    def test_body(self, dispatcher):
+        server = serve()
+        try:
+            for body in (b'{', b'[]', b'{"message": ""}',
+                         b'{"message": "a", "color": "blue"}',
+                         b'{"message": "a", "notify": "yes"}',
+                         b'{"message": "a", "message_format": "md"}'):
+                request = build_request(
+                    server.endpoint % '1',
+                    'a',
+                    body,
+                )
+                result = send_request(request, '1', dispatcher.opener_director)
+                assert result['status'] == 400
+        finally:
+            server.stop()
+        assert server.statuses == {400: 6}
+
+    def test_rate_limit(self, dispatcher):
+        server = serve(rate_limit=(2, 60.0))
+        dispatcher.endpoint = server.endpoint
+        try:
+            results = [dispatcher.deliver(ARGS)[0] for _ in range(3)]
+        finally:
+            server.stop()
+        assert [r['status'] for r in results] == [204, 204, 429]
+
+    def test_rate_limit_headers(self, dispatcher):
+        server = serve(rate_limit=(2, 60.0))
+        dispatcher.opener_director = RateLimitedOpener(
+            dispatcher.opener_director,
+            RateLimiter(100, 300.0),
+            max_wait=1.0,
+        )
+        dispatcher.endpoint = server.endpoint
+        try:
+            results = [dispatcher.deliver(ARGS)[0] for _ in range(3)]
+        finally:
+            server.stop()
+        assert [r['status'] for r in results] == [204, 204, None]
+        assert 'Rate limited' in results[2]['error']
+        assert server.statuses == {204: 2}
+
+    def test_reset(self, dispatcher):
+        server = serve(reset_rate=1.0)
+        dispatcher.endpoint = server.endpoint
+        try:
+            [result] = dispatcher.deliver(ARGS)
+        finally:
+            server.stop()
+        assert result['status'] is None
+        assert result['error']
+        assert server.statuses == {None: 1}
+
+    def test_look_up(self, dispatcher):
+        server = serve(rooms={'Ops Room': 42})
+        cache = RoomCache(60.0)
+        try:
+            room_id = cache.resolve(
+                'Ops Room',
+                'a',
+                dispatcher.opener_director,
+                server.endpoint,
+            )
+            missing = cache.resolve(
+                'Nope',
+                'a',
+                dispatcher.opener_director,
+                server.endpoint,
+            )
+        finally:
+            server.stop()
+        assert room_id == '42'
+        assert missing is None
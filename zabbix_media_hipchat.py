@@ -6,9 +6,14 @@ Send alert to HipChat room mentioning everyone.
 
 __version__ = '0.1.1'
 
+import errno
 import optparse
+import os
+import re
+import socket
 import sys
-import textwrap
+import threading
+import time
 
 # pylint: disable=import-error, no-name-in-module
 try:
@@ -17,31 +22,28 @@ except ImportError:
     import simplejson as json
 
 try:
-    from urllib2 import HTTPSHandler
+    import SocketServer as socketserver
 except ImportError:
-    from urllib.request import HTTPSHandler
+    import socketserver
 
-try:
-    from urllib2 import build_opener
-except ImportError:
-    from urllib.request import build_opener
-
-try:
-    from urllib2 import Request
-except ImportError:
-    from urllib.request import Request
-
-try:
-    from urllib2 import HTTPError
-except ImportError:
-    from urllib.error import HTTPError
-
-try:
-    from urllib2 import URLError
-except ImportError:
-    from urllib.error import URLError
+from io import BytesIO
+from io import TextIOWrapper
 # pylint: enable=import-error, no-name-in-module
 
+# The HTTP client takes longer to import than handing an alert to the
+# delivery daemon takes altogether, so :func:`import_http` imports it once a
+# request is to be made.
+HTTPSHandler = None
+build_opener = None
+Request = None
+HTTPError = None
+URLError = None
+addinfourl = None
+urlsplit = None
+quote = None
+httplib = None
+HipChatRequest = None
+
 
 def main():
     """Main function.
@@ -49,26 +51,214 @@ def main():
     Generates an appropriate JSON and throws them to HipChat API.
 
     In case something happens(for example wrong token), prints error to stdout
-    and exit with 1.
+    and exit with 1. When the alert is sent to several rooms, each error is
+    prefixed with the room, and the alert script exits with 1 if it failed
+    for any of them.
+
+    With ``--serve``, runs the delivery daemon instead, as ``--workers``
+    processes if given. With ``--socket``, the
+    alert is handed to the daemon listening on that socket, falling back to
+    sending it directly when the daemon can not be reached. Once the alert
+    has been handed over, failures of the daemon are reported rather than
+    sending the alert again. With ``--bulk``, sends every alert read from the
+    file and exits with the highest exit status of them. With ``--spool``,
+    alerts which could not be sent for a reason worth retrying are kept for
+    a later retry instead of failing, and ``--drain`` retries those due.
+    With ``--coalesce``, the daemon and the bulk mode merge alerts to the same
+    room within a window into a digest. With ``--dedup``, alerts repeating
+    one sent to the same room within a while are suppressed. With
+    ``--prometheus``, the daemon serves its metrics, and with ``--statsd``,
+    metrics are pushed once the alerts are sent. With ``--routing``, the
+    alert script and the bulk mode decide how alerts are posted to every
+    room by the rules in the file. With ``--circuit-breaker``, alerts fail
+    right away while the API host keeps failing.
     """
 
-    opener_director = build_opener(HTTPSHandler())
+    started = time.time()
+    (options, args) = get_options_and_arguments()
+    parsed = time.time()
 
-    args = get_arguments()
-    request = get_request(args, API_ENDPOINT_ROOM)
+    if options.serve:
+        if options.workers:
+            supervise(
+                options.socket,
+                options.workers,
+                lambda: get_dispatcher(options),
+                options.prometheus,
+                options.drain_timeout,
+            )
+        else:
+            serve(
+                options.socket,
+                get_dispatcher(options),
+                options.prometheus,
+                options.drain_timeout,
+            )
+        return
 
-    try:
-        opener_director.open(request)
-    except HTTPError:
-        sys.stderr.write(str(sys.exc_info()[1]) + '\n')
-        sys.exit(1)
-    except URLError:
-        sys.stderr.write(str(sys.exc_info()[1]) + '\n')
+    if options.bulk:
+        sys.exit(bulk_deliver_file(
+            options.bulk,
+            get_dispatcher(options),
+            get_router(options),
+        ))
+
+    if options.drain:
+        dispatcher = get_dispatcher(options)
+        try:
+            dispatcher.drain()
+        finally:
+            dispatcher.close()
+        return
+
+    results = None
+
+    if options.socket:
+        try:
+            results = send_to_daemon(
+                options.socket,
+                args,
+                connect_timeout=options.connect_timeout,
+                timeout=options.connect_timeout + options.timeout,
+            )
+        except socket.error:
+            results = None
+
+    if results is None:
+        dispatcher = get_dispatcher(options, args)
+        if dispatcher.metrics is not None:
+            dispatcher.metrics.observe('parse', parsed - started)
+        try:
+            results = dispatcher.deliver(args)
+        finally:
+            dispatcher.close()
+
+    failed = False
+    for result in results:
+        if result['error']:
+            if len(results) > 1:
+                sys.stderr.write('%s: ' % result['room'])
+            if result.get('queued'):
+                sys.stderr.write(result['error'] + ' (queued for retry)\n')
+            else:
+                sys.stderr.write(result['error'] + '\n')
+                failed = True
+
+    if failed:
         sys.exit(1)
 
 
 API_ENDPOINT_ROOM = 'https://api.hipchat.com/v2/room/%s/notification'
 
+ENVIRONMENT_PREFIX = 'ZABBIX_MEDIA_HIPCHAT_'
+
+MESSAGE_LIMIT = 10000
+
+TRANSPORTS = ('urllib', 'pool', 'pipeline')
+
+ROUTING_ACTIONS = ('page', 'silent', 'drop')
+
+ROUTING_KEYS = ('rooms', 'severities', 'status', 'action', 'escalate')
+
+PAIRING_ACTIONS = ('collapse', 'drop')
+
+NSEVERITY_COLOR_MAP = {
+    0: 'gray',
+    1: 'purple',
+    2: 'yellow',
+    3: 'red',
+    4: 'red',
+    5: 'red',
+}
+
+
+def import_http():
+    """Import the HTTP client unless already imported.
+
+    Binds ``HTTPSHandler``, ``build_opener``, ``Request``, ``HTTPError``,
+    ``URLError``, ``addinfourl``, ``urlsplit``, ``quote`` and ``httplib`` as
+    globals of the module, along with :class:`HipChatRequest`. Every
+    function using them calls this first.
+    """
+
+    # pylint: disable=global-statement, import-error, no-name-in-module
+    # pylint: disable=redefined-outer-name, invalid-name
+    global HTTPSHandler, build_opener, Request, HTTPError, URLError
+    global addinfourl, urlsplit, quote, httplib, HipChatRequest
+
+    if HipChatRequest is not None:
+        return
+
+    try:
+        from urllib2 import HTTPSHandler
+    except ImportError:
+        from urllib.request import HTTPSHandler
+
+    try:
+        from urllib2 import build_opener
+    except ImportError:
+        from urllib.request import build_opener
+
+    try:
+        from urllib2 import Request
+    except ImportError:
+        from urllib.request import Request
+
+    try:
+        from urllib2 import HTTPError
+    except ImportError:
+        from urllib.error import HTTPError
+
+    try:
+        from urllib2 import URLError
+    except ImportError:
+        from urllib.error import URLError
+
+    try:
+        from urllib import addinfourl
+    except ImportError:
+        from urllib.response import addinfourl
+
+    try:
+        from urlparse import urlsplit
+    except ImportError:
+        from urllib.parse import urlsplit
+
+    try:
+        from urllib import quote
+    except ImportError:
+        from urllib.parse import quote
+
+    try:
+        import httplib
+    except ImportError:
+        import http.client as httplib
+
+    class HipChatRequest(Request):
+        """``Request`` with ``add_data`` and ``get_data`` on every version.
+
+        Python 3.4 removed both accessors in favour of the ``data``
+        attribute, which is what they operate on here.
+        """
+
+        def add_data(self, data):
+            """Set body of the request.
+
+            Args:
+                data (bytes): Body of the request.
+            """
+
+            self.data = data
+
+        def get_data(self):
+            """Get body of the request.
+
+            Returns:
+                bytes. Body of the request.
+            """
+
+            return self.data
+
 
 class PlainTextEpilogFormatter(optparse.IndentedHelpFormatter):
     """Format help.
@@ -93,54 +283,73 @@ class PlainTextEpilogFormatter(optparse.IndentedHelpFormatter):
             return ""
 
 
-def get_arguments():
-    """Parse commandline arguments.
+class OptionParser(optparse.OptionParser):
+    """Option parser building its help only when shown.
 
-    Parse commandline arguments and returns a dict containing runtime
-    parameters. Commandline arguments are (in order):
+    The help is formatted with :class:`PlainTextEpilogFormatter`, followed by
+    the epilog returned by :func:`get_epilog`. Neither is built unless help
+    is requested, or parsing fails.
+    """
 
-        ``destination``
-            ``destination string``
+    def format_help(self, formatter=None):
+        """Format help.
 
-        ``metadata``
-            ``metadata string``
+        Args:
+            formatter (optparse.HelpFormatter): Formatter to format help
+                with. None for a :class:`PlainTextEpilogFormatter`.
 
-        ``alert``
-            Body of the alert message.
+        Returns:
+            str. Formatted help.
+        """
 
-    Every commandline arguments are required. A nice help message will be
-    displayed when parsing of commandline arguments failed for some reason,
-    or user supplied ``--help`` option.
+        if formatter is None:
+            formatter = PlainTextEpilogFormatter()
+            formatter.set_parser(self)
+        return optparse.OptionParser.format_help(self, formatter)
 
-    Returns:
-        A dict containing the following:
+    def format_epilog(self, formatter):
+        """Format epilog.
 
-        ================ ====================================================
-        key              value
-        room (str)       ID or name of the room which the message is sent to.
-        auth_token (str) Bearer token to authenticate API access.
-        color (str)      Background color of the message sent to HipChat.
-        notify (bool)    Wether or not to trigger notifications.
-        ================ ====================================================
+        Args:
+            formatter (optparse.HelpFormatter): Formatter to format epilog
+                with.
+
+        Returns:
+            str. Formatted epilog.
+        """
+
+        return formatter.format_epilog(get_epilog())
+
+
+def get_epilog():
+    """Build epilog of the help.
+
+    Returns:
+        str. Epilog describing positional arguments and environment
+        variables.
     """
 
-    usage = '%prog [options] "destination" "metadata" "alert"'
-    version = '%%prog %s' % __version__
-    description = 'Send zabbix alert to HipChat.'
+    import textwrap
 
-    epilog = textwrap.dedent('''\
+    return textwrap.dedent('''\
         Positional arguments:
             destination     string representing the destination of the alert
             metadata        string representing alert metadata
-            alert           body of the alert
+            alert           body of the alert, unless read from
+                            `--alert-file`
 
         Format of `destination` string:
             A list of key/value paris in the form `key1=value1,key2=value2`.
+            Values may be double-quoted, or have `,`, `=`, `"` and `\\`
+            escaped with `\\`, to hold any of them.
             key        value
             room       ID or name of the room which the alert is sent to
-                       as an "@all" mentioning message. Required.
+                       as an "@all" mentioning message. Required. Repeat to
+                       send the alert to several rooms. Append
+                       `|<auth_token>` to use a token of its own for the room.
             auth_token Bearer token to authenticate API access against
-                       HipChat API version 2. Required.
+                       HipChat API version 2. Required unless every room has
+                       a token of its own.
 
         Format of `metadata` string:
             A list of key/value paris in the form of `key1=value1,key2=value2`.
@@ -159,195 +368,885 @@ def get_arguments():
                        To not trigger notifications, value has to be one of
                        'false', 'off', 'no', '0' (case insensitive). Any thing
                        other than these values will trigger the notification.
+            eventid    ID of the Zabbix event ({EVENT.ID}). Optional.
+                       Attached to traces of the alert, and pairs a
+                       recovery with its problem for `--pairing`.
+            triggerid  ID of the Zabbix trigger ({TRIGGER.ID}). Optional.
+                       Pairs a recovery with its problem for `--pairing`
+                       when no `eventid` is given.
+
+        Format of `--routing` file:
+            A JSON object with `rules`, a list of rules. The first rule
+            matching the room, `nseverity` and `status` of the alert
+            decides; alerts matching none are paged. Every key of a rule is
+            optional.
+            key        value
+            rooms      list of rooms the rule applies to. Any if not given.
+            severities list of `nseverity` values the rule applies to. Any
+                       if not given.
+            status     'OK' or 'PROBLEM'. Any if not given.
+            action     'page' to mention everyone with "@all" (default),
+                       'silent' to post without mention or notification,
+                       or 'drop' not to post.
+            escalate   list of rooms to page as well, in the form of
+                       `room` of `destination`.
+            e.g. {"rules": [{"severities": [0, 1], "action": "drop"},
+                            {"status": "OK", "action": "silent"},
+                            {"severities": [5], "escalate": ["oncall"]}]}
+            The rules are compiled into PATH.cache if writable, and
+            compiled again once PATH changes.
+
+        Environment variables:
+            Every option defaults to the value of the environment variable
+            ZABBIX_MEDIA_HIPCHAT_<OPTION>, where <OPTION> is the upper-cased
+            long option name with '-' replaced by '_'
+            (e.g. ZABBIX_MEDIA_HIPCHAT_SOCKET for `--socket`).
         ''')
 
-    option_parser = optparse.OptionParser(
+
+def get_option_parser():
+    """Build commandline option parser.
+
+    Every option defaults to the value of the environment variable named
+    ``ZABBIX_MEDIA_HIPCHAT_<DEST>``, where ``<DEST>`` is the upper-cased
+    destination of the option (e.g. ``ZABBIX_MEDIA_HIPCHAT_SOCKET``), so that
+    options can be set for alerts launched by Zabbix server, which passes
+    nothing but the 3 positional arguments.
+
+    Returns:
+        OptionParser. Option parser for the commandline.
+    """
+
+    usage = '%prog [options] "destination" "metadata" "alert"'
+    version = '%%prog %s' % __version__
+    description = 'Send zabbix alert to HipChat.'
+
+    option_parser = OptionParser(
         usage=usage,
         version=version,
         description=description,
-        formatter=PlainTextEpilogFormatter(),
-        epilog=epilog,
     )
 
-    (_, args) = option_parser.parse_args()
+    option_parser.add_option(
+        '--socket',
+        dest='socket',
+        metavar='PATH',
+        help='path of the unix socket of the delivery daemon. Alerts are '
+             'handed to the daemon, or sent directly when it is not running.',
+    )
+    option_parser.add_option(
+        '--serve',
+        dest='serve',
+        action='store_true',
+        default=False,
+        help='run the delivery daemon listening on `--socket`. On SIGTERM, '
+             'it stops accepting alerts, and exits once those it accepted '
+             'are sent.',
+    )
+    option_parser.add_option(
+        '--workers',
+        dest='workers',
+        type='int',
+        metavar='N',
+        help='run the daemon as N worker processes taking turns at the '
+             'alerts handed to `--socket`, each with connections of its '
+             'own, and fork them again when they exit. Workers share '
+             '`--dedup`, `--rate-limit`, `--circuit-breaker` and '
+             '`--room-cache` only through their state files, and coalesce '
+             'alerts on their own. With `--prometheus`, each serves its '
+             'metrics on PORT plus its number, from 0.',
+    )
+    option_parser.add_option(
+        '--drain-timeout',
+        dest='drain_timeout',
+        type='float',
+        default=30.0,
+        metavar='SECONDS',
+        help='seconds the daemon waits for the alerts it accepted to be sent '
+             'once terminated. [default: %default]',
+    )
+    option_parser.add_option(
+        '--endpoint',
+        dest='endpoint',
+        default=API_ENDPOINT_ROOM,
+        metavar='URL',
+        help='URL of the room notification API, with %s for the room, '
+             'e.g. to send alerts to a stand-in for HipChat. '
+             'Defaults to %default.',
+    )
+    option_parser.add_option(
+        '--connect-timeout',
+        dest='connect_timeout',
+        type='float',
+        default=5.0,
+        metavar='SECONDS',
+        help='timeout for connecting to HipChat or to the delivery daemon. '
+             '[default: %default]',
+    )
+    option_parser.add_option(
+        '--timeout',
+        dest='timeout',
+        type='float',
+        default=30.0,
+        metavar='SECONDS',
+        help='timeout for HipChat to respond once connected. '
+             '[default: %default]',
+    )
+    option_parser.add_option(
+        '--transport',
+        dest='transport',
+        type='choice',
+        choices=TRANSPORTS,
+        metavar='|'.join(TRANSPORTS),
+        help="how to send requests: 'urllib' opens a connection per "
+             "request, 'pool' keeps connections open between requests, and "
+             "'pipeline' also sends the requests of an alert to many rooms "
+             'down one connection without waiting for each response. '
+             "Defaults to 'urllib' for an alert to a single room, to 'pool' "
+             'otherwise. Connections are only timed by `--prometheus` and '
+             '`--statsd`, and hosts only looked up in `--dns-cache`, with a '
+             'pool.',
+    )
+    option_parser.add_option(
+        '--spool',
+        dest='spool',
+        metavar='PATH',
+        help='path of the SQLite database keeping alerts until they are '
+             'sent. Alerts failing for a reason worth retrying are retried '
+             'with exponential backoff by `--drain` or by the daemon.',
+    )
+    option_parser.add_option(
+        '--spool-aging',
+        dest='spool_aging',
+        type='float',
+        default=300.0,
+        metavar='SECONDS',
+        help='seconds an alert in `--spool` has to wait to be sent ahead of '
+             'one a severity higher. Alerts are retried most severe first, '
+             'and recoveries in a lane of their own. [default: %default]',
+    )
+    option_parser.add_option(
+        '--drain',
+        dest='drain',
+        action='store_true',
+        default=False,
+        help='retry the alerts in `--spool` which are due, and exit.',
+    )
+    option_parser.add_option(
+        '--coalesce',
+        dest='coalesce',
+        type='float',
+        metavar='SECONDS',
+        help='in the daemon and bulk mode, merge alerts to the same room '
+             'arriving within SECONDS of the first one into a digest.',
+    )
+    option_parser.add_option(
+        '--pairing',
+        dest='pairing',
+        type='choice',
+        choices=PAIRING_ACTIONS,
+        metavar='|'.join(PAIRING_ACTIONS),
+        help='what to do with a recovery whose problem, of the same '
+             '`eventid` or `triggerid`, is still waiting in `--spool` or '
+             "`--coalesce` to be sent: 'collapse' not to send the problem "
+             'and to tell in the recovery how long it lasted, '
+             "'drop' to send neither. Both are sent if not given.",
+    )
+    option_parser.add_option(
+        '--dedup',
+        dest='dedup',
+        type='float',
+        metavar='SECONDS',
+        help='suppress alerts repeating one sent to the same room within '
+             'SECONDS. The next alert sent afterwards tells how many times '
+             'it was repeated.',
+    )
+    option_parser.add_option(
+        '--dedup-state',
+        dest='dedup_state',
+        metavar='PATH',
+        help='path of the file sharing the state of `--dedup` between '
+             'processes. Without it, the state lasts as long as the process, '
+             'which is enough for the daemon and bulk mode.',
+    )
+    option_parser.add_option(
+        '--routing',
+        dest='routing',
+        metavar='PATH',
+        help='decide for every room whether the alert is paged, posted '
+             'silently or dropped, and which rooms it is escalated to, by '
+             'the rules in the JSON file PATH. See below for the format.',
+    )
+    option_parser.add_option(
+        '--rate-limit',
+        dest='rate_limit',
+        metavar='REQUESTS/SECONDS',
+        help='pace requests made with each token to at most REQUESTS per '
+             'SECONDS, e.g. 100/300 for the default quota of HipChat.',
+    )
+    option_parser.add_option(
+        '--rate-limit-state',
+        dest='rate_limit_state',
+        metavar='PATH',
+        help='path of the file sharing the state of `--rate-limit` between '
+             'processes. Without it, the state lasts as long as the process, '
+             'which is enough for the daemon and bulk mode.',
+    )
+    option_parser.add_option(
+        '--circuit-breaker',
+        dest='circuit_breaker',
+        metavar='FAILURES/SECONDS',
+        help='fail requests to the API host right away for SECONDS once '
+             'FAILURES in a row failed to get a response or got a server '
+             'error, e.g. 5/60, then let a request through to probe whether '
+             'it is back. Failed alerts wait in `--spool` meanwhile, if '
+             'given.',
+    )
+    option_parser.add_option(
+        '--circuit-breaker-state',
+        dest='circuit_breaker_state',
+        metavar='PATH',
+        help='path of the file sharing the state of `--circuit-breaker` '
+             'between processes. Without it, the state lasts as long as the '
+             'process, which is enough for the daemon and bulk mode.',
+    )
+    option_parser.add_option(
+        '--room-cache',
+        dest='room_cache',
+        type='float',
+        metavar='SECONDS',
+        help='look rooms given by name up once, and send to them by ID for '
+             'SECONDS. Alerts to rooms which do not exist fail without a '
+             'request for a minute. Rooms the auth token is not allowed to '
+             'look up are sent to by name.',
+    )
+    option_parser.add_option(
+        '--room-cache-state',
+        dest='room_cache_state',
+        metavar='PATH',
+        help='path of the file sharing the rooms cached by `--room-cache` '
+             'between processes. Without it, rooms are looked up by every '
+             'alert script.',
+    )
+    option_parser.add_option(
+        '--dns-cache',
+        dest='dns_cache',
+        type='float',
+        metavar='SECONDS',
+        help='keep the addresses the API host resolves to for SECONDS '
+             'instead of resolving it for every connection.',
+    )
+    option_parser.add_option(
+        '--dns-cache-state',
+        dest='dns_cache_state',
+        metavar='PATH',
+        help='path of the file sharing the addresses cached by `--dns-cache` '
+             'between processes, so that alert scripts skip resolving the '
+             'host. Without it, they last as long as the process.',
+    )
+    option_parser.add_option(
+        '--prometheus',
+        dest='prometheus',
+        metavar='[HOST:]PORT',
+        help='serve metrics of the daemon to Prometheus on PORT of HOST '
+             '(127.0.0.1 unless given).',
+    )
+    option_parser.add_option(
+        '--statsd',
+        dest='statsd',
+        metavar='[HOST:]PORT',
+        help='push metrics to the StatsD server on PORT of HOST (127.0.0.1 '
+             'unless given) once the alerts are sent.',
+    )
+    option_parser.add_option(
+        '--trace',
+        dest='trace',
+        metavar='PATH|URL',
+        help='export spans of every stage of delivering alerts as OTLP JSON, '
+             'appended to PATH a line per trace, or posted to the OTLP/HTTP '
+             'traces URL of a collector (e.g. '
+             'http://127.0.0.1:4318/v1/traces).',
+    )
+    option_parser.add_option(
+        '--alert-file',
+        dest='alert_file',
+        metavar='FILE',
+        help="read the body of the alert from FILE ('-' for stdin, "
+             '/dev/fd/N for file descriptor N) instead of the `alert` '
+             'argument. Only the part fitting in a message is kept in '
+             'memory, however long the body is.',
+    )
+    option_parser.add_option(
+        '--record',
+        dest='record',
+        metavar='PATH',
+        help='append the arguments of the alert, with the time and the auth '
+             'tokens replaced by hashes of them, to PATH as a record of '
+             '`--bulk` input, e.g. to replay an alert storm with '
+             'replay_zabbix_media_hipchat.py.',
+    )
+    option_parser.add_option(
+        '--bulk',
+        dest='bulk',
+        metavar='FILE',
+        help="send every alert read from FILE ('-' for stdin) instead of "
+             'the positional arguments, one record per line. Records are '
+             'either JSON objects with `destination`, `metadata` and `alert` '
+             'keys, or the 3 strings separated by tabs with tab, newline and '
+             'backslash escaped as \\t, \\n and \\\\. The result of each '
+             'record is written to stdout as a line of JSON.',
+    )
 
-    dictionary = {}
+    set_defaults_from_environment(option_parser)
 
-    try:
-        dictionary.update(parse_destination(args[0]))
-        dictionary.update(parse_metadata(args[1]))
-        dictionary.update(parse_alert(args[2]))
-    except (IndexError, KeyError, ValueError):
-        option_parser.print_help()
-        sys.exit(2)
+    return option_parser
 
-    return dictionary
 
+def set_defaults_from_environment(option_parser):
+    """Set option defaults from ``ZABBIX_MEDIA_HIPCHAT_*`` environment.
 
-def parse_destination(string):
-    """Parse ``destination string``.
+    Values are converted the same way as values given on the commandline.
+    For ``store_true`` options, any value other than ``false``, ``off``,
+    ``no``, ``0`` (case insensitive) or an empty string enables the option.
 
-    ``destination string`` is a list of key/value paris in the form of
-    ``key1=value1,key2=value2``. Accepted keys and values are:
+    Args:
+        option_parser (optparse.OptionParser): Option parser to update.
+    """
 
-        ``room``
-            ID or name of the room which the alert is sent to as an "@all"
-            mentioning message. Required.
-        ``auth_token``
-            Bearer token to authenticate API access against HipChat API version
-            2. Required.
+    for option in option_parser.option_list:
+        if not option.dest:
+            continue
 
-    Args:
-        string (str): ``destination string``.
+        name = ENVIRONMENT_PREFIX + option.dest.upper()
+        if name not in os.environ:
+            continue
 
-    Returns:
-        A dict containing the following:
+        value = os.environ[name]
+        if option.action == 'store_true':
+            value = value.lower() not in ['', 'false', 'off', 'no', '0']
+        else:
+            value = option.check_value(option.get_opt_string(), value)
 
-        ================ ====================================================
-        key              value
-        room (str)       ID or name of the room which the message is sent to.
-        auth_token (str) Bearer token to authenticate API access.
-        ================ ====================================================
+        option_parser.set_default(option.dest, value)
 
-    Raises:
-        * KeyError: Raised when required keys are not proveded.
-        * ValueError: Raised when values are not acceptable.
-    """
 
-    dictionary = {}
-    room = None
-    auth_token = None
+def get_options_and_arguments():
+    """Parse commandline options and arguments.
 
-    for kv_pair in string.split(','):
-        if kv_pair:
-            key, value = kv_pair.split('=', 1)
-            key = key.strip().lower()
-            value = value.strip()
+    Same as :func:`get_arguments`, but returns parsed options as well. In
+    modes which take no positional arguments (``--serve``, ``--bulk`` and
+    ``--drain``), the dict of runtime parameters is empty. With ``--trace``,
+    the tracer is installed before the positional arguments are parsed, so
+    that parsing them is traced too. With ``--routing``, the alert is routed
+    as returned by :meth:`Router.route`. With ``--record``, the arguments
+    are recorded by :func:`record_alert` before they are parsed, so that
+    malformed ones are recorded too.
 
-            if key == 'room':
-                room = value
-            elif key == 'auth_token':
-                auth_token = value
-            else:
-                pass
+    Returns:
+        A tuple of ``optparse.Values`` and a dict containing runtime
+        parameters.
+    """
 
-    if not room:
-        raise KeyError
+    option_parser = get_option_parser()
 
-    if not len(str(room)) <= 100:
-        raise ValueError
+    started = time.time()
+    (options, args) = option_parser.parse_args()
 
-    if not auth_token:
-        raise KeyError
+    if options.endpoint.count('%s') != 1:
+        option_parser.error('--endpoint needs %s for the room')
 
-    dictionary['room'] = str(room)
-    dictionary['auth_token'] = str(auth_token)
-    return dictionary
+    if options.workers is not None and options.workers < 1:
+        option_parser.error('--workers needs at least 1 worker')
 
+    for name in ('prometheus', 'statsd'):
+        if getattr(options, name):
+            try:
+                parse_address(getattr(options, name))
+            except ValueError:
+                option_parser.error('malformed --%s' % name)
 
-def parse_metadata(string):
-    """Parse ``metadata string``.
+    dictionary = {}
 
-    ``metadata string`` is a list of key/value paris in the form of
-    ``key1=value1,key2=value2``. Accepted keys and values are:
+    if options.serve or options.bulk or options.drain:
+        if options.trace:
+            set_tracer(OTLPTracer(options.trace))
+        return (options, dictionary)
 
-        ``status``
-            Status of the alert. ``OK`` will set the background color of the
-            message to green irrespective of the severity of the alert. If not
-            specified, or anything other than ``OK`` was specified, background
-            color is determined by ``nseverity``.
+    if options.trace:
+        # One trace for everything the alert script does.
+        set_tracer(OTLPTracer(options.trace, trace_id=new_trace_id()))
 
-        ``nseverity``
-            Numerical severity of the alert (0 <= n <= 5).  Background color of
-            the message sent to HipChat will be determined according to this
-            value. If not specified, ``High`` is used as a default.
+    if options.alert_file and len(args) != 2:
+        option_parser.error('--alert-file takes the place of `alert`')
 
-        ``notify``
-            Wether or not to trigger notifications(both in-app notification and
-            offline / idle notifications). To not trigger notifications, value
-            has to be one of ``false``, ``off``, ``no``, ``0`` (case
-            insensitive). Any thing other than these values will trigger the
-            notification.
+    with trace('get_arguments', start=started) as span:
+        if options.alert_file:
+            try:
+                with trace('read_alert'):
+                    args.append(read_alert_file(options.alert_file))
+            except IOError:
+                sys.stderr.write(
+                    'Unreadable --alert-file: %s\n' % sys.exc_info()[1]
+                )
+                sys.exit(2)
 
-    Args:
-        string (str): ``metadata string``.
+        if options.record and len(args) == 3:
+            try:
+                with trace('record'):
+                    record_alert(options.record, args[0], args[1], args[2])
+            except (IOError, OSError):
+                # The alert matters more than its record.
+                sys.stderr.write(
+                    'Unwritable --record: %s\n' % sys.exc_info()[1]
+                )
 
-    Returns:
-        A dict containing the following:
+        try:
+            with trace('parse_destination'):
+                dictionary.update(parse_destination(args[0]))
+            with trace('parse_metadata'):
+                dictionary.update(parse_metadata(args[1]))
+            with trace('parse_alert'):
+                dictionary.update(parse_alert(args[2]))
+        except (IndexError, KeyError, ValueError):
+            option_parser.print_help()
+            sys.exit(2)
 
-        ============= ================================================
-        key           value
-        color (str)   Background color of the message sent to HipChat.
-        notify (bool) Wether or not to trigger notifications.
-        ============= ================================================
-    """
+        router = get_router(options)
+        if router is not None:
+            with trace('route'):
+                dictionary = router.route(dictionary, args[1])
 
-    nseverity_color_map = {
-        0: 'gray',
-        1: 'purple',
-        2: 'yellow',
-        3: 'red',
-        4: 'red',
-        5: 'red',
-    }
+        if 'eventid' in dictionary:
+            span.set_attribute('zabbix.event_id', dictionary['eventid'])
 
-    dictionary = {}
-    status = None
-    nseverity = None
-    notify = None
-
-    for kv_pair in string.split(','):
-        if kv_pair:
-            key, value = kv_pair.split('=', 1)
-            key = key.strip().lower()
-            value = value.strip()
-
-            if key == 'status':
-                status = value
-            elif key == 'nseverity':
-                nseverity = value
-            elif key == 'notify':
-                notify = value
-            else:
-                pass
+    return (options, dictionary)
 
-    try:
-        if str(status).upper() == 'OK':
-            color = 'green'
-        else:
-            color = nseverity_color_map[int(nseverity)]
-    except (KeyError, TypeError, ValueError):
-        color = 'red'
 
-    if str(notify).lower() in ['false', 'off', 'no', '0']:
-        notify = False
-    else:
-        notify = True
+def get_arguments():
+    """Parse commandline arguments.
 
-    dictionary['color'] = color
-    dictionary['notify'] = notify
-    return dictionary
+    Parse commandline arguments and returns a dict containing runtime
+    parameters. Commandline arguments are (in order):
 
+        ``destination``
+            ``destination string``
 
-def parse_alert(string):
-    """Format alert message before sending it to HipChat.
+        ``metadata``
+            ``metadata string``
 
-    Does 2 thins:
-        * Prefix message with "@all" mention for messages to trigger
-          notifications.
-        * Truncate long messages so that they fits within the 10000 character
-          limit of HipChat.
+        ``alert``
+            Body of the alert message.
 
-    Args:
-        string (str): Body of the alert message.
+    Every commandline arguments are required. A nice help message will be
+    displayed when parsing of commandline arguments failed for some reason,
+    or user supplied ``--help`` option.
 
     Returns:
         A dict containing the following:
 
-        ===== =========================================
-        key   value
-        alert Formatted message.
-        ===== =========================================
+        ================ ====================================================
+        key              value
+        room (str)       ID or name of the room which the message is sent to.
+        auth_token (str) Bearer token to authenticate API access.
+        color (str)      Background color of the message sent to HipChat.
+        notify (bool)    Wether or not to trigger notifications.
+        ================ ====================================================
+    """
+
+    return get_options_and_arguments()[1]
+
+
+PAIR_TOKEN_PATTERN = re.compile(
+    r'"((?:[^"\\]|\\.)*)"|\\([,="\\])|([,=])|([^,="\\]+|["\\])'
+)
+
+QUOTED_ESCAPE_PATTERN = re.compile(r'\\(["\\])')
+
+PAIRS_CACHE = {}
+
+PAIRS_CACHE_SIZE = 4096
+
+
+def tokenize_pairs(string):
+    """Split key/value pairs in the form of ``key1=value1,key2=value2``.
+
+    Pairs are separated by ``,``, and keys from values by the first ``=``.
+    Keys are lower-cased, and both keys and values stripped of whitespace.
+    Empty pairs are skipped. ``,``, ``=``, ``"`` and ``\\`` are taken
+    literally when escaped with ``\\``, as is everything in double quotes,
+    where ``"`` and ``\\`` are escaped the same way. Any other backslash is
+    taken literally. Strings with neither quotes nor backslashes, that is
+    almost all of them, are split without looking for either, and the
+    others scanned once.
+
+    The pairs of the last :data:`PAIRS_CACHE_SIZE` distinct strings are
+    kept, as the daemon and bulk mode get the same destinations and metadata
+    over and over.
+
+    Args:
+        string (str): List of key/value pairs.
+
+    Returns:
+        tuple. A tuple of the key and value of every pair, in order.
+
+    Raises:
+        * ValueError: Raised when a pair has no ``=``.
+    """
+
+    pairs = PAIRS_CACHE.get(string)
+    if pairs is not None:
+        return pairs
+
+    pairs = []
+
+    if '"' not in string and '\\' not in string:
+        for kv_pair in string.split(','):
+            if kv_pair.strip():
+                (key, separator, value) = kv_pair.partition('=')
+                if not separator:
+                    raise ValueError('No value: %s' % kv_pair.strip())
+                pairs.append((key.strip().lower(), value.strip()))
+        return remember_pairs(string, pairs)
+
+    key = None
+    parts = []
+
+    for match in PAIR_TOKEN_PATTERN.finditer(string + ','):
+        (quoted, escaped, separator, plain) = match.groups()
+        if separator == ',':
+            if key is not None:
+                pairs.append((key, join_token_parts(parts)))
+            elif join_token_parts(parts):
+                raise ValueError('No value: %s' % join_token_parts(parts))
+            key = None
+            parts = []
+        elif separator == '=' and key is None:
+            key = join_token_parts(parts).lower()
+            parts = []
+        elif quoted is not None:
+            parts.append((QUOTED_ESCAPE_PATTERN.sub(r'\1', quoted), True))
+        elif escaped is not None:
+            parts.append((escaped, True))
+        else:
+            parts.append((plain or separator, False))
+
+    return remember_pairs(string, pairs)
+
+
+def remember_pairs(string, pairs):
+    """Keep the pairs split from a string for :func:`tokenize_pairs`.
+
+    Args:
+        string (str): List of key/value pairs.
+        pairs (list): A tuple of the key and value of every pair.
+
+    Returns:
+        tuple. The pairs.
+    """
+
+    pairs = tuple(pairs)
+
+    if len(PAIRS_CACHE) >= PAIRS_CACHE_SIZE:
+        PAIRS_CACHE.clear()
+    PAIRS_CACHE[string] = pairs
+
+    return pairs
+
+
+def join_token_parts(parts):
+    """Join the parts of a key or value, stripping it of whitespace.
+
+    Args:
+        parts (list): A tuple of the text of every part and whether it was
+            quoted or escaped, which keeps it from being stripped.
+
+    Returns:
+        str. Key or value.
+    """
+
+    if not parts:
+        return ''
+
+    texts = [text for (text, _) in parts]
+    if not parts[0][1]:
+        texts[0] = texts[0].lstrip()
+    if not parts[-1][1]:
+        texts[-1] = texts[-1].rstrip()
+    return ''.join(texts)
+
+
+def parse_destination(string):
+    """Parse ``destination string``.
+
+    ``destination string`` is a list of key/value paris in the form of
+    ``key1=value1,key2=value2``. Accepted keys and values are:
+
+        ``room``
+            ID or name of the room which the alert is sent to as an "@all"
+            mentioning message. Required. May be given more than once to send
+            the alert to every room given, and may be suffixed with
+            ``|<auth_token>`` to use a token of its own for the room.
+        ``auth_token``
+            Bearer token to authenticate API access against HipChat API version
+            2. Required unless every room has a token of its own.
+
+    Args:
+        string (str): ``destination string``.
+
+    Returns:
+        A dict containing the following:
+
+        ================ ====================================================
+        key              value
+        room (str)       ID or name of the room which the message is sent to.
+        auth_token (str) Bearer token to authenticate API access.
+        rooms (list)     Only when more than one room was given. A dict with
+                         ``room`` and ``auth_token`` for every room, in
+                         order. ``room`` and ``auth_token`` above are those
+                         of the first room.
+        ================ ====================================================
+
+    Raises:
+        * KeyError: Raised when required keys are not proveded.
+        * ValueError: Raised when values are not acceptable.
+    """
+
+    dictionary = {}
+    rooms = []
+    auth_token = None
+
+    for (key, value) in tokenize_pairs(string):
+        if key == 'room':
+            rooms.append(value)
+        elif key == 'auth_token':
+            auth_token = value
+
+    if not rooms:
+        raise KeyError
+
+    destinations = []
+
+    for room in rooms:
+        (room, _, room_auth_token) = room.partition('|')
+        room = room.strip()
+        room_auth_token = room_auth_token.strip() or auth_token
+
+        if not room:
+            raise KeyError
+
+        if not len(str(room)) <= 100:
+            raise ValueError
+
+        if not room_auth_token:
+            raise KeyError
+
+        destinations.append({
+            'room': str(room),
+            'auth_token': str(room_auth_token),
+        })
+
+    dictionary.update(destinations[0])
+    if len(destinations) > 1:
+        dictionary['rooms'] = destinations
+    return dictionary
+
+
+def split_destinations(args):
+    """Split the alert into an alert per room.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        list. Runtime parameters for every room alone, in the order of the
+        rooms.
+    """
+
+    if 'rooms' not in args:
+        return [args]
+
+    alerts = []
+    for destination in args['rooms']:
+        room_args = dict(args)
+        del room_args['rooms']
+        room_args.update(destination)
+        alerts.append(room_args)
+
+    return alerts
+
+
+def join_destinations(alerts):
+    """Join alerts with the same message to several rooms into one alert.
+
+    The reverse of :func:`split_destinations`.
+
+    Parameters of a room differing from those of the first room, such as
+    those set by :meth:`Router.route`, are kept along with the room.
+
+    Args:
+        alerts (list): Runtime parameters of the alert for every room alone.
+
+    Returns:
+        dict. Runtime parameters of the alert to every room, in the order of
+        ``alerts``.
+    """
+
+    if len(alerts) == 1:
+        return alerts[0]
+
+    dictionary = dict(alerts[0])
+    dictionary['rooms'] = []
+    for alert in alerts:
+        destination = {
+            'room': alert['room'],
+            'auth_token': alert['auth_token'],
+        }
+        for key in set(alert) | set(alerts[0]):
+            if key not in destination and \
+                    alert.get(key) != alerts[0].get(key):
+                destination[key] = alert.get(key)
+        dictionary['rooms'].append(destination)
+
+    return dictionary
+
+
+def get_destinations(args):
+    """List rooms the alert is sent to.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        list. A dict with ``room`` and ``auth_token`` for every room.
+    """
+
+    if 'rooms' in args:
+        return args['rooms']
+    return [{'room': args['room'], 'auth_token': args['auth_token']}]
+
+
+def parse_metadata(string):
+    """Parse ``metadata string``.
+
+    ``metadata string`` is a list of key/value paris in the form of
+    ``key1=value1,key2=value2``. Accepted keys and values are:
+
+        ``status``
+            Status of the alert. ``OK`` will set the background color of the
+            message to green irrespective of the severity of the alert. If not
+            specified, or anything other than ``OK`` was specified, background
+            color is determined by ``nseverity``.
+
+        ``nseverity``
+            Numerical severity of the alert (0 <= n <= 5).  Background color of
+            the message sent to HipChat will be determined according to this
+            value. If not specified, ``High`` is used as a default.
+
+        ``notify``
+            Wether or not to trigger notifications(both in-app notification and
+            offline / idle notifications). To not trigger notifications, value
+            has to be one of ``false``, ``off``, ``no``, ``0`` (case
+            insensitive). Any thing other than these values will trigger the
+            notification.
+
+        ``eventid``
+            ID of the Zabbix event (``{EVENT.ID}``). Optional. Attached to
+            traces of the alert, and pairs a recovery with its problem.
+
+        ``triggerid``
+            ID of the Zabbix trigger (``{TRIGGER.ID}``). Optional. Pairs a
+            recovery with its problem when no ``eventid`` is given.
+
+    Args:
+        string (str): ``metadata string``.
+
+    Returns:
+        A dict containing the following:
+
+        =============== ================================================
+        key             value
+        color (str)     Background color of the message sent to HipChat.
+        notify (bool)   Wether or not to trigger notifications.
+        nseverity (int) Numerical severity of the alert. Only when given
+                        and from 0 to 5.
+        eventid (str)   ID of the Zabbix event. Only when given.
+        triggerid (str) ID of the Zabbix trigger. Only when given.
+        =============== ================================================
+    """
+
+    dictionary = {}
+    pairs = parse_pairs(string)
+    status = pairs.get('status')
+    nseverity = pairs.get('nseverity')
+    notify = pairs.get('notify')
+    eventid = pairs.get('eventid')
+    triggerid = pairs.get('triggerid')
+
+    try:
+        nseverity = int(nseverity)
+    except (TypeError, ValueError):
+        nseverity = None
+    if nseverity not in NSEVERITY_COLOR_MAP:
+        nseverity = None
+
+    if str(status).upper() == 'OK':
+        color = 'green'
+    else:
+        color = NSEVERITY_COLOR_MAP.get(nseverity, 'red')
+
+    if str(notify).lower() in ['false', 'off', 'no', '0']:
+        notify = False
+    else:
+        notify = True
+
+    dictionary['color'] = color
+    dictionary['notify'] = notify
+    if nseverity is not None:
+        # Colors are coarser, e.g. red for 3 to 5, for ranking alerts.
+        dictionary['nseverity'] = nseverity
+    if eventid:
+        dictionary['eventid'] = eventid
+    if triggerid:
+        dictionary['triggerid'] = triggerid
+    return dictionary
+
+
+def parse_pairs(string):
+    """Parse key/value pairs in the form of ``key1=value1,key2=value2``.
+
+    Args:
+        string (str): List of key/value pairs, as split by
+            :func:`tokenize_pairs`.
+
+    Returns:
+        dict. Value of every key, the last one when repeated.
+
+    Raises:
+        * ValueError: Raised when a pair has no ``=``.
+    """
+
+    return dict(tokenize_pairs(string))
+
+
+def parse_alert(string):
+    """Format alert message before sending it to HipChat.
+
+    Does 2 thins:
+        * Prefix message with "@all" mention for messages to trigger
+          notifications.
+        * Truncate long messages so that they fits within the 10000 character
+          limit of HipChat.
+
+    Args:
+        string (str): Body of the alert message.
+
+    Returns:
+        A dict containing the following:
+
+        ===== =========================================
+        key   value
+        alert Formatted message.
+        ===== =========================================
     """
 
     dictionary = {}
@@ -363,21 +1262,5155 @@ def parse_alert(string):
     return dictionary
 
 
-def get_request(args, endpoint):
-    request = Request(endpoint % args['room'])
+def read_alert(stream, chunk_size=65536):
+    """Read the body of an alert from a stream, keeping no more than fits.
 
-    json_body_dict = {}
-    json_body_dict['color'] = args['color']
-    json_body_dict['message'] = args['alert']
-    json_body_dict['notify'] = args['notify']
-    json_body_dict['message_format'] = 'text'
-    json_body_str = json.dumps(json_body_dict)
-    request.add_data(json_body_str)
+    At most :data:`MESSAGE_LIMIT` characters are kept, which is enough for
+    :func:`parse_alert` to truncate the body as it would the whole of it.
+    The rest is read and thrown away ``chunk_size`` characters at a time,
+    so that the writer is not cut off, and memory does not grow with the
+    size of the body.
 
-    request.add_header('Authorization', 'Bearer %s' % args['auth_token'])
-    request.add_header('Content-type', 'application/json')
+    Args:
+        stream: File-like object to read from.
+        chunk_size (int): Number of characters to read at a time once
+            enough have been kept.
 
-    return request
+    Returns:
+        str. The beginning of the body.
+    """
+
+    parts = []
+    length = 0
+
+    while length < MESSAGE_LIMIT:
+        part = stream.read(MESSAGE_LIMIT - length)
+        if not part:
+            break
+        parts.append(part)
+        length += len(part)
+
+    while stream.read(chunk_size):
+        pass
+
+    return ''.join(parts)
+
+
+def read_alert_file(path):
+    """Read the body of an alert as :func:`read_alert` does.
+
+    The file is read as UTF-8 whatever the locale, bytes which are not UTF-8
+    being replaced by U+FFFD, so that a body in another encoding is still
+    sent.
+
+    Args:
+        path (str): Path of the file to read. ``-`` for stdin.
+
+    Returns:
+        str. The beginning of the body.
+
+    Raises:
+        * IOError: Raised when the file can not be read.
+    """
+
+    if path == '-':
+        if not hasattr(sys.stdin, 'buffer'):
+            return read_alert(sys.stdin)
+        stream = TextIOWrapper(
+            sys.stdin.buffer,
+            encoding='utf-8',
+            errors='replace',
+        )
+        try:
+            return read_alert(stream)
+        finally:
+            # Leave stdin open.
+            stream.detach()
+
+    stream = TextIOWrapper(
+        open(path, 'rb'),
+        encoding='utf-8',
+        errors='replace',
+    )
+    try:
+        return read_alert(stream)
+    finally:
+        stream.close()
+
+
+class Router(object):
+    """Decide how the alert is posted to every room.
+
+    Wraps a table compiled by :func:`compile_routes`, so that deciding is a
+    single lookup of the room, the severity and whether the alert is a
+    recovery. Every room gets one of the actions:
+
+    ====== ==============================================================
+    action effect
+    page   Posted as it is, mentioning everyone with "@all".
+    silent Posted without the "@all" mention and without notifications.
+    drop   Not posted.
+    ====== ==============================================================
+
+    Along with the action, the alert may be escalated to other rooms, where
+    it is paged.
+    """
+
+    def __init__(self, table):
+        """Initialize router.
+
+        Args:
+            table (dict): Table as returned by :func:`compile_routes`.
+        """
+
+        self.table = table
+
+    def lookup(self, room, severity, recovery):
+        """Decide how the alert is posted to a room.
+
+        Args:
+            room (str): ID or name of the room.
+            severity (int): ``nseverity`` of the alert, None when not given
+                or out of range.
+            recovery (bool): Whether the status of the alert is ``OK``.
+
+        Returns:
+            A tuple of the action and a tuple of the rooms to escalate to.
+        """
+
+        key = (room, severity, recovery)
+        if key in self.table:
+            return self.table[key]
+        return self.table[(None, severity, recovery)]
+
+    def route(self, args, metadata):
+        """Apply the routing rules to the alert.
+
+        Rooms are marked with the decision, so that every room can still be
+        sent to in one go: silenced rooms get an ``alert`` and ``notify`` of
+        their own, and dropped rooms ``dropped``, which
+        :meth:`Dispatcher.deliver` skips. Rooms escalated to are added after
+        the others, unless already sent to.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`.
+            metadata (str): ``metadata string`` the alert was parsed from.
+
+        Returns:
+            dict. Runtime parameters of the routed alert.
+        """
+
+        pairs = parse_pairs(metadata)
+        try:
+            severity = int(pairs.get('nseverity'))
+        except (TypeError, ValueError):
+            severity = None
+        if severity not in NSEVERITY_COLOR_MAP:
+            severity = None
+        recovery = str(pairs.get('status')).upper() == 'OK'
+
+        alerts = []
+        escalations = []
+
+        for room_args in split_destinations(args):
+            (action, escalate) = self.lookup(
+                room_args['room'],
+                severity,
+                recovery,
+            )
+
+            for destination in escalate:
+                (room, _, auth_token) = destination.partition('|')
+                escalated = dict(room_args)
+                escalated['room'] = room
+                escalated['auth_token'] = auth_token or room_args['auth_token']
+                escalations.append(escalated)
+
+            if action == 'silent':
+                if room_args['alert'].startswith('@all '):
+                    room_args['alert'] = room_args['alert'][5:]
+                room_args['notify'] = False
+            elif action == 'drop':
+                room_args['dropped'] = True
+            alerts.append(room_args)
+
+        rooms = set([room_args['room'] for room_args in alerts])
+        for escalated in escalations:
+            if escalated['room'] not in rooms:
+                rooms.add(escalated['room'])
+                alerts.append(escalated)
+
+        return join_destinations(alerts)
+
+
+def compile_routes(config):
+    """Compile routing rules into a lookup table.
+
+    ``config`` is a dict with ``rules``, a list of rules tried in order, the
+    first matching one deciding. A rule is a dict with the following keys,
+    all optional:
+
+    ========== ============================================================
+    key        value
+    rooms      List of rooms the rule applies to. Any room when not given.
+    severities List of ``nseverity`` values the rule applies to. Any
+               severity, including none, when not given.
+    status     ``OK`` or ``PROBLEM``, the status the rule applies to. Any
+               status when not given.
+    action     ``page``, ``silent`` or ``drop``. Defaults to ``page``.
+    escalate   List of rooms to page too, with ``|<auth_token>`` appended
+               unless the token of the room is to be used.
+    ========== ============================================================
+
+    Alerts matching no rule are paged. Rooms are names or IDs of up to 100
+    characters, as in ``destination``.
+
+    Args:
+        config (dict): Routing rules.
+
+    Returns:
+        dict. A tuple of the action and a tuple of the rooms to escalate to,
+        for every room named by a rule (None for any other room), every
+        severity (None for none) and both statuses (True for ``OK``).
+
+    Raises:
+        * ValueError: Raised when the rules are malformed.
+    """
+
+    if not isinstance(config, dict) or \
+            not isinstance(config.get('rules'), list):
+        raise ValueError('rules have to be a list')
+
+    rules = []
+    rooms = set([None])
+
+    for rule in config['rules']:
+        if not isinstance(rule, dict):
+            raise ValueError('rules have to be objects')
+        for key in rule:
+            if key not in ROUTING_KEYS:
+                raise ValueError('unknown key: %s' % key)
+
+        action = rule.get('action', 'page')
+        if action not in ROUTING_ACTIONS:
+            raise ValueError('unknown action: %s' % action)
+
+        rule_rooms = get_rule_list(rule, 'rooms')
+        if rule_rooms is not None:
+            rule_rooms = set([check_rule_room(room) for room in rule_rooms])
+            rooms.update(rule_rooms)
+
+        severities = get_rule_list(rule, 'severities')
+        if severities is not None:
+            for severity in severities:
+                if isinstance(severity, bool) or \
+                        not isinstance(severity, int) or \
+                        severity not in NSEVERITY_COLOR_MAP:
+                    raise ValueError('severities have to be from 0 to 5')
+            severities = set(severities)
+
+        recovery = None
+        if 'status' in rule:
+            recovery = str(rule['status']).upper() == 'OK'
+
+        escalate = []
+        for destination in get_rule_list(rule, 'escalate') or ():
+            if not isinstance(destination, STRING_TYPES):
+                raise ValueError('escalate has to be a list of strings')
+            (room, _, auth_token) = destination.partition('|')
+            room = check_rule_room(room.strip())
+            if auth_token.strip():
+                room = '%s|%s' % (room, auth_token.strip())
+            escalate.append(room)
+        escalate = tuple(escalate)
+
+        rules.append((rule_rooms, severities, recovery, (action, escalate)))
+
+    table = {}
+    for room in rooms:
+        for severity in [None] + sorted(NSEVERITY_COLOR_MAP):
+            for recovery in (False, True):
+                decision = ('page', ())
+                for (rule_rooms, severities, rule_recovery, rule_decision) \
+                        in rules:
+                    if rule_rooms is not None and room not in rule_rooms:
+                        continue
+                    if severities is not None and severity not in severities:
+                        continue
+                    if rule_recovery is not None and \
+                            rule_recovery != recovery:
+                        continue
+                    decision = rule_decision
+                    break
+                table[(room, severity, recovery)] = decision
+
+    return table
+
+
+def get_rule_list(rule, key):
+    """Get a list of a routing rule.
+
+    Args:
+        rule (dict): Routing rule.
+        key (str): Key of the list.
+
+    Returns:
+        list. The list, None when not given.
+
+    Raises:
+        * ValueError: Raised when the value is not a list.
+    """
+
+    value = rule.get(key)
+    if value is not None and not isinstance(value, list):
+        raise ValueError('%s has to be a list' % key)
+    return value
+
+
+def check_rule_room(room):
+    """Check a room of a routing rule.
+
+    Args:
+        room: Name or ID of the room.
+
+    Returns:
+        str. The room.
+
+    Raises:
+        * ValueError: Raised when the room is neither a string nor an
+          integer, or empty, or longer than 100 characters.
+    """
+
+    if isinstance(room, bool) or \
+            not isinstance(room, STRING_TYPES + (int,)):
+        raise ValueError('rooms have to be strings: %r' % (room,))
+    room = str(room)
+    if not room or len(room) > 100:
+        raise ValueError('rooms have to be 1 to 100 characters: %r' % room)
+    return room
+
+
+def load_router(path):
+    """Load routing rules, compiling them unless already compiled.
+
+    The table compiled from the JSON file in ``path`` is kept next to it in
+    ``<path>.cache`` along with the modification time and size of the file,
+    so that alert scripts load the table instead of compiling the rules
+    again until the file changes. Rules are compiled every time when the
+    cache can not be written.
+
+    Args:
+        path (str): Path of the JSON file holding the routing rules, as
+            described by :func:`compile_routes`.
+
+    Returns:
+        Router. Router applying the rules.
+
+    Raises:
+        * IOError: Raised when the file can not be read.
+        * ValueError: Raised when the rules are malformed.
+    """
+
+    import marshal
+
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+    cache_path = '%s.cache' % path
+
+    try:
+        with open(cache_path, 'rb') as stream:
+            (cached_key, table) = marshal.load(stream)
+        if tuple(cached_key) == key:
+            return Router(table)
+    except (EOFError, IOError, OSError, TypeError, ValueError):
+        pass
+
+    with open(path) as stream:
+        table = compile_routes(json.load(stream))
+
+    temporary_path = '%s.%d' % (cache_path, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as stream:
+            marshal.dump((key, table), stream)
+        os.rename(temporary_path, cache_path)
+    except (IOError, OSError):
+        pass
+
+    return Router(table)
+
+
+def get_router(options):
+    """Load the routing rules given by commandline options.
+
+    Exits with 2 when they can not be loaded.
+
+    Args:
+        options (optparse.Values): Options as returned by
+            :func:`get_options_and_arguments`.
+
+    Returns:
+        Router. Router applying the rules, None without ``--routing``.
+    """
+
+    if not options.routing:
+        return None
+
+    try:
+        return load_router(options.routing)
+    except (IOError, OSError, ValueError):
+        sys.stderr.write('Unusable --routing: %s\n' % sys.exc_info()[1])
+        sys.exit(2)
+
+
+def get_request(args, endpoint):
+    """Build request to send the alert to HipChat.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+
+    Returns:
+        HipChatRequest. Request ready to be opened.
+    """
+
+    return build_request(
+        get_room_url(endpoint, args),
+        args['auth_token'],
+        get_body(args),
+    )
+
+
+def get_room_url(endpoint, args):
+    """Get the URL of the endpoint for the room of an alert.
+
+    The room is the ID it was resolved to by :class:`RoomCache` if any,
+    URL-encoded so that any room name makes a valid URL.
+
+    Args:
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+        args (dict): Runtime parameters of the alert, for a single room.
+
+    Returns:
+        str. URL of the endpoint.
+    """
+
+    return endpoint % quote_room(args.get('room_id') or args['room'])
+
+
+ROOM_ID_PATTERN = re.compile(r'[0-9]+\Z')
+
+
+def quote_room(room):
+    """URL-encode a room for the path of a URL.
+
+    Room IDs are left as they are. Names are encoded in UTF-8, and every
+    character but letters, digits and ``_.-~`` is percent-encoded,
+    including ``/``.
+
+    Args:
+        room (str): ID or name of the room.
+
+    Returns:
+        str. URL-encoded room.
+    """
+
+    if ROOM_ID_PATTERN.match(room):
+        return room
+
+    import_http()
+
+    if not isinstance(room, bytes):
+        room = room.encode('utf-8')
+    return quote(room, safe='')
+
+
+def get_body(args):
+    """Serialize the alert into the JSON body of a request.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        bytes. JSON body of the request, as returned by :func:`dump_body`.
+    """
+
+    return PAYLOAD_ENCODER.encode(args)
+
+
+def dump_body(args):
+    """Serialize the alert into the JSON body of a request with ``json``.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        bytes. JSON body of the request.
+    """
+
+    json_body_dict = {}
+    json_body_dict['color'] = args['color']
+    json_body_dict['message'] = args['alert']
+    json_body_dict['notify'] = args['notify']
+    json_body_dict['message_format'] = 'text'
+    json_body_str = json.dumps(json_body_dict)
+    return json_body_str.encode('utf-8')
+
+
+class PayloadEncoder(object):
+    """Serialize alerts into JSON bodies from precompiled templates.
+
+    Everything in a body but the message depends on the color and whether
+    to notify only, so the body is serialized once for every combination
+    with a placeholder message, and split around it. Serializing an alert
+    then takes escaping the message and joining it with both parts, giving
+    the same bytes as :func:`dump_body`.
+
+    Only the colors :func:`parse_metadata` sets get a template; alerts of
+    any other color are serialized by :func:`dump_body`.
+    """
+
+    PLACEHOLDER = 'zabbix-media-hipchat-message'
+
+    COLORS = frozenset(list(NSEVERITY_COLOR_MAP.values()) + ['green'])
+
+    def __init__(self):
+        """Initialize encoder."""
+
+        self._templates = {}
+
+    def encode(self, args):
+        """Serialize the alert.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`.
+
+        Returns:
+            bytes. JSON body of the request.
+        """
+
+        key = (args['color'], args['notify'])
+        template = self._templates.get(key)
+
+        if template is None:
+            if args['color'] not in self.COLORS or \
+                    not isinstance(args['notify'], bool):
+                return dump_body(args)
+            template = self._compile(args['color'], args['notify'])
+            self._templates[key] = template
+
+        return template[0] + json.dumps(args['alert']).encode('utf-8') + \
+            template[1]
+
+    def _compile(self, color, notify):
+        body = dump_body({
+            'color': color,
+            'notify': notify,
+            'alert': self.PLACEHOLDER,
+        })
+        (prefix, _, suffix) = body.partition(
+            json.dumps(self.PLACEHOLDER).encode('utf-8'),
+        )
+        return (prefix, suffix)
+
+
+PAYLOAD_ENCODER = PayloadEncoder()
+
+
+def build_request(url, auth_token, body):
+    """Build request posting an already serialized body.
+
+    Args:
+        url (str): URL of the room notification API.
+        auth_token (str): Bearer token to authenticate API access.
+        body (bytes): JSON body of the request.
+
+    Returns:
+        HipChatRequest. Request ready to be opened.
+    """
+
+    import_http()
+
+    request = HipChatRequest(url)
+    request.add_data(body)
+    request.add_header('Authorization', 'Bearer %s' % auth_token)
+    request.add_header('Content-type', 'application/json')
+    return request
+
+
+def get_requests(args, endpoint):
+    """Build requests to send the alert to every room.
+
+    The body is serialized once and shared by every request, or once for
+    every message when rooms get messages of their own.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+
+    Returns:
+        list. A tuple of the room and the request for every room, in the
+        order of :func:`get_destinations`.
+    """
+
+    bodies = {}
+    requests = []
+
+    for room_args in split_destinations(args):
+        key = (room_args['alert'], room_args['color'], room_args['notify'])
+        if key not in bodies:
+            bodies[key] = get_body(room_args)
+
+        request = build_request(
+            get_room_url(endpoint, room_args),
+            room_args['auth_token'],
+            bodies[key],
+        )
+        requests.append((room_args['room'], request))
+
+    return requests
+
+
+def deliver(args, opener_director, endpoint):
+    """Send the alert to HipChat and report how it went.
+
+    Errors are reported in the returned dict instead of being raised, so that
+    the result can be handed over to another process as it is. Only alerts
+    to a single room are accepted; use :func:`deliver_all` for the others.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        opener_director: Object to open the request with, such as the one
+            returned by ``build_opener`` or a :class:`ConnectionPool`.
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+
+    Returns:
+        A dict as returned by :func:`send_request`.
+
+    Raises:
+        * ValueError: Raised when the alert is sent to more than one room.
+    """
+
+    if len(get_destinations(args)) > 1:
+        raise ValueError('deliver() sends to a single room, use deliver_all()')
+
+    with trace('deliver', get_trace_attributes(args)):
+        with trace('get_request'):
+            [(room, request)] = get_requests(args, endpoint)
+        return send_request(request, room, opener_director)
+
+
+def deliver_all(args, opener_director, endpoint, max_workers=8,
+                metrics=None):
+    """Send the alert to every room in parallel.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        opener_director: Object to open the requests with. Has to be safe to
+            share between threads when there are several rooms.
+        endpoint (str): URL of the API endpoint with ``%s`` for the room.
+        max_workers (int): Maximum number of requests in flight.
+        metrics (Metrics): Metrics to record the time building the requests
+            takes in. None not to record it.
+
+    Returns:
+        list. A dict as returned by :func:`send_request` for every room, in
+        the order of the rooms.
+    """
+
+    import_http()
+
+    with trace('deliver', get_trace_attributes(args)) as span:
+        started = time.time()
+        with trace('get_request'):
+            requests = get_requests(args, endpoint)
+        if metrics is not None:
+            metrics.observe('request', time.time() - started)
+
+        return send_all(requests, opener_director, max_workers, span)
+
+
+def send_all(requests, opener_director, max_workers=8, parent=None):
+    """Open requests in parallel.
+
+    Requests are pipelined instead when the opener can, that is when it has
+    ``open_many`` like :class:`PipeliningConnectionPool`.
+
+    Args:
+        requests (list): A tuple of the room and the request for every room,
+            as returned by :func:`get_requests`.
+        opener_director: Object to open the requests with. Has to be safe to
+            share between threads when there are several requests.
+        max_workers (int): Maximum number of requests in flight.
+        parent: Span to trace the requests under, as they are opened by
+            other threads. None for the current span.
+
+    Returns:
+        list. A dict as returned by :func:`send_request` for every request,
+        in order.
+    """
+
+    if len(requests) == 1:
+        (room, request) = requests[0]
+        return [send_request(request, room, opener_director, parent)]
+
+    if hasattr(opener_director, 'open_many'):
+        import_http()
+
+        started = time.time()
+        responses = opener_director.open_many([
+            request for (_, request) in requests
+        ])
+
+        results = []
+        for ((room, _), response) in zip(requests, responses):
+            with trace('open', {'hipchat.room': room}, parent, started,
+                       kind='client') as span:
+                results.append(get_result(room, response, started, span))
+        return results
+
+    results = [None] * len(requests)
+    pending = list(enumerate(requests))
+    lock = threading.Lock()
+
+    def send():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                (index, (room, request)) = pending.pop(0)
+            results[index] = send_request(
+                request,
+                room,
+                opener_director,
+                parent,
+            )
+
+    threads = []
+    for _ in range(min(max_workers, len(requests))):
+        thread = threading.Thread(target=send)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def send_request(request, room, opener_director, parent=None):
+    """Open request and report how it went.
+
+    Args:
+        request (Request): Request to open.
+        room (str): ID or name of the room the request is sent to.
+        opener_director: Object to open the request with.
+        parent: Span to trace the request under. None for the current span.
+
+    Returns:
+        A dict containing the following:
+
+        =================== ==============================================
+        key                 value
+        room (str)          ID or name of the room which the message is
+                            sent to.
+        status (int)        HTTP status of the response, None if there was
+                            none.
+        elapsed (float)     Seconds taken to get the response.
+        error (str)         Description of the failure, None on success.
+        retry_after (float) Seconds to wait before retrying, as told by the
+                            ``Retry-After`` header of an error response.
+                            None if there was none.
+        =================== ==============================================
+    """
+
+    import_http()
+
+    started = time.time()
+    with trace('open', {'hipchat.room': room}, parent, kind='client') as span:
+        try:
+            response = opener_director.open(request)
+        except URLError:
+            response = sys.exc_info()[1]
+        return get_result(room, response, started, span)
+
+
+def get_result(room, response, started, span=None):
+    """Report how opening a request went.
+
+    Args:
+        room (str): ID or name of the room the request was sent to.
+        response: Response to the request, or the ``HTTPError`` or
+            ``URLError`` opening it failed with.
+        started (float): Time the request was opened at.
+        span: Span to record the status or error in. None not to record it.
+
+    Returns:
+        A dict as returned by :func:`send_request`.
+    """
+
+    import_http()
+
+    dictionary = {}
+    status = None
+    error = None
+    retry_after = None
+
+    if isinstance(response, HTTPError):
+        status = response.code
+        error = str(response)
+        retry_after = get_retry_after(response)
+    elif isinstance(response, URLError):
+        error = str(response)
+    else:
+        status = response.getcode()
+
+    if span is not None:
+        if status is not None:
+            span.set_attribute('http.status_code', status)
+        if error:
+            span.set_error(error)
+    elapsed = time.time() - started
+
+    dictionary['room'] = room
+    dictionary['status'] = status
+    dictionary['elapsed'] = elapsed
+    dictionary['error'] = error
+    dictionary['retry_after'] = retry_after
+    return dictionary
+
+
+def get_retry_after(error):
+    """Get seconds to wait before retrying from an error response.
+
+    Only the delay-seconds form of ``Retry-After`` is understood, which is
+    what HipChat sends.
+
+    Args:
+        error (HTTPError): Error response.
+
+    Returns:
+        float. Seconds to wait, None if not told.
+    """
+
+    headers = getattr(error, 'hdrs', None)
+    if headers is None:
+        return None
+
+    value = headers.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def build_timed_opener(connect_timeout=None, timeout=None):
+    """Build an opener with a timeout for connecting and one for responding.
+
+    ``build_opener`` takes a single timeout, applying to connecting and to
+    every read alike. Connections of this opener get ``connect_timeout`` to
+    connect, and ``timeout`` for every read and write once connected. A
+    request timing out fails with ``URLError`` either way.
+
+    Args:
+        connect_timeout (float): Timeout in seconds for connecting, None for
+            the default timeout of sockets.
+        timeout (float): Timeout in seconds for each read and write once
+            connected, None to keep ``connect_timeout``.
+
+    Returns:
+        OpenerDirector. Opener for HTTP and HTTPS.
+    """
+
+    import_http()
+
+    try:
+        from urllib2 import HTTPHandler
+    except ImportError:
+        from urllib.request import HTTPHandler
+
+    def get_connection_class(base):
+        class TimedConnection(base):
+            def connect(self):
+                base.connect(self)
+                if timeout is not None:
+                    self.sock.settimeout(timeout)
+
+        return TimedConnection
+
+    def open_timed(handler, connection_class, request, **kwargs):
+        if connect_timeout is not None:
+            request.timeout = connect_timeout
+        try:
+            return handler.do_open(connection_class, request, **kwargs)
+        except URLError:
+            raise
+        except socket.error:
+            raise URLError(sys.exc_info()[1])
+
+    http_connection = get_connection_class(httplib.HTTPConnection)
+    https_connection = get_connection_class(httplib.HTTPSConnection)
+
+    class TimedHTTPHandler(HTTPHandler):
+        def http_open(self, request):
+            return open_timed(self, http_connection, request)
+
+    class TimedHTTPSHandler(HTTPSHandler):
+        def https_open(self, request):
+            return open_timed(
+                self,
+                https_connection,
+                request,
+                context=self._context,
+            )
+
+    return build_opener(TimedHTTPHandler(), TimedHTTPSHandler())
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP(S) connections.
+
+    Stands in for the ``OpenerDirector`` returned by ``build_opener``, but
+    keeps connections open after each response so that subsequent requests to
+    the same host skip the TCP and TLS handshake. Safe to share between
+    threads.
+
+    New TLS connections resume the last TLS session of their host, so that
+    reconnecting after the server closed an idle connection takes an
+    abbreviated handshake.
+    """
+
+    def __init__(self, maxsize=4, connect_timeout=None, timeout=None,
+                 metrics=None, resolver=None):
+        """Initialize pool.
+
+        Args:
+            maxsize (int): Number of idle connections kept per host.
+            connect_timeout (float): Timeout in seconds for connecting,
+                including the TLS handshake. None for the global default.
+            timeout (float): Timeout in seconds for each read and write once
+                connected. None for the global default.
+            metrics (Metrics): Metrics to record the time resolving the host,
+                connecting, the TLS handshake and the response take in. None
+                not to record them.
+            resolver (DNSCache): Cache to resolve hosts with. None to resolve
+                them for every connection.
+        """
+
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.metrics = metrics
+        self.resolver = resolver
+        self._idle = {}
+        self._sessions = {}
+        self._context = None
+        self._lock = threading.Lock()
+
+    def open(self, request):
+        """Send request over a pooled connection.
+
+        A request is retried on a fresh connection when a reused one turns
+        out to have been closed by the server while idle, that is when
+        sending the request fails, or when the connection is closed without
+        any response. Any other failure is not retried, as the server may
+        have already posted the notification.
+
+        Args:
+            request (Request): Request to send.
+
+        Returns:
+            addinfourl. Response with its body already read.
+
+        Raises:
+            * HTTPError: Raised when the response has an error status.
+            * URLError: Raised when the request could not be sent.
+        """
+
+        import_http()
+
+        url = request.get_full_url()
+        (scheme, netloc, path, query, _) = urlsplit(url)
+        key = (scheme, netloc)
+
+        if query:
+            path = '%s?%s' % (path, query)
+
+        headers = dict(request.header_items())
+
+        while True:
+            with trace('acquire_connection') as span:
+                (connection, reused) = self._acquire(key)
+                span.set_attribute('reused', reused)
+                if not reused and scheme == 'https':
+                    span.set_attribute(
+                        'tls.session_reused',
+                        getattr(connection.sock, 'session_reused', False),
+                    )
+            started = time.time()
+            try:
+                connection.request(
+                    request.get_method(),
+                    path or '/',
+                    request.get_data(),
+                    headers,
+                )
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    continue
+                raise URLError(sys.exc_info()[1])
+
+            try:
+                response = connection.getresponse()
+                body = response.read()
+            except httplib.BadStatusLine:
+                connection.close()
+                if reused:
+                    continue
+                raise URLError(sys.exc_info()[1])
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise URLError(sys.exc_info()[1])
+            break
+
+        if self.metrics is not None:
+            self.metrics.observe('response', time.time() - started)
+
+        self._remember_session(key, connection)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+        result = get_response(url, response, body)
+        if isinstance(result, HTTPError):
+            raise result
+
+        return result
+
+    def close(self):
+        """Close every idle connection."""
+
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _acquire(self, key):
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(key)
+            if connections:
+                return (connections.pop(), True)
+        finally:
+            self._lock.release()
+
+        kwargs = {}
+        if self.connect_timeout is not None:
+            kwargs['timeout'] = self.connect_timeout
+
+        (scheme, netloc) = key
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+            # A session can only be resumed with the context it was made by.
+            with self._lock:
+                if self._context is None:
+                    import ssl
+
+                    self._context = ssl.create_default_context()
+                    self._context.set_alpn_protocols(['http/1.1'])
+                kwargs['context'] = self._context
+                session = self._sessions.get(key)
+            if session is not None:
+                kwargs['context'] = TLSSessionContext(self._context, session)
+        else:
+            connection_class = httplib.HTTPConnection
+
+        connection = connection_class(netloc, **kwargs)
+
+        timings = {}
+        if (self.metrics is not None or self.resolver is not None) and \
+                hasattr(connection, '_create_connection'):
+            # Resolve and connect separately to time both, leaving the rest
+            # of connect() to the TLS handshake.
+            def create(address, timeout, source_address=None):
+                started = time.time()
+                if self.resolver is None:
+                    addresses = socket.getaddrinfo(
+                        address[0],
+                        address[1],
+                        0,
+                        socket.SOCK_STREAM,
+                    )
+                else:
+                    addresses = self.resolver.resolve(address[0], address[1])
+                timings['dns'] = time.time() - started
+                try:
+                    sock = create_connection(
+                        addresses,
+                        timeout,
+                        source_address,
+                    )
+                except socket.error:
+                    if self.resolver is None:
+                        raise
+                    # The cached addresses may be stale, look them up again.
+                    self.resolver.forget(address[0], address[1])
+                    addresses = self.resolver.resolve(address[0], address[1])
+                    sock = create_connection(
+                        addresses,
+                        timeout,
+                        source_address,
+                    )
+                timings['connect'] = time.time() - started - timings['dns']
+                return sock
+
+            connection._create_connection = create
+
+        started = time.time()
+        try:
+            connection.connect()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise URLError(sys.exc_info()[1])
+
+        if timings and self.metrics is not None:
+            for phase in ('dns', 'connect'):
+                self.metrics.observe(phase, timings[phase])
+            if scheme == 'https':
+                self.metrics.observe(
+                    'tls',
+                    time.time() - started - sum(timings.values()),
+                )
+
+        if self.timeout is not None:
+            connection.sock.settimeout(self.timeout)
+
+        return (connection, False)
+
+    def _remember_session(self, key, connection):
+        # TLS 1.3 sends the session ticket after the handshake, so the
+        # session is only resumable once a response has been read.
+        session = getattr(connection.sock, 'session', None)
+        if session is not None:
+            with self._lock:
+                self._sessions[key] = session
+
+    def _release(self, key, connection):
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                connection = None
+        finally:
+            self._lock.release()
+
+        if connection is not None:
+            connection.close()
+
+
+class PipeliningConnectionPool(ConnectionPool):
+    """Pool of keep-alive HTTP(S) connections pipelining requests.
+
+    :meth:`open_many` writes up to ``depth`` requests to the same host down a
+    single connection before reading any response (HTTP/1.1 pipelining), so
+    that sending an alert to many rooms takes one connection and about one
+    round trip instead of a connection per request in flight.
+
+    Requests left without a response when the server closes the connection
+    fail with ``URLError``, as the server may have posted their notification.
+    """
+
+    def __init__(self, maxsize=4, connect_timeout=None, timeout=None,
+                 metrics=None, resolver=None, depth=16):
+        """Initialize pool.
+
+        Args:
+            maxsize (int): Number of idle connections kept per host.
+            connect_timeout (float): Timeout in seconds for connecting,
+                including the TLS handshake. None for the global default.
+            timeout (float): Timeout in seconds for each read and write once
+                connected. None for the global default.
+            metrics (Metrics): Metrics to record the time resolving the host,
+                connecting, the TLS handshake and the responses take in. None
+                not to record them.
+            resolver (DNSCache): Cache to resolve hosts with. None to resolve
+                them for every connection.
+            depth (int): Maximum number of requests written to a connection
+                before reading their responses.
+        """
+
+        ConnectionPool.__init__(
+            self,
+            maxsize,
+            connect_timeout,
+            timeout,
+            metrics,
+            resolver,
+        )
+        self.depth = depth
+
+    def open_many(self, requests):
+        """Send requests, pipelining those to the same host.
+
+        Args:
+            requests (list): Requests to send.
+
+        Returns:
+            list. For every request, in order, either the response with its
+            body already read, or the ``HTTPError`` or ``URLError`` it failed
+            with.
+        """
+
+        import_http()
+
+        results = [None] * len(requests)
+        batches = {}
+        keys = []
+
+        for (index, request) in enumerate(requests):
+            (scheme, netloc, _, _, _) = urlsplit(request.get_full_url())
+            key = (scheme, netloc)
+            if key not in batches:
+                batches[key] = []
+                keys.append(key)
+            batches[key].append(index)
+
+        for key in keys:
+            indexes = batches[key]
+            for start in range(0, len(indexes), self.depth):
+                batch = indexes[start:start + self.depth]
+                responses = self._pipeline(
+                    key,
+                    [requests[index] for index in batch],
+                )
+                for (index, response) in zip(batch, responses):
+                    results[index] = response
+
+        return results
+
+    def _pipeline(self, key, requests):
+        (_, netloc) = key
+        data = b''.join([
+            format_request(request, netloc) for request in requests
+        ])
+
+        while True:
+            with trace('acquire_connection') as span:
+                try:
+                    (connection, reused) = self._acquire(key)
+                except URLError:
+                    return [sys.exc_info()[1]] * len(requests)
+                span.set_attribute('reused', reused)
+            started = time.time()
+            try:
+                connection.sock.sendall(data)
+            except socket.error:
+                connection.close()
+                if reused:
+                    continue
+                return [URLError(sys.exc_info()[1])] * len(requests)
+
+            (responses, error) = self._read_responses(connection, requests)
+            if responses or not reused or \
+                    not isinstance(error, httplib.BadStatusLine):
+                break
+            # Closed by the server while idle, without any response.
+            connection.close()
+
+        if self.metrics is not None:
+            self.metrics.observe('response', time.time() - started)
+
+        self._remember_session(key, connection)
+
+        if error is not None or len(responses) < len(requests) or \
+                responses[-1][0].will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+        results = []
+        for (index, request) in enumerate(requests):
+            if index < len(responses):
+                (response, body) = responses[index]
+                results.append(
+                    get_response(request.get_full_url(), response, body),
+                )
+            elif error is not None:
+                results.append(URLError(error))
+            else:
+                results.append(
+                    URLError('Connection closed before the response'),
+                )
+
+        return results
+
+    def _read_responses(self, connection, requests):
+        # Responses have to be read from a single buffered file, as each
+        # one may be read ahead into the buffer along with the previous one.
+        stream = PipelinedResponseFile(connection.sock.makefile('rb'))
+        responses = []
+
+        try:
+            for request in requests:
+                response = httplib.HTTPResponse(
+                    stream,
+                    method=request.get_method(),
+                )
+                try:
+                    response.begin()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    return (responses, sys.exc_info()[1])
+
+                responses.append((response, body))
+                if response.will_close:
+                    break
+        finally:
+            stream.fp.close()
+
+        return (responses, None)
+
+
+class PipelinedResponseFile(object):
+    """File of a pipelined connection, shared by the responses read from it.
+
+    Stands in for both the socket and the file ``HTTPResponse`` reads from,
+    and is left open when a response closes it.
+    """
+
+    def __init__(self, fp):
+        """Initialize file.
+
+        Args:
+            fp: Buffered file of the socket.
+        """
+
+        self.fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def makefile(self, *args, **kwargs):
+        """Get the file itself.
+
+        Returns:
+            PipelinedResponseFile. This file.
+        """
+
+        return self
+
+    def close(self):
+        """Leave the file open for the next response."""
+
+
+def format_request(request, host):
+    """Serialize request into an HTTP/1.1 message.
+
+    Args:
+        request (Request): Request to serialize.
+        host (str): Value of the ``Host`` header.
+
+    Returns:
+        bytes. Request line, headers and body of the request.
+    """
+
+    import_http()
+
+    (_, _, path, query, _) = urlsplit(request.get_full_url())
+    if query:
+        path = '%s?%s' % (path, query)
+
+    body = request.get_data() or b''
+
+    lines = [
+        '%s %s HTTP/1.1' % (request.get_method(), path or '/'),
+        'Host: %s' % host,
+        'Accept-Encoding: identity',
+        'Content-Length: %d' % len(body),
+    ]
+    for (name, value) in request.header_items():
+        lines.append('%s: %s' % (name, value))
+
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def get_response(url, response, body):
+    """Wrap a response the way ``urlopen`` does.
+
+    Args:
+        url (str): URL of the request.
+        response (httplib.HTTPResponse): Response, its body already read.
+        body (bytes): Body of the response.
+
+    Returns:
+        addinfourl. Response, unless it has an error status, in which case
+        the ``HTTPError`` to raise for it.
+    """
+
+    import_http()
+
+    if response.status >= 400:
+        return HTTPError(
+            url,
+            response.status,
+            response.reason,
+            response.msg,
+            BytesIO(body),
+        )
+
+    return addinfourl(BytesIO(body), response.msg, url, response.status)
+
+
+def create_connection(addresses, timeout, source_address=None):
+    """Connect to the first address accepting the connection.
+
+    Args:
+        addresses (list): Addresses as returned by ``socket.getaddrinfo``.
+        timeout (float): Timeout in seconds for connecting. None for the
+            global default.
+        source_address (tuple): Host and port to connect from. None for any.
+
+    Returns:
+        socket.socket. Connected socket.
+
+    Raises:
+        * socket.error: Raised when no address accepted the connection.
+    """
+
+    error = socket.error('getaddrinfo returns an empty list')
+
+    for address in addresses:
+        try:
+            return socket.create_connection(
+                address[4][:2],
+                timeout,
+                source_address,
+            )
+        except socket.error:
+            error = sys.exc_info()[1]
+
+    raise error
+
+
+class TLSSessionContext(object):
+    """``ssl.SSLContext`` resuming a TLS session for the sockets it wraps.
+
+    Anything but :meth:`wrap_socket` is left to the wrapped context. The
+    server does a full handshake instead when it no longer knows the session.
+    """
+
+    def __init__(self, context, session):
+        """Initialize context.
+
+        Args:
+            context (ssl.SSLContext): Context to wrap sockets with.
+            session (ssl.SSLSession): Session to resume.
+        """
+
+        self.context = context
+        self.session = session
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        """Wrap socket, resuming the session.
+
+        Args:
+            sock (socket.socket): Connected socket.
+
+        Returns:
+            ssl.SSLSocket. Socket as returned by the wrapped context.
+        """
+
+        kwargs.setdefault('session', self.session)
+        return self.context.wrap_socket(sock, *args, **kwargs)
+
+
+def update_state_file(path, function, write=True, prune=None):
+    """Read, and update, state shared between processes in a JSON file.
+
+    The file is locked while in use, exclusively when written, so that
+    every update is applied to the state left by the one before. A file
+    holding anything but a JSON object, e.g. one cut short, counts as
+    empty.
+
+    Args:
+        path (str): Path of the file. Created if missing.
+        function (callable): Function taking the state, a dict, to read or
+            update in place.
+        write (bool): Whether to write the state back. False to only read
+            it, under a shared lock.
+        prune (callable): Function taking the state to remove stale entries
+            from before it is written. None to write it as is.
+
+    Returns:
+        The return value of ``function``.
+
+    Raises:
+        * IOError, OSError: Raised when the file can not be opened.
+    """
+
+    import fcntl
+
+    state_file = open(path, 'a+')
+    try:
+        fcntl.flock(state_file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        state_file.seek(0)
+        try:
+            state = json.loads(state_file.read())
+        except ValueError:
+            state = {}
+        if not isinstance(state, dict):
+            state = {}
+
+        result = function(state)
+        if not write:
+            return result
+
+        if prune is not None:
+            prune(state)
+
+        state_file.seek(0)
+        state_file.truncate()
+        state_file.write(json.dumps(state))
+        state_file.flush()
+        return result
+    finally:
+        state_file.close()
+
+
+def prune_expired(entries):
+    """Remove the entries of a cache which have expired.
+
+    Args:
+        entries (dict): Dicts with ``expires``, the time they expire at, by
+            key.
+    """
+
+    now = time.time()
+    for key in list(entries):
+        if entries[key]['expires'] <= now:
+            del entries[key]
+
+
+class DNSCache(object):
+    """Cache of the addresses hosts resolve to.
+
+    Addresses are kept for ``ttl`` seconds, in memory, or in a file locked
+    while in use when ``path`` is given, so that every process using the
+    file, such as alert scripts launched one after another, shares them.
+    """
+
+    def __init__(self, ttl, path=None):
+        """Initialize cache.
+
+        Args:
+            ttl (float): Seconds to keep addresses for.
+            path (str): Path of the file keeping the addresses. None to keep
+                them in memory.
+
+        Raises:
+            * ValueError: Raised when ``ttl`` is not positive.
+        """
+
+        if ttl <= 0:
+            raise ValueError
+
+        self.ttl = ttl
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Get the addresses of a host, resolving it unless cached.
+
+        Args:
+            host (str): Host name or address.
+            port (int): Port to connect to.
+
+        Returns:
+            list. Addresses as returned by ``socket.getaddrinfo``.
+
+        Raises:
+            * socket.error: Raised when the host could not be resolved.
+        """
+
+        key = '%s:%s' % (host, port)
+        now = time.time()
+
+        def lookup(entries):
+            entry = entries.get(key)
+            if entry is not None and entry['expires'] > now:
+                return entry['addresses']
+            return None
+
+        addresses = self._update(lookup, write=False)
+        if addresses is not None:
+            return addresses
+
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        def store(entries):
+            entries[key] = {
+                'addresses': [
+                    [int(family), int(type_), proto, canonname, list(address)]
+                    for (family, type_, proto, canonname, address)
+                    in addresses
+                ],
+                'expires': now + self.ttl,
+            }
+
+        self._update(store)
+        return addresses
+
+    def forget(self, host, port):
+        """Drop the cached addresses of a host.
+
+        Args:
+            host (str): Host name or address.
+            port (int): Port to connect to.
+        """
+
+        key = '%s:%s' % (host, port)
+
+        def drop(entries):
+            entries.pop(key, None)
+
+        self._update(drop)
+
+    def _update(self, function, write=True):
+        with self._lock:
+            if self.path is None:
+                return function(self._entries)
+            return update_state_file(
+                self.path,
+                function,
+                write,
+                prune_expired,
+            )
+
+
+class RoomCache(object):
+    """Cache of the IDs of rooms given by name.
+
+    A room given by name is looked up once through the room API of HipChat,
+    at the endpoint cut short after the room (``/v2/room/<name>``), and its
+    ID is kept for ``ttl`` seconds, so that alerts are sent to a short URL
+    known to work. Rooms which do not exist are kept for ``negative_ttl``
+    seconds, during which alerts to them fail right away. Rooms which the
+    auth token is not allowed to look up, such as with a token only allowed
+    to send notifications, are kept as they are, and still sent to by name.
+
+    Entries are kept in memory, or in a file locked while in use when
+    ``path`` is given, so that every process using the file shares them.
+    Auth tokens are stored as hashes only.
+    """
+
+    def __init__(self, ttl, path=None, negative_ttl=60.0):
+        """Initialize cache.
+
+        Args:
+            ttl (float): Seconds to keep the ID of a room for.
+            path (str): Path of the file keeping the entries. None to keep
+                them in memory.
+            negative_ttl (float): Seconds to keep a room which does not
+                exist for.
+
+        Raises:
+            * ValueError: Raised when ``ttl`` is not positive.
+        """
+
+        if ttl <= 0:
+            raise ValueError
+
+        self.ttl = ttl
+        self.path = path
+        self.negative_ttl = min(ttl, negative_ttl)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, room, auth_token, opener_director, endpoint):
+        """Get the ID of a room, looking it up unless cached.
+
+        Args:
+            room (str): ID or name of the room.
+            auth_token (str): Bearer token to look the room up with.
+            opener_director: Object to open the request with.
+            endpoint (str): URL of the API endpoint with ``%s`` for the
+                room.
+
+        Returns:
+            str. ID of the room, or the room as given when it is an ID or
+            could not be looked up. None if the room does not exist.
+        """
+
+        import hashlib
+
+        if ROOM_ID_PATTERN.match(room):
+            return room
+
+        key = hashlib.sha1(
+            '\n'.join([endpoint, auth_token, room]).encode('utf-8'),
+        ).hexdigest()
+        now = time.time()
+
+        def lookup(entries):
+            entry = entries.get(key)
+            if entry is not None and entry['expires'] > now:
+                return entry
+            return None
+
+        entry = self._update(lookup, write=False)
+        if entry is not None:
+            return entry['id']
+
+        (room_id, ttl) = self._look_up(
+            room,
+            auth_token,
+            opener_director,
+            endpoint,
+        )
+
+        def store(entries):
+            entries[key] = {'id': room_id, 'expires': now + ttl}
+
+        if ttl:
+            self._update(store)
+        return room_id
+
+    def _look_up(self, room, auth_token, opener_director, endpoint):
+        import_http()
+
+        url = endpoint.partition('%s')[0] + quote_room(room)
+        request = HipChatRequest(url)
+        request.add_header('Authorization', 'Bearer %s' % auth_token)
+
+        with trace('look_up_room', {'hipchat.room': room}, kind='client'):
+            try:
+                response = opener_director.open(request)
+                room_id = json.loads(response.read().decode('utf-8'))['id']
+            except HTTPError:
+                status = sys.exc_info()[1].code
+                if status == 404:
+                    return (None, self.negative_ttl)
+                if status in (401, 403):
+                    return (room, self.ttl)
+                return (room, 0)
+            except (URLError, KeyError, TypeError, ValueError):
+                return (room, 0)
+
+        return (str(room_id), self.ttl)
+
+    def _update(self, function, write=True):
+        with self._lock:
+            if self.path is None:
+                return function(self._entries)
+            return update_state_file(
+                self.path,
+                function,
+                write,
+                prune_expired,
+            )
+
+
+class DeliveryRequestHandler(socketserver.StreamRequestHandler):
+    """Handle a client of the delivery daemon.
+
+    Clients write runtime parameters as returned by :func:`get_arguments`, as
+    a line of JSON each. Every line is answered by a line of JSON holding the
+    list returned by :meth:`Dispatcher.deliver`.
+    """
+
+    def handle(self):
+        """Deliver alerts until the client closes the connection."""
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            try:
+                args = json.loads(line.decode('utf-8'))
+                results = self.server.dispatcher.deliver(args)
+            except (KeyError, TypeError, ValueError):
+                results = [{
+                    'room': None,
+                    'status': None,
+                    'elapsed': 0.0,
+                    'error': 'Malformed request: %s' % sys.exc_info()[1],
+                }]
+
+            self.wfile.write((json.dumps(results) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class DeliveryServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """Delivery daemon listening on a unix socket.
+
+    Alerts of every client are sent through one shared :class:`Dispatcher`,
+    typically with a :class:`ConnectionPool`, so that the connections to
+    HipChat outlive the short-lived alert scripts.
+
+    Clients being served are counted, so that :meth:`wait_idle` can wait for
+    the alerts being delivered when the daemon stops. Worker processes
+    forked by :func:`supervise` serve clients of the socket they inherit,
+    which they leave in place when closing it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, dispatcher):
+        """Bind to the socket.
+
+        A socket file left over by a previous daemon is removed first, that
+        is when nothing accepts connections on it.
+
+        Args:
+            socket_path (str): Path of the unix socket to listen on.
+            dispatcher (Dispatcher): Dispatcher to deliver alerts with.
+
+        Raises:
+            * socket.error: Raised when another daemon listens on the socket.
+        """
+
+        self.dispatcher = dispatcher
+        self.active = 0
+        self.idle = threading.Condition()
+        self.pid = os.getpid()
+
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                if sys.exc_info()[1].errno != errno.ECONNREFUSED:
+                    raise
+                os.unlink(socket_path)
+            else:
+                raise socket.error(
+                    errno.EADDRINUSE,
+                    'Delivery daemon already listens on %s' % socket_path,
+                )
+            finally:
+                probe.close()
+
+        socketserver.UnixStreamServer.__init__(
+            self,
+            socket_path,
+            DeliveryRequestHandler,
+        )
+
+    def get_request(self):
+        """Accept a client.
+
+        The listening socket is non-blocking when shared by worker processes,
+        so that those losing the race for a client do not block in
+        ``accept``. The connection to the client blocks either way.
+
+        Returns:
+            A tuple of the socket connected to the client and its address.
+        """
+
+        (request, client_address) = self.socket.accept()
+        request.setblocking(True)
+        return (request, client_address)
+
+    def process_request(self, request, client_address):
+        """Serve a client in a thread of its own, counting it as active."""
+
+        with self.idle:
+            self.active += 1
+        try:
+            socketserver.ThreadingMixIn.process_request(
+                self,
+                request,
+                client_address,
+            )
+        except Exception:
+            self._release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        """Serve a client, then stop counting it as active."""
+
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                self,
+                request,
+                client_address,
+            )
+        finally:
+            self._release()
+
+    def wait_idle(self, timeout=None):
+        """Wait until no client is being served.
+
+        Args:
+            timeout (float): Maximum seconds to wait. None to wait as long as
+                it takes.
+
+        Returns:
+            bool. True when no client is being served, False on timeout.
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.idle:
+            while self.active:
+                if deadline is None:
+                    self.idle.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+
+        return True
+
+    def server_close(self):
+        """Stop listening, and remove the socket file.
+
+        The socket file is only removed by the process which bound it, and
+        not by the worker processes it forked.
+        """
+
+        socketserver.UnixStreamServer.server_close(self)
+        if os.getpid() == self.pid and os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+    def _release(self):
+        with self.idle:
+            self.active -= 1
+            self.idle.notify_all()
+
+
+def serve(socket_path, dispatcher, metrics_address=None, drain_timeout=30.0):
+    """Run the delivery daemon until terminated or interrupted.
+
+    Args:
+        socket_path (str): Path of the unix socket to listen on.
+        dispatcher (Dispatcher): Dispatcher to deliver alerts with.
+        metrics_address (str): ``[HOST:]PORT`` to serve the metrics of the
+            dispatcher to Prometheus on. None not to serve them.
+        drain_timeout (float): Maximum seconds to wait for the alerts being
+            delivered once terminated, as for :func:`run_daemon`.
+    """
+
+    server = bind_daemon(socket_path, dispatcher)
+
+    if metrics_address:
+        metrics_address = parse_address(metrics_address)
+
+    run_daemon(server, metrics_address, drain_timeout)
+
+
+def bind_daemon(socket_path, dispatcher=None):
+    """Bind the socket of the delivery daemon, exiting on failure.
+
+    Args:
+        socket_path (str): Path of the unix socket to listen on.
+        dispatcher (Dispatcher): Dispatcher to deliver alerts with. None
+            when set by every worker process.
+
+    Returns:
+        DeliveryServer. The daemon, bound to the socket.
+    """
+
+    if not socket_path:
+        sys.stderr.write('--serve requires --socket\n')
+        sys.exit(2)
+
+    try:
+        return DeliveryServer(socket_path, dispatcher)
+    except socket.error:
+        sys.stderr.write(str(sys.exc_info()[1]) + '\n')
+        sys.exit(1)
+
+
+def run_daemon(server, metrics_address=None, drain_timeout=30.0):
+    """Serve the clients of the delivery daemon until terminated.
+
+    When the dispatcher has an outbox, alerts due for a retry are sent by a
+    background thread meanwhile. On SIGTERM, or when interrupted, the daemon
+    stops accepting clients and waits for the alerts being delivered before
+    closing the dispatcher, which sends the alerts waiting in the coalescer.
+
+    Args:
+        server (DeliveryServer): Daemon bound to its socket, with its
+            dispatcher.
+        metrics_address (tuple): Host and port to serve the metrics of the
+            dispatcher to Prometheus on. None not to serve them.
+        drain_timeout (float): Maximum seconds to wait for the alerts being
+            delivered. Clients still connected afterwards are cut off.
+    """
+
+    import signal
+
+    dispatcher = server.dispatcher
+    stopping = threading.Event()
+
+    metrics_server = None
+    if metrics_address and dispatcher.metrics is not None:
+        try:
+            metrics_server = serve_metrics(metrics_address, dispatcher.metrics)
+        except socket.error:
+            sys.stderr.write(str(sys.exc_info()[1]) + '\n')
+            server.server_close()
+            sys.exit(1)
+
+    if dispatcher.outbox is not None:
+        drainer = threading.Thread(
+            target=drain_forever,
+            args=(dispatcher, stopping),
+        )
+        drainer.daemon = True
+        drainer.start()
+
+    def terminate(signum, frame):
+        # shutdown() waits for serve_forever() to return, which it can not
+        # in the thread running it, where signal handlers run.
+        threading.Thread(target=server.shutdown).start()
+
+    try:
+        previous = signal.signal(signal.SIGTERM, terminate)
+    except ValueError:
+        # Signal handlers can only be set in the main thread.
+        previous = None
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
+        stopping.set()
+        server.server_close()
+        if not server.wait_idle(drain_timeout):
+            sys.stderr.write(
+                'Gave up waiting for %d clients after %r seconds\n' % (
+                    server.active,
+                    drain_timeout,
+                )
+            )
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        dispatcher.close()
+
+
+def supervise(socket_path, workers, dispatcher_factory, metrics_address=None,
+              drain_timeout=30.0, restart_delay=1.0):
+    """Run the delivery daemon as worker processes until terminated.
+
+    The socket is bound once, and every worker forked afterwards accepts
+    clients from it in turn, so that the backlog of the socket is the queue
+    they share. Every worker builds a dispatcher of its own, and with it its
+    own connections. Workers which exit are forked again, after
+    ``restart_delay`` seconds if they failed. On SIGTERM, or when
+    interrupted, every worker is terminated, and stops as the daemon does
+    in :func:`run_daemon`, before the socket is removed.
+
+    Args:
+        socket_path (str): Path of the unix socket to listen on.
+        workers (int): Number of worker processes.
+        dispatcher_factory (callable): Function returning the dispatcher of
+            a worker. Called once before forking, and the dispatcher closed
+            right away, so that malformed options stop the daemon rather
+            than every worker.
+        metrics_address (str): ``[HOST:]PORT`` to serve the metrics of the
+            first worker to Prometheus on. Every further worker serves its
+            own on the following port.
+        drain_timeout (float): Maximum seconds for every worker to wait for
+            the alerts being delivered once terminated.
+        restart_delay (float): Seconds to wait before forking a worker
+            again when it failed.
+    """
+
+    import signal
+
+    dispatcher_factory().close()
+
+    server = bind_daemon(socket_path)
+    server.socket.setblocking(False)
+
+    if metrics_address:
+        metrics_address = parse_address(metrics_address)
+
+    children = {}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def start(index):
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            server.dispatcher = dispatcher_factory()
+            address = None
+            if metrics_address:
+                address = (metrics_address[0], metrics_address[1] + index)
+            run_daemon(server, address, drain_timeout)
+            status = 0
+        except SystemExit:
+            code = sys.exc_info()[1].code
+            status = code if isinstance(code, int) else 1
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    previous = [
+        (signum, signal.signal(signum, stop))
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    ]
+
+    try:
+        for index in range(workers):
+            start(index)
+
+        while children:
+            try:
+                (pid, status) = os.waitpid(-1, 0)
+            except OSError:
+                if sys.exc_info()[1].errno == errno.EINTR:
+                    continue
+                raise
+
+            index = children.pop(pid, None)
+            if index is None or stopping:
+                continue
+
+            if status:
+                if os.WIFSIGNALED(status):
+                    reason = 'was killed by signal %d' % os.WTERMSIG(status)
+                else:
+                    reason = 'exited with %d' % os.WEXITSTATUS(status)
+                sys.stderr.write(
+                    'Worker %d %s, restarting\n' % (index, reason)
+                )
+                time.sleep(restart_delay)
+                if stopping:
+                    continue
+            start(index)
+    finally:
+        for (signum, handler) in previous:
+            signal.signal(signum, handler)
+        server.server_close()
+
+
+def drain_forever(dispatcher, stopping, interval=1.0):
+    """Retry alerts of the outbox as they become due until stopped.
+
+    Args:
+        dispatcher (Dispatcher): Dispatcher with an outbox.
+        stopping (threading.Event): Event set to stop.
+        interval (float): Maximum seconds to wait between checks.
+    """
+
+    while not stopping.is_set():
+        dispatcher.drain()
+        next_due = dispatcher.outbox.next_due()
+        if next_due is None:
+            delay = interval
+        else:
+            delay = min(interval, max(0.0, next_due - time.time()))
+        stopping.wait(delay)
+
+
+def send_to_daemon(socket_path, args, connect_timeout=None, timeout=None):
+    """Hand the alert over to the delivery daemon.
+
+    Only failing to hand the alert over is raised. Once the request has been
+    written, the daemon may have sent the alert already, so failing to get
+    the results is reported as an error of every room instead, for the
+    caller not to send the alert again.
+
+    Args:
+        socket_path (str): Path of the unix socket the daemon listens on.
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        connect_timeout (float): Timeout in seconds for connecting and
+            writing the request. None to block.
+        timeout (float): Timeout in seconds for the results. None to block.
+
+    Returns:
+        A list as returned by :func:`deliver_all`.
+
+    Raises:
+        * socket.error: Raised when the alert could not be handed over.
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(connect_timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps(args) + '\n').encode('utf-8'))
+
+        started = time.time()
+        try:
+            client.settimeout(timeout)
+            line = client.makefile('rb').readline()
+            if not line:
+                raise socket.error('Delivery daemon closed the connection')
+            return json.loads(line.decode('utf-8'))
+        except (socket.error, ValueError):
+            error = 'Delivery daemon failed: %s' % sys.exc_info()[1]
+            return [
+                {
+                    'room': destination['room'],
+                    'status': None,
+                    'elapsed': time.time() - started,
+                    'error': error,
+                }
+                for destination in get_destinations(args)
+            ]
+    finally:
+        client.close()
+
+
+class AsyncSender(object):
+    """Send alerts concurrently from asyncio code.
+
+    Requests are built with :func:`get_requests` and opened in a pool of
+    threads, as the underlying ``opener_director`` blocks. At most ``limit``
+    requests are in flight at a time, and requests to the same room are sent
+    one after another in the order :meth:`send` was called, so that they show
+    up in the room in that order.
+
+    Requires ``asyncio`` and ``concurrent.futures`` (Python 3.4 or later).
+    Methods must be called from the thread running the event loop.
+    """
+
+    def __init__(self, opener_director, endpoint=API_ENDPOINT_ROOM, limit=10,
+                 loop=None):
+        """Initialize sender.
+
+        ``asyncio`` is imported here rather than along with the module, as
+        it would add tens of milliseconds to every run of the alert script.
+
+        Args:
+            opener_director: Object to open requests with. Has to be safe to
+                share between threads, such as a :class:`ConnectionPool`,
+                whose ``maxsize`` is raised to ``limit`` so that connections
+                of a burst are kept for the next one.
+            endpoint (str): URL of the API endpoint with ``%s`` for the room.
+            limit (int): Maximum number of requests in flight.
+            loop: Event loop to use. Defaults to the current event loop.
+
+        Raises:
+            * RuntimeError: Raised when asyncio is not available.
+        """
+
+        # pylint: disable=import-error
+        try:
+            import asyncio
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            raise RuntimeError('AsyncSender requires asyncio')
+        # pylint: enable=import-error
+
+        if isinstance(opener_director, ConnectionPool):
+            opener_director.maxsize = max(opener_director.maxsize, limit)
+
+        self._asyncio = asyncio
+        self.opener_director = opener_director
+        self.endpoint = endpoint
+        self.limit = limit
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=limit)
+        self._tails = {}
+
+    def send(self, args):
+        """Schedule the alert to be sent to every room.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`.
+
+        Returns:
+            asyncio.Future. Resolves to the list returned by
+            :func:`deliver_all`.
+        """
+
+        loop = self._loop or self._asyncio.get_event_loop()
+        futures = [
+            self._send_request(loop, room, request)
+            for (room, request) in get_requests(args, self.endpoint)
+        ]
+        return self._asyncio.gather(*futures)
+
+    def send_many(self, args_list):
+        """Schedule every alert to be sent.
+
+        Args:
+            args_list (list): Dicts as returned by :func:`get_arguments`.
+
+        Returns:
+            asyncio.Future. Resolves to the list of lists returned by
+            :func:`deliver_all`, in the order of ``args_list``.
+        """
+
+        futures = [self.send(args) for args in args_list]
+        if not futures:
+            loop = self._loop or self._asyncio.get_event_loop()
+            future = loop.create_future()
+            future.set_result([])
+            return future
+        return self._asyncio.gather(*futures)
+
+    def _send_request(self, loop, room, request):
+        future = loop.create_future()
+
+        previous = self._tails.get(room)
+        self._tails[room] = future
+
+        def start(_=None):
+            delivery = loop.run_in_executor(
+                self._executor,
+                send_request,
+                request,
+                room,
+                self.opener_director,
+            )
+            delivery.add_done_callback(
+                lambda delivery: self._finish(room, future, delivery)
+            )
+
+        if previous is None or previous.done():
+            start()
+        else:
+            previous.add_done_callback(start)
+
+        return future
+
+    def close(self):
+        """Wait for alerts in flight and release the threads."""
+
+        self._executor.shutdown(wait=True)
+
+    def _finish(self, room, future, delivery):
+        if self._tails.get(room) is future:
+            del self._tails[room]
+
+        if future.cancelled():
+            return
+
+        if delivery.exception() is not None:
+            future.set_exception(delivery.exception())
+        else:
+            future.set_result(delivery.result())
+
+
+def get_color_severity(color):
+    """Rank background color of a message by severity.
+
+    Colors rank as the highest ``nseverity`` they stand for, and green, the
+    color of recoveries, below all of them.
+
+    Args:
+        color (str): Background color of the message.
+
+    Returns:
+        int. Rank of the color, higher for more severe.
+    """
+
+    severity = -1
+    for (nseverity, nseverity_color) in NSEVERITY_COLOR_MAP.items():
+        if nseverity_color == color:
+            severity = max(severity, nseverity)
+    return severity
+
+
+def get_severity(args):
+    """Rank an alert by severity.
+
+    Args:
+        args (dict): Runtime parameters of the alert.
+
+    Returns:
+        int. ``nseverity`` of the alert, or the rank of its background color
+        by :func:`get_color_severity` when not given. -1 for recoveries.
+    """
+
+    severity = get_color_severity(args.get('color'))
+    if severity < 0:
+        return severity
+    nseverity = args.get('nseverity')
+    if nseverity in NSEVERITY_COLOR_MAP and not isinstance(nseverity, bool):
+        return nseverity
+    return severity
+
+
+def merge_alerts(alerts):
+    """Merge alerts to a room into a digest.
+
+    The digest starts with the number of alerts by background color, most
+    severe first, followed by every alert on a line of its own for as long
+    as the digest fits within the message length limit of HipChat. It takes
+    the most severe background color and ``nseverity`` of the alerts, and
+    triggers notifications if any of the alerts does. It has neither
+    ``eventid`` nor ``triggerid``, so that the recovery of one of the
+    alerts does not cancel the others along with it.
+
+    Args:
+        alerts (list): Runtime parameters of alerts to the same room.
+
+    Returns:
+        dict. Runtime parameters of the digest. The alert itself when there
+        is only one.
+    """
+
+    if len(alerts) == 1:
+        return alerts[0]
+
+    counts = {}
+    for alert in alerts:
+        counts[alert['color']] = counts.get(alert['color'], 0) + 1
+
+    colors = sorted(counts, key=get_color_severity, reverse=True)
+
+    header = '@all %d alerts (%s)' % (
+        len(alerts),
+        ', '.join(['%s: %d' % (color, counts[color]) for color in colors]),
+    )
+
+    lines = [header]
+    length = len(header)
+    reserve = len('\n... and %d more' % len(alerts))
+
+    for (index, alert) in enumerate(alerts):
+        line = alert['alert']
+        if line.startswith('@all '):
+            line = line[len('@all '):]
+        line = '- ' + line
+
+        available = MESSAGE_LIMIT - 1 - length - 1 - reserve
+        if len(line) > available:
+            if index == 0:
+                lines.append(line[:available - len(' ...')] + ' ...')
+                index += 1
+            lines.append('... and %d more' % (len(alerts) - index))
+            break
+
+        lines.append(line)
+        length += 1 + len(line)
+
+    dictionary = dict(alerts[0])
+    dictionary['color'] = colors[0]
+    for key in ('nseverity', 'eventid', 'triggerid'):
+        dictionary.pop(key, None)
+    severity = max([get_severity(alert) for alert in alerts])
+    if severity >= 0:
+        dictionary['nseverity'] = severity
+    dictionary['notify'] = True in [alert['notify'] for alert in alerts]
+    dictionary['alert'] = '\n'.join(lines)
+    return dictionary
+
+
+class Coalescer(object):
+    """Merge alerts to the same room arriving within a window into a digest.
+
+    The first alert to a room opens a window of ``window`` seconds. Alerts to
+    the same room arriving meanwhile are merged with it by
+    :func:`merge_alerts`, and the result is sent when the window closes.
+    Problems resolved within the window can be taken back by :meth:`cancel`.
+    """
+
+    def __init__(self, deliver, window):
+        """Initialize coalescer.
+
+        Args:
+            deliver: Function sending runtime parameters of an alert and
+                returning the list of results, such as
+                :meth:`Dispatcher.deliver_now`.
+            window (float): Seconds to wait for more alerts.
+        """
+
+        self.deliver = deliver
+        self.window = window
+        self._pending = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def add(self, args):
+        """Add an alert to a single room.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`, for a single room.
+        """
+
+        key = (args['room'], args['auth_token'])
+        alert = (time.time(), args)
+
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append(alert)
+                return
+
+            self._pending[key] = [alert]
+            timer = threading.Timer(self.window, self._flush, (key,))
+            timer.daemon = True
+            self._timers[key] = timer
+            timer.start()
+
+    def cancel(self, args):
+        """Take back the pending problems a recovery resolves.
+
+        Args:
+            args (dict): Runtime parameters of the recovery, for a single
+                room.
+
+        Returns:
+            float. Time the earliest problem taken back was added, None if
+            there was none.
+        """
+
+        key = (args['room'], args['auth_token'])
+        pair_key = get_pair_key(args)
+        added = None
+
+        with self._lock:
+            alerts = self._pending.get(key, [])
+            kept = []
+            for alert in alerts:
+                if is_recovery(alert[1]) or \
+                        get_pair_key(alert[1]) != pair_key:
+                    kept.append(alert)
+                elif added is None or alert[0] < added:
+                    added = alert[0]
+
+            if added is not None:
+                if kept:
+                    self._pending[key] = kept
+                else:
+                    del self._pending[key]
+                    self._timers.pop(key).cancel()
+
+        return added
+
+    def flush(self):
+        """Send every pending alert right away."""
+
+        with self._lock:
+            keys = list(self._pending)
+            for key in keys:
+                self._timers[key].cancel()
+
+        for key in keys:
+            self._flush(key)
+
+    def __len__(self):
+        with self._lock:
+            return sum([len(alerts) for alerts in self._pending.values()])
+
+    def _flush(self, key):
+        with self._lock:
+            alerts = self._pending.pop(key, None)
+            self._timers.pop(key, None)
+
+        if not alerts:
+            return
+
+        alerts = [alert[1] for alert in alerts]
+        for result in self.deliver(merge_alerts(alerts)):
+            if result['error'] and not result.get('queued'):
+                sys.stderr.write(
+                    'Failed to send %d alerts to %s: %s\n' % (
+                        len(alerts),
+                        result['room'],
+                        result['error'],
+                    )
+                )
+
+
+def add_repetitions(args, repeated):
+    """Tell in the alert how many times it was repeated.
+
+    The message is truncated as needed for the note to fit within the
+    message length limit of HipChat.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        repeated (int): Number of repetitions suppressed.
+
+    Returns:
+        dict. Runtime parameters with the note appended to the message.
+    """
+
+    return append_note(args, '\n(repeated %d times)' % repeated)
+
+
+def add_resolution(args, seconds):
+    """Tell in a recovery that its problem was never sent.
+
+    The message is truncated as needed for the note to fit within the
+    message length limit of HipChat.
+
+    Args:
+        args (dict): Runtime parameters of the recovery as returned by
+            :func:`get_arguments`.
+        seconds (float): Seconds between the problem and the recovery.
+
+    Returns:
+        dict. Runtime parameters with the note appended to the message.
+    """
+
+    return append_note(
+        args,
+        '\n(resolved after %ds, before the problem was sent)' % seconds,
+    )
+
+
+def append_note(args, suffix):
+    """Append a note to the alert, truncating the message to fit.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+        suffix (str): Note to append.
+
+    Returns:
+        dict. Runtime parameters with the note appended to the message.
+    """
+
+    alert = args['alert']
+
+    limit = MESSAGE_LIMIT - 1 - len(suffix)
+    if len(alert) > limit:
+        alert = alert[:limit - len(' ...')] + ' ...'
+
+    dictionary = dict(args)
+    dictionary['alert'] = alert + suffix
+    return dictionary
+
+
+def get_pair_key(args):
+    """Get the key pairing a recovery with its problem.
+
+    Zabbix gives a recovery the ``{EVENT.ID}`` of the problem it resolves,
+    so alerts pair by ``eventid``, or by ``triggerid`` when not given.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        str. ``eventid:<ID>`` or ``triggerid:<ID>``. None if the alert has
+        neither.
+    """
+
+    for name in ('eventid', 'triggerid'):
+        if args.get(name):
+            return '%s:%s' % (name, args[name])
+    return None
+
+
+def is_recovery(args):
+    """Tell whether the alert is a recovery.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        bool. True for a recovery, whose message is green.
+    """
+
+    return args['color'] == 'green'
+
+
+class Deduplicator(object):
+    """Suppress alerts repeating one sent to the same room within a TTL.
+
+    Alerts are keyed by a hash of the room and the body of the request
+    sending them, so that an alert repeats another only when its request
+    would be the same. An alert sent opens a window of ``ttl`` seconds,
+    within which its repetitions are suppressed and counted. The count is
+    returned for the first repetition after the window, which opens the
+    next one.
+
+    Entries are kept in a set-associative table: an alert may only be kept
+    in one of :attr:`WAYS` slots picked by its hash, replacing the least
+    recently seen of them when they are all taken. The table is kept in
+    memory, or in a memory-mapped file locked while in use when ``path`` is
+    given, so that every process mapping the file shares it. A file of
+    another size is replaced rather than truncated, as processes may still
+    have it mapped.
+    """
+
+    WAYS = 8
+
+    SLOT_FORMAT = '<16sddI'
+
+    def __init__(self, ttl, path=None, slots=4096):
+        """Initialize deduplicator.
+
+        Args:
+            ttl (float): Seconds within which alerts are repetitions.
+            path (str): Path of the file keeping the table. None to keep it
+                in memory.
+            slots (int): Number of alerts kept.
+
+        Raises:
+            * ValueError: Raised when the TTL is not positive or there are
+              less slots than :attr:`WAYS`.
+        """
+
+        import mmap
+        import struct
+
+        if ttl <= 0 or slots < self.WAYS:
+            raise ValueError
+
+        self.ttl = ttl
+        self.path = path
+        self.buckets = slots // self.WAYS
+        self._slot = struct.Struct(self.SLOT_FORMAT)
+        self._lock = threading.Lock()
+        self._file = None
+
+        size = self.buckets * self.WAYS * self._slot.size
+
+        if path is None:
+            self._table = mmap.mmap(-1, size)
+            return
+
+        self._file = os.fdopen(
+            os.open(path, os.O_RDWR | os.O_CREAT, 0o600),
+            'r+b',
+        )
+
+        import fcntl
+
+        locked = self._file
+        fcntl.flock(locked, fcntl.LOCK_EX)
+        try:
+            current_size = os.fstat(locked.fileno()).st_size
+            if not current_size:
+                self._file.truncate(size)
+            elif current_size != size:
+                # Tables of another size are laid out differently. Processes
+                # still mapping it would get SIGBUS past the end of the file
+                # if it were truncated, so a new one takes its place.
+                self._replace(size)
+            self._table = mmap.mmap(self._file.fileno(), size)
+        finally:
+            fcntl.flock(locked, fcntl.LOCK_UN)
+            if locked is not self._file:
+                locked.close()
+
+    def check(self, args):
+        """Record the alert and tell whether to send it.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`, for a single room.
+
+        Returns:
+            int. Number of repetitions suppressed since the alert was last
+            sent, to tell in the alert. None when the alert is a repetition
+            to suppress.
+        """
+
+        import hashlib
+
+        key = hashlib.sha1(args['room'].encode('utf-8'))
+        key.update(b'\n')
+        key.update(get_body(args))
+
+        digest = key.digest()[:16]
+        bucket = int(key.hexdigest()[:8], 16) % self.buckets
+        now = time.time()
+
+        with self._lock:
+            if self._file is None:
+                return self._check(digest, bucket, now)
+
+            import fcntl
+
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                return self._check(digest, bucket, now)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def close(self):
+        """Release the table."""
+
+        self._table.close()
+        if self._file is not None:
+            self._file.close()
+
+    def _check(self, digest, bucket, now):
+        victim = None
+
+        for way in range(self.WAYS):
+            offset = (bucket * self.WAYS + way) * self._slot.size
+            (slot_digest, sent, seen, repeated) = self._slot.unpack_from(
+                self._table,
+                offset,
+            )
+
+            if slot_digest == digest:
+                if now - sent < self.ttl:
+                    self._slot.pack_into(
+                        self._table,
+                        offset,
+                        digest,
+                        sent,
+                        now,
+                        repeated + 1,
+                    )
+                    return None
+
+                self._slot.pack_into(self._table, offset, digest, now, now, 0)
+                return repeated
+
+            if victim is None or seen < victim[1]:
+                victim = (offset, seen)
+
+        self._slot.pack_into(self._table, victim[0], digest, now, now, 0)
+        return 0
+
+    def _replace(self, size):
+        import tempfile
+
+        (descriptor, temporary) = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + '.',
+            dir=os.path.dirname(os.path.abspath(self.path)),
+        )
+        replacement = os.fdopen(descriptor, 'r+b')
+        try:
+            replacement.truncate(size)
+            os.rename(temporary, self.path)
+        except (IOError, OSError):
+            replacement.close()
+            os.unlink(temporary)
+            raise
+        self._file = replacement
+
+
+class RateLimiter(object):
+    """Token bucket per auth token, pacing requests under the API quota.
+
+    Every auth token has a bucket of ``requests`` tokens refilled over
+    ``seconds``. A request takes a token, waiting for one if the bucket is
+    empty; waiting requests take tokens in advance, so that they are spread
+    over time rather than all going at once.
+
+    Buckets are kept in memory, or in a file locked while in use when
+    ``path`` is given, so that every process using the file shares them.
+    Auth tokens are stored as hashes only.
+
+    :meth:`calibrate` corrects a bucket with what the ``X-Ratelimit-*``
+    headers of a response tell, as other clients may use the same token.
+    """
+
+    def __init__(self, requests, seconds, path=None):
+        """Initialize limiter.
+
+        Args:
+            requests (int): Number of requests allowed per ``seconds``.
+            seconds (float): Period of the quota.
+            path (str): Path of the file keeping the buckets. None to keep
+                them in memory.
+
+        Raises:
+            * ValueError: Raised when the quota is not positive.
+        """
+
+        if requests <= 0 or seconds <= 0:
+            raise ValueError
+
+        self.requests = requests
+        self.seconds = seconds
+        self.path = path
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, auth_token, max_wait=None):
+        """Take a token from the bucket of an auth token.
+
+        Args:
+            auth_token (str): Auth token the request is made with.
+            max_wait (float): Seconds the caller is willing to wait. When it
+                would have to wait longer, no token is taken. None to always
+                take one.
+
+        Returns:
+            float. Seconds to wait before making the request.
+        """
+
+        now = time.time()
+
+        def take(buckets):
+            bucket = self._refill(buckets, auth_token, now)
+            wait = max(
+                0.0,
+                (1 - bucket['tokens']) * self.seconds / self.requests,
+            )
+            if max_wait is None or wait <= max_wait:
+                bucket['tokens'] -= 1
+            return wait
+
+        return self._update(take)
+
+    def calibrate(self, auth_token, headers):
+        """Correct the bucket of an auth token with response headers.
+
+        ``X-Ratelimit-Remaining`` caps the tokens left, and when none are
+        left, ``X-Ratelimit-Reset`` (in seconds since the epoch) tells when
+        the next request may be made.
+
+        Args:
+            auth_token (str): Auth token the request was made with.
+            headers: Headers of the response. Anything with ``get``.
+        """
+
+        try:
+            remaining = int(headers.get('X-Ratelimit-Remaining'))
+        except (TypeError, ValueError):
+            return
+
+        try:
+            reset = float(headers.get('X-Ratelimit-Reset'))
+        except (TypeError, ValueError):
+            reset = None
+
+        now = time.time()
+
+        def correct(buckets):
+            bucket = self._refill(buckets, auth_token, now)
+            bucket['tokens'] = min(bucket['tokens'], remaining)
+            if remaining <= 0 and reset is not None and reset > now:
+                debt = (reset - now) * self.requests / self.seconds
+                bucket['tokens'] = min(bucket['tokens'], -debt)
+
+        self._update(correct)
+
+    def _refill(self, buckets, auth_token, now):
+        import hashlib
+
+        key = hashlib.sha1(auth_token.encode('utf-8')).hexdigest()
+        bucket = buckets.setdefault(
+            key,
+            {'tokens': float(self.requests), 'updated': now},
+        )
+        elapsed = max(0.0, now - bucket['updated'])
+        bucket['tokens'] = min(
+            float(self.requests),
+            bucket['tokens'] + elapsed * self.requests / self.seconds,
+        )
+        bucket['updated'] = now
+        return bucket
+
+    def _update(self, function):
+        with self._lock:
+            if self.path is None:
+                return function(self._buckets)
+            return update_state_file(
+                self.path,
+                function,
+                prune=self._prune,
+            )
+
+    def _prune(self, buckets):
+        # Buckets full for a whole period are as good as missing.
+        stale = time.time() - self.seconds
+        for key in list(buckets):
+            if buckets[key]['updated'] < stale and \
+                    buckets[key]['tokens'] >= self.requests:
+                del buckets[key]
+
+
+class RateLimitedOpener(object):
+    """Open requests through another opener, pacing them with a limiter.
+
+    Requests are keyed by the auth token of their ``Authorization`` header.
+    A request which would have to wait longer than ``max_wait`` fails right
+    away with ``URLError`` instead, leaving it to the caller to retry later.
+    """
+
+    def __init__(self, opener_director, limiter, max_wait=None):
+        """Initialize opener.
+
+        Args:
+            opener_director: Object to open requests with.
+            limiter (RateLimiter): Limiter to pace requests with.
+            max_wait (float): Maximum seconds to wait. None to always wait.
+        """
+
+        self.opener_director = opener_director
+        self.limiter = limiter
+        self.max_wait = max_wait
+
+    def open(self, request):
+        """Open request once allowed by the limiter.
+
+        Args:
+            request (Request): Request to send.
+
+        Returns:
+            Response as returned by the underlying opener.
+
+        Raises:
+            * HTTPError: Raised when the response has an error status.
+            * URLError: Raised when the request could not be sent, including
+              when the limiter would make it wait too long.
+        """
+
+        import_http()
+
+        authorization = request.get_header('Authorization') or ''
+        auth_token = authorization.partition(' ')[2]
+
+        wait = self.limiter.acquire(auth_token, self.max_wait)
+        if self.max_wait is not None and wait > self.max_wait:
+            raise URLError('Rate limited for %.1f seconds' % wait)
+        if wait > 0:
+            time.sleep(wait)
+
+        try:
+            response = self.opener_director.open(request)
+        except HTTPError:
+            error = sys.exc_info()[1]
+            if error.hdrs is not None:
+                self.limiter.calibrate(auth_token, error.hdrs)
+            raise
+
+        self.limiter.calibrate(auth_token, response.info())
+        return response
+
+    def close(self):
+        """Close the underlying opener, if it can be."""
+
+        if hasattr(self.opener_director, 'close'):
+            self.opener_director.close()
+
+
+class CircuitBreaker(object):
+    """Circuit per API host, failing requests fast while the host is down.
+
+    A circuit is closed, letting requests through, until ``threshold``
+    requests in a row fail. It is then open for ``cooldown`` seconds, during
+    which requests fail right away instead of waiting for timeouts. Once
+    the cooldown is over, the circuit is half-open: a single request at a
+    time is let through as a probe, closing the circuit if it succeeds and
+    opening it again if it fails.
+
+    Circuits are kept in memory, or in a file locked while in use when
+    ``path`` is given, so that every process using the file shares them.
+    """
+
+    def __init__(self, threshold, cooldown, path=None):
+        """Initialize breaker.
+
+        Args:
+            threshold (int): Number of failures in a row opening a circuit.
+            cooldown (float): Seconds a circuit stays open.
+            path (str): Path of the file keeping the circuits. None to keep
+                them in memory.
+
+        Raises:
+            * ValueError: Raised when the threshold or the cooldown is not
+              positive.
+        """
+
+        if threshold <= 0 or cooldown <= 0:
+            raise ValueError
+
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.path = path
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host, probe_timeout):
+        """Tell whether a request to a host may be sent.
+
+        Args:
+            host (str): Host, and port if any, the request is sent to.
+            probe_timeout (float): Seconds a probe may take at most, after
+                which another one is let through.
+
+        Returns:
+            float. Seconds before a request may be sent, 0.0 when it may be
+            sent right away.
+        """
+
+        now = time.time()
+
+        def check(circuits):
+            circuit = circuits.get(host)
+            if circuit is None or circuit['opened'] is None:
+                return 0.0
+
+            reopen = circuit['opened'] + self.cooldown
+            if now < reopen:
+                return reopen - now
+
+            probing = circuit.get('probing')
+            if probing is not None and now < probing:
+                return probing - now
+
+            circuit['probing'] = now + probe_timeout
+            return 0.0
+
+        return self._update(check)
+
+    def record(self, host, success):
+        """Record how a request to a host went.
+
+        Args:
+            host (str): Host, and port if any, the request was sent to.
+            success (bool): Whether the host responded, even with an error
+                of the client.
+        """
+
+        now = time.time()
+
+        def count(circuits):
+            if success:
+                circuits.pop(host, None)
+                return
+
+            circuit = circuits.setdefault(
+                host,
+                {'failures': 0, 'opened': None},
+            )
+            circuit['failures'] += 1
+            if circuit['opened'] is not None or \
+                    circuit['failures'] >= self.threshold:
+                circuit['opened'] = now
+                circuit['probing'] = None
+
+        self._update(count)
+
+    def _update(self, function):
+        with self._lock:
+            if self.path is None:
+                return function(self._circuits)
+            return update_state_file(self.path, function)
+
+
+class CircuitBreakerOpener(object):
+    """Open requests through another opener, unless their circuit is open.
+
+    Requests are keyed by the host of their URL. A request whose circuit is
+    open fails right away with ``URLError``, which is worth retrying, so
+    that the alert waits in the outbox when there is one. Failing to get a
+    response and server errors count as failures of the host; any other
+    response, including 429 Too Many Requests, as a success.
+    """
+
+    def __init__(self, opener_director, breaker, probe_timeout=60.0):
+        """Initialize opener.
+
+        Args:
+            opener_director: Object to open requests with.
+            breaker (CircuitBreaker): Breaker keeping the circuits.
+            probe_timeout (float): Seconds a request may take at most.
+        """
+
+        self.opener_director = opener_director
+        self.breaker = breaker
+        self.probe_timeout = probe_timeout
+
+    def open(self, request):
+        """Open request unless its circuit is open.
+
+        Args:
+            request (Request): Request to send.
+
+        Returns:
+            Response as returned by the underlying opener.
+
+        Raises:
+            * HTTPError: Raised when the response has an error status.
+            * URLError: Raised when the request could not be sent, including
+              when its circuit is open.
+        """
+
+        import_http()
+
+        host = urlsplit(request.get_full_url())[1]
+
+        wait = self.breaker.allow(host, self.probe_timeout)
+        if wait > 0:
+            raise URLError(
+                'Circuit open for %s for %.1f seconds' % (host, wait)
+            )
+
+        try:
+            response = self.opener_director.open(request)
+        except HTTPError:
+            self.breaker.record(host, sys.exc_info()[1].code < 500)
+            raise
+        except URLError:
+            self.breaker.record(host, False)
+            raise
+
+        self.breaker.record(host, True)
+        return response
+
+    def close(self):
+        """Close the underlying opener, if it can be."""
+
+        if hasattr(self.opener_director, 'close'):
+            self.opener_director.close()
+
+
+try:
+    STRING_TYPES = (basestring,)  # pylint: disable=undefined-variable
+except NameError:
+    STRING_TYPES = (str,)
+
+TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+
+TSV_ESCAPE_PATTERN = re.compile(r'\\(.)')
+
+
+def parse_record(line, router=None):
+    """Parse a record of bulk input.
+
+    A record is either a JSON object with ``destination``, ``metadata`` and
+    ``alert`` keys, or the 3 strings separated by tabs. In the latter, tab,
+    newline, carriage return and backslash are escaped as ``\\t``, ``\\n``,
+    ``\\r`` and ``\\\\``.
+
+    Args:
+        line (str): Line of bulk input, without the line terminator.
+        router (Router): Router to route the alert with. None not to route
+            it.
+
+    Returns:
+        A dict as returned by :func:`get_arguments`.
+
+    Raises:
+        * KeyError: Raised when required keys are not proveded.
+        * ValueError: Raised when the record is malformed, including a JSON
+          record whose fields are not strings.
+    """
+
+    if line.lstrip().startswith('{'):
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError
+        fields = [record['destination'], record['metadata'], record['alert']]
+        for field in fields:
+            if not isinstance(field, STRING_TYPES):
+                raise ValueError
+    else:
+        fields = line.split('\t')
+        if len(fields) != 3:
+            raise ValueError
+        fields = [
+            TSV_ESCAPE_PATTERN.sub(
+                lambda match: TSV_ESCAPES.get(match.group(1), match.group(0)),
+                field,
+            )
+            for field in fields
+        ]
+
+    dictionary = {}
+    dictionary.update(parse_destination(fields[0]))
+    dictionary.update(parse_metadata(fields[1]))
+    dictionary.update(parse_alert(fields[2]))
+    if router is not None:
+        dictionary = router.route(dictionary, fields[1])
+    return dictionary
+
+
+def bulk_deliver(stream, dispatcher, output, router=None):
+    """Send every alert read from a stream.
+
+    Records are read, sent and reported one at a time, so memory usage does
+    not depend on the length of the input. Blank lines are skipped.
+
+    For every room of every record, a line of JSON is written to ``output``
+    holding the dict returned by :meth:`Dispatcher.deliver` plus ``record``,
+    the line number, and ``exit``, the exit status the alert script would
+    have exited with for the room: 0 on success, when queued for a retry or
+    when coalesced, 1 when delivery failed, 2 when the record is malformed.
+    Coalesced alerts are sent by the time the dispatcher is closed.
+
+    Args:
+        stream: Iterable of lines of bulk input.
+        dispatcher (Dispatcher): Dispatcher to deliver alerts with.
+        output: File-like object to write the results to.
+        router (Router): Router to route alerts with. None not to route
+            them.
+
+    Returns:
+        int. The highest exit status of the records, 0 if there was none.
+    """
+
+    exit_status = 0
+
+    for (number, line) in enumerate(stream, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+
+        try:
+            args = parse_record(line, router)
+        except (KeyError, TypeError, ValueError):
+            results = [{
+                'room': None,
+                'status': None,
+                'elapsed': 0.0,
+                'error': 'Malformed record',
+                'exit': 2,
+            }]
+        else:
+            results = dispatcher.deliver(args)
+            for result in results:
+                if result['error'] and not result['queued']:
+                    result['exit'] = 1
+                else:
+                    result['exit'] = 0
+
+        for result in results:
+            result['record'] = number
+            output.write(json.dumps(result) + '\n')
+            exit_status = max(exit_status, result['exit'])
+        output.flush()
+
+    return exit_status
+
+
+def bulk_deliver_file(path, dispatcher, router=None):
+    """Send every alert read from a file, reporting to stdout.
+
+    Args:
+        path (str): Path of the file to read. ``-`` for stdin.
+        dispatcher (Dispatcher): Dispatcher to deliver alerts with.
+        router (Router): Router to route alerts with. None not to route
+            them.
+
+    Returns:
+        int. The highest exit status of the records, 0 if there was none.
+    """
+
+    try:
+        if path == '-':
+            return bulk_deliver(sys.stdin, dispatcher, sys.stdout, router)
+
+        stream = open(path)
+        try:
+            return bulk_deliver(stream, dispatcher, sys.stdout, router)
+        finally:
+            stream.close()
+    finally:
+        dispatcher.close()
+
+
+PAIR_QUOTE_PATTERN = re.compile(r'[,="\\]|^\s|\s$')
+
+
+def quote_pair_value(value):
+    """Quote a key or value of a pair for :func:`tokenize_pairs`.
+
+    Args:
+        value (str): Key or value to quote.
+
+    Returns:
+        str. The value, in double quotes with ``"`` and ``\\`` escaped if it
+        holds ``,``, ``=``, ``"`` or ``\\``, or starts or ends with
+        whitespace.
+    """
+
+    if not PAIR_QUOTE_PATTERN.search(value):
+        return value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def redact_destination(string):
+    """Replace the auth tokens of a ``destination`` with hashes of them.
+
+    Tokens are replaced by the first 16 hex digits of their SHA-1, so that
+    alerts sent with the same token still share one, e.g. for
+    ``--rate-limit``, without the record giving access to HipChat.
+
+    Args:
+        string (str): Destination string, as given to the alert script.
+
+    Returns:
+        str. The destination with its tokens replaced, the pairs quoted by
+        :func:`quote_pair_value`. An empty string when the destination is
+        malformed, as it is then not sent either.
+    """
+
+    import hashlib
+
+    def redact(token):
+        if not token:
+            return token
+        return hashlib.sha1(token.encode('utf-8')).hexdigest()[:16]
+
+    try:
+        pairs = tokenize_pairs(string)
+    except ValueError:
+        return ''
+
+    redacted = []
+    for (key, value) in pairs:
+        if key == 'auth_token':
+            value = redact(value)
+        elif key == 'room' and '|' in value:
+            (room, _, token) = value.partition('|')
+            value = '%s|%s' % (room, redact(token.strip()))
+        redacted.append(
+            '%s=%s' % (quote_pair_value(key), quote_pair_value(value))
+        )
+
+    return ','.join(redacted)
+
+
+def record_alert(path, destination, metadata, alert, now=None):
+    """Append the arguments of an alert to a recording.
+
+    The recording is a file of JSON records of ``--bulk`` input, plus
+    ``time``, the time the alert script was run. Every record is appended
+    by a single write to the file opened for appending, so that records of
+    alert scripts running at once are not interleaved.
+
+    Args:
+        path (str): Path of the recording. Created, readable by the owner
+            only, if missing.
+        destination (str): Destination string. Recorded as returned by
+            :func:`redact_destination`.
+        metadata (str): Metadata string.
+        alert (str): Body of the alert.
+        now (float): Time of the alert. The current time if not given.
+
+    Raises:
+        * IOError, OSError: Raised when the recording can not be written.
+    """
+
+    record = {
+        'time': round(time.time() if now is None else now, 6),
+        'destination': redact_destination(destination),
+        'metadata': metadata,
+        'alert': alert,
+    }
+    line = json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n'
+
+    descriptor = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(descriptor, line.encode('utf-8'))
+    finally:
+        os.close(descriptor)
+
+
+class Dispatcher(object):
+    """Deliver alerts with the delivery features in use.
+
+    Holds everything needed to send an alert besides the alert itself, so
+    that the alert script, the delivery daemon and bulk mode deliver alerts
+    the same way.
+    """
+
+    def __init__(self, opener_director, endpoint=API_ENDPOINT_ROOM,
+                 outbox=None, coalesce=None, deduplicator=None,
+                 metrics=None, pairing=None, room_cache=None):
+        """Initialize dispatcher.
+
+        Args:
+            opener_director: Object to open requests with. Has to be safe to
+                share between threads, such as a :class:`ConnectionPool`.
+            endpoint (str): URL of the API endpoint with ``%s`` for the room.
+            outbox (Outbox): Outbox keeping alerts until they are sent. None
+                not to keep them.
+            coalesce (float): Seconds to wait for more alerts to the same
+                room to merge into a digest. None not to merge alerts.
+            deduplicator (Deduplicator): Deduplicator suppressing repeated
+                alerts. None not to suppress them.
+            metrics (Metrics): Metrics to count deliveries and track the
+                depth of queues in. None not to record them.
+            pairing (str): What to do with a recovery whose problem is still
+                waiting in the outbox or the coalescer: 'collapse' to take
+                the problem back and tell in the recovery it was never
+                sent, 'drop' to take both back. None to send both.
+            room_cache (RoomCache): Cache to resolve rooms given by name to
+                their ID with. None to send to rooms by name.
+        """
+
+        self.opener_director = opener_director
+        self.endpoint = endpoint
+        self.outbox = outbox
+        self.deduplicator = deduplicator
+        self.metrics = metrics
+        self.pairing = pairing
+        self.room_cache = room_cache
+        self.coalescer = None
+
+        if coalesce:
+            self.coalescer = Coalescer(self.deliver_now, coalesce)
+
+        if metrics is not None:
+            if outbox is not None:
+                metrics.track_queue('outbox', outbox.__len__)
+            if self.coalescer is not None:
+                metrics.track_queue('coalescer', self.coalescer.__len__)
+
+    def deliver(self, args):
+        """Send the alert to every room.
+
+        Rooms dropped by :meth:`Router.route` are skipped. With pairing, a
+        recovery takes back the problem it resolves if still waiting to be
+        sent to the room, and is either sent with a note or skipped as well.
+        With a deduplicator, rooms for which the alert is a repetition are
+        skipped too. With a coalescer, the alert is only handed over to it,
+        to be sent along with the alerts to the same room arriving within
+        its window.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`.
+
+        Returns:
+            list. A dict as returned by :meth:`deliver_now` for every room,
+            in the order of the rooms, plus ``dropped``, True when the room
+            was dropped by routing, ``cancelled``, True when the recovery was
+            skipped along with its problem, ``suppressed``, True when the
+            alert was skipped as a repetition, and ``coalesced``, True when
+            the alert was handed over to the coalescer. Other values are
+            then empty, as the alert was not sent.
+        """
+
+        alerts = split_destinations(args)
+        kept = [
+            room_args for room_args in alerts if not room_args.get('dropped')
+        ]
+
+        if len(kept) == len(alerts):
+            results = self._deliver(args)
+        else:
+            results = []
+            if kept:
+                results = self._deliver(join_destinations(kept))
+            results.reverse()
+            results = [
+                self._skip(room_args['room'], 'dropped')
+                if room_args.get('dropped') else results.pop()
+                for room_args in alerts
+            ]
+
+        for result in results:
+            result.setdefault('dropped', False)
+            result.setdefault('cancelled', False)
+            result.setdefault('suppressed', False)
+            result.setdefault('coalesced', False)
+
+        return results
+
+    def deliver_now(self, args):
+        """Send the alert to every room right away.
+
+        With a room cache, rooms given by name are sent to by ID, and rooms
+        known not to exist fail right away with a 404 status. With an
+        outbox, the alert is recorded in it before being sent, and rooms it
+        could not be sent to for a reason worth retrying are left in it for
+        a retry.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`.
+
+        Returns:
+            list. A dict as returned by :func:`send_request` for every room,
+            in the order of the rooms, plus ``queued``, True when the alert
+            was kept in the outbox for a retry.
+        """
+
+        if self.room_cache is None:
+            return self._send_now(args)
+
+        alerts = []
+        for room_args in split_destinations(args):
+            room_id = self.room_cache.resolve(
+                room_args['room'],
+                room_args['auth_token'],
+                self.opener_director,
+                self.endpoint,
+            )
+            if room_id is not None and room_id != room_args['room']:
+                room_args = dict(room_args, room_id=room_id)
+            alerts.append((room_id is not None, room_args))
+
+        kept = [room_args for (found, room_args) in alerts if found]
+        results = []
+        if kept:
+            results = self._send_now(join_destinations(kept))
+        results.reverse()
+
+        return [
+            results.pop() if found else self._fail_unknown(room_args['room'])
+            for (found, room_args) in alerts
+        ]
+
+    def _send_now(self, args):
+        entries = None
+        if self.outbox is not None:
+            entries = self.outbox.put(args)
+
+        results = deliver_all(
+            args,
+            self.opener_director,
+            self.endpoint,
+            metrics=self.metrics,
+        )
+
+        for (index, result) in enumerate(results):
+            result['queued'] = False
+            if entries is not None:
+                result['queued'] = self._settle(entries[index], result)
+            if self.metrics is not None:
+                self.metrics.count(result)
+
+        return results
+
+    def drain(self):
+        """Retry alerts of the outbox which are due.
+
+        Alerts becoming due again while draining are left for the next time.
+
+        Returns:
+            int. Number of alerts sent successfully.
+        """
+
+        if self.outbox is None:
+            return 0
+
+        started = time.time()
+        sent = 0
+
+        while True:
+            entries = self.outbox.claim(before=started)
+            if not entries:
+                break
+
+            for entry in entries:
+                result = deliver(
+                    entry['args'],
+                    self.opener_director,
+                    self.endpoint,
+                )
+                if not result['error']:
+                    sent += 1
+                result['queued'] = self._settle(entry, result)
+                if self.metrics is not None:
+                    self.metrics.count(result)
+                if not result['queued'] and result['error']:
+                    sys.stderr.write(
+                        'Gave up on alert to %s: %s\n' % (
+                            result['room'],
+                            result['error'],
+                        )
+                    )
+
+        self.outbox.compact()
+        return sent
+
+    def close(self):
+        """Send alerts waiting in the coalescer, and release resources."""
+
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        if self.metrics is not None and self.metrics.statsd is not None:
+            self.metrics.push()
+        if hasattr(self.opener_director, 'close'):
+            self.opener_director.close()
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.deduplicator is not None:
+            self.deduplicator.close()
+
+    def _deliver(self, args):
+        if self.pairing is not None and is_recovery(args) and \
+                get_pair_key(args) is not None:
+            return self._pair(args)
+        return self._send(args)
+
+    def _send(self, args):
+        if self.deduplicator is None:
+            return self._coalesce(args)
+        return self._deduplicate(args)
+
+    def _pair(self, args):
+        alerts = split_destinations(args)
+        results = [None] * len(alerts)
+        kept = []
+        now = time.time()
+
+        for (index, room_args) in enumerate(alerts):
+            added = self._cancel(room_args)
+            if added is None:
+                kept.append((index, room_args))
+            elif self.pairing == 'drop':
+                results[index] = self._skip(room_args['room'], 'cancelled')
+            else:
+                kept.append((index, add_resolution(room_args, now - added)))
+
+        self._send_grouped(kept, results, self._send)
+        return results
+
+    def _cancel(self, args):
+        added = []
+        if self.outbox is not None:
+            added.append(self.outbox.cancel(args))
+        if self.coalescer is not None:
+            added.append(self.coalescer.cancel(args))
+
+        added = [value for value in added if value is not None]
+        if not added:
+            return None
+        return min(added)
+
+    def _deduplicate(self, args):
+        alerts = split_destinations(args)
+        results = [None] * len(alerts)
+        kept = []
+
+        for (index, room_args) in enumerate(alerts):
+            repeated = self.deduplicator.check(room_args)
+            if repeated is None:
+                results[index] = self._skip(room_args['room'], 'suppressed')
+                continue
+            if repeated:
+                room_args = add_repetitions(room_args, repeated)
+            kept.append((index, room_args))
+
+        self._send_grouped(kept, results, self._coalesce)
+        return results
+
+    def _send_grouped(self, alerts, results, send):
+        # Rooms getting the same message are sent to together.
+        groups = []
+        for (index, room_args) in alerts:
+            for group in groups:
+                if group[0][1]['alert'] == room_args['alert']:
+                    group.append((index, room_args))
+                    break
+            else:
+                groups.append([(index, room_args)])
+
+        for group in groups:
+            group_args = join_destinations([pair[1] for pair in group])
+            for (pair, result) in zip(group, send(group_args)):
+                results[pair[0]] = result
+
+    def _coalesce(self, args):
+        if self.coalescer is None:
+            return self.deliver_now(args)
+
+        results = []
+        for room_args in split_destinations(args):
+            self.coalescer.add(room_args)
+            results.append(self._skip(room_args['room'], 'coalesced'))
+
+        return results
+
+    def _skip(self, room, reason):
+        result = {
+            'room': room,
+            'status': None,
+            'elapsed': 0.0,
+            'error': None,
+            'retry_after': None,
+            'queued': False,
+        }
+        result[reason] = True
+        if self.metrics is not None:
+            self.metrics.count(result)
+        return result
+
+    def _fail_unknown(self, room):
+        result = {
+            'room': room,
+            'status': 404,
+            'elapsed': 0.0,
+            'error': 'Unknown room: %s' % room,
+            'retry_after': None,
+            'queued': False,
+        }
+        if self.metrics is not None:
+            self.metrics.count(result)
+        return result
+
+    def _settle(self, entry, result):
+        if not result['error'] or not is_retryable(result):
+            self.outbox.done(entry['id'])
+            return False
+
+        return self.outbox.retry(entry, result['retry_after'])
+
+
+def get_dispatcher(options, args=None):
+    """Build dispatcher as configured by commandline options.
+
+    Args:
+        options (optparse.Values): Options as returned by
+            :func:`get_options_and_arguments`.
+        args (dict): Runtime parameters of the alert when sending a single
+            alert, None when sending many.
+
+    Returns:
+        Dispatcher. Dispatcher to deliver alerts with.
+    """
+
+    metrics = None
+    if options.prometheus or options.statsd:
+        statsd = None
+        if options.statsd:
+            statsd = parse_address(options.statsd)
+        metrics = Metrics(statsd)
+
+    resolver = None
+    if options.dns_cache:
+        try:
+            resolver = DNSCache(options.dns_cache, options.dns_cache_state)
+        except ValueError:
+            sys.stderr.write(
+                'Malformed --dns-cache: %s\n' % options.dns_cache
+            )
+            sys.exit(2)
+
+    transport = options.transport
+    if transport is None:
+        # Connections are only timed, and hosts only looked up in the cache,
+        # by the pool.
+        transport = 'pool'
+        if args is not None and len(get_destinations(args)) == 1 and \
+                metrics is None and resolver is None:
+            transport = 'urllib'
+
+    if transport == 'urllib':
+        opener_director = build_timed_opener(
+            options.connect_timeout,
+            options.timeout,
+        )
+    else:
+        maxsize = 4
+        if args is not None:
+            maxsize = len(get_destinations(args))
+        pool_class = ConnectionPool
+        if transport == 'pipeline':
+            pool_class = PipeliningConnectionPool
+        opener_director = pool_class(
+            maxsize=maxsize,
+            connect_timeout=options.connect_timeout,
+            timeout=options.timeout,
+            metrics=metrics,
+            resolver=resolver,
+        )
+
+    if options.circuit_breaker:
+        (failures, _, seconds) = options.circuit_breaker.partition('/')
+        try:
+            breaker = CircuitBreaker(
+                int(failures),
+                float(seconds),
+                options.circuit_breaker_state,
+            )
+        except ValueError:
+            sys.stderr.write(
+                'Malformed --circuit-breaker: %s\n' % options.circuit_breaker
+            )
+            sys.exit(2)
+        # Inside the rate limiter, so that requests it turns down do not
+        # count as failures of the host.
+        opener_director = CircuitBreakerOpener(
+            opener_director,
+            breaker,
+            probe_timeout=options.connect_timeout + options.timeout,
+        )
+
+    if options.rate_limit:
+        (requests, _, seconds) = options.rate_limit.partition('/')
+        try:
+            limiter = RateLimiter(
+                int(requests),
+                float(seconds),
+                options.rate_limit_state,
+            )
+        except ValueError:
+            sys.stderr.write(
+                'Malformed --rate-limit: %s\n' % options.rate_limit
+            )
+            sys.exit(2)
+        opener_director = RateLimitedOpener(
+            opener_director,
+            limiter,
+            max_wait=options.timeout,
+        )
+
+    outbox = None
+    if options.spool:
+        outbox = Outbox(options.spool, aging=options.spool_aging)
+
+    coalesce = None
+    if args is None:
+        coalesce = options.coalesce
+
+    deduplicator = None
+    if options.dedup:
+        deduplicator = Deduplicator(options.dedup, options.dedup_state)
+
+    room_cache = None
+    if options.room_cache:
+        try:
+            room_cache = RoomCache(
+                options.room_cache,
+                options.room_cache_state,
+            )
+        except ValueError:
+            sys.stderr.write(
+                'Malformed --room-cache: %s\n' % options.room_cache
+            )
+            sys.exit(2)
+
+    return Dispatcher(
+        opener_director,
+        options.endpoint,
+        outbox,
+        coalesce,
+        deduplicator,
+        metrics,
+        options.pairing,
+        room_cache,
+    )
+
+
+def is_retryable(result):
+    """Tell whether a failed delivery is worth retrying.
+
+    Failing to connect, being rate limited and server errors are, as they
+    are expected to go away. Any other error response, such as a wrong
+    token or an unknown room, is not.
+
+    Args:
+        result (dict): Dict as returned by :func:`send_request`.
+
+    Returns:
+        bool. True if worth retrying.
+    """
+
+    status = result['status']
+    return status is None or status == 429 or status >= 500
+
+
+def get_backoff(attempts, base=2.0, cap=3600.0, retry_after=None):
+    """Get seconds to wait before the next attempt.
+
+    Exponential backoff with jitter: a random delay between half and all of
+    ``base * 2 ** (attempts - 1)``, capped at ``cap``. A delay told by the
+    server takes precedence when longer.
+
+    Args:
+        attempts (int): Number of attempts made so far, at least 1.
+        base (float): Delay after the first attempt.
+        cap (float): Maximum delay.
+        retry_after (float): Delay told by the server. None if not told.
+
+    Returns:
+        float. Seconds to wait.
+    """
+
+    import random
+
+    delay = min(cap, base * 2 ** min(attempts - 1, 32))
+    delay = random.uniform(delay / 2, delay)
+
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+class Outbox(object):
+    """Crash-safe spool of alerts waiting to be sent.
+
+    Alerts are kept in a SQLite database in WAL mode, one entry per room, and
+    are recorded before being sent so that an alert survives a crash of the
+    process sending it. An entry is leased to a sender by moving its due
+    time ahead, so that processes sharing the outbox do not send it twice,
+    and is handed out again once the lease expires.
+
+    Entries are handed out by rank rather than first in, first out, so that
+    a Disaster does not wait behind a backlog of Information alerts: the
+    rank of an entry is the time it was created, moved ahead by ``aging``
+    seconds for every level of severity of its color. An entry thus ages
+    into the rank of one a level more severe after ``aging`` seconds, and
+    no entry starves. Recoveries, in green, go in a lane of their own which
+    gets a share of every claim, so that neither lane holds the other up.
+
+    Problems are indexed by the key pairing them with their recovery, so
+    that :meth:`cancel` finds the ones waiting for a retry.
+
+    Disk usage is bounded by ``max_entries``, dropping the oldest entries of
+    the lowest severity first, and by ``max_age`` and ``max_attempts``, after
+    which an alert is given up. :meth:`compact` gives the space of removed
+    entries back.
+    """
+
+    PROBLEM_LANE = 0
+
+    RECOVERY_LANE = 1
+
+    RECOVERY_SHARE = 4
+
+    def __init__(self, path, max_entries=10000, max_age=86400.0,
+                 max_attempts=20, lease=60.0, aging=300.0):
+        """Open the outbox, creating it if needed.
+
+        Args:
+            path (str): Path of the SQLite database.
+            max_entries (int): Maximum number of entries kept.
+            max_age (float): Seconds after which an alert is given up.
+            max_attempts (int): Attempts after which an alert is given up.
+            lease (float): Seconds an entry handed out stays leased.
+            aging (float): Seconds an entry has to wait to rank as one a
+                level of severity higher.
+        """
+
+        import sqlite3
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.aging = aging
+        self._lock = threading.Lock()
+        self._removed = 0
+
+        self._connection = sqlite3.connect(
+            path,
+            timeout=30.0,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'created REAL NOT NULL, '
+            'due REAL NOT NULL, '
+            'attempts INTEGER NOT NULL, '
+            'args TEXT NOT NULL, '
+            'lane INTEGER NOT NULL DEFAULT 0, '
+            'rank REAL, '
+            'pair TEXT, '
+            'leased INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._migrate()
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS outbox_due ON outbox (due)'
+        )
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS outbox_rank ON outbox (lane, rank)'
+        )
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS outbox_pair ON outbox (pair)'
+        )
+
+    def _migrate(self):
+        """Add the columns missing from an outbox created by an older version.
+
+        Entries already in the outbox rank by the time they were created,
+        and pair with no recovery.
+        """
+
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            columns = [
+                row[1]
+                for row in self._connection.execute(
+                    'PRAGMA table_info(outbox)'
+                )
+            ]
+            for (name, definition) in (
+                ('lane', 'INTEGER NOT NULL DEFAULT 0'),
+                ('rank', 'REAL'),
+                ('pair', 'TEXT'),
+                ('leased', 'INTEGER NOT NULL DEFAULT 0'),
+            ):
+                if name not in columns:
+                    self._connection.execute(
+                        'ALTER TABLE outbox ADD COLUMN %s %s' % (
+                            name,
+                            definition,
+                        )
+                    )
+            if 'rank' not in columns:
+                self._connection.execute('UPDATE outbox SET rank = created')
+            self._connection.execute('COMMIT')
+        except Exception:
+            self._connection.execute('ROLLBACK')
+            raise
+
+    def get_rank(self, args, created):
+        """Rank an entry.
+
+        Args:
+            args (dict): Runtime parameters of the entry.
+            created (float): Time the entry was created.
+
+        Returns:
+            A tuple of the lane and the rank of the entry, lower first.
+        """
+
+        severity = get_severity(args)
+        if severity < 0:
+            return (self.RECOVERY_LANE, created)
+        return (self.PROBLEM_LANE, created - severity * self.aging)
+
+    def put(self, args):
+        """Record an alert about to be sent.
+
+        The entries are leased to the caller right away.
+
+        Args:
+            args (dict): Runtime parameters as returned by
+                :func:`get_arguments`.
+
+        Returns:
+            list. An entry for every room, in the order of the rooms. Entries
+            are dicts with ``id``, ``created``, ``attempts`` and ``args``,
+            the runtime parameters for the room alone.
+        """
+
+        now = time.time()
+        entries = []
+
+        for room_args in split_destinations(args):
+            entries.append({
+                'id': None,
+                'created': now,
+                'attempts': 0,
+                'args': room_args,
+            })
+
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                for entry in entries:
+                    (lane, rank) = self.get_rank(entry['args'], now)
+                    pair_key = None
+                    if lane == self.PROBLEM_LANE:
+                        pair_key = get_pair_key(entry['args'])
+                    cursor = self._connection.execute(
+                        'INSERT INTO outbox '
+                        '(created, due, attempts, args, lane, rank, pair, '
+                        'leased) VALUES (?, ?, 0, ?, ?, ?, ?, 1)',
+                        (
+                            now,
+                            now + self.lease,
+                            json.dumps(entry['args']),
+                            lane,
+                            rank,
+                            pair_key,
+                        ),
+                    )
+                    entry['id'] = cursor.lastrowid
+
+                cursor = self._connection.execute(
+                    'DELETE FROM outbox WHERE id IN ('
+                    'SELECT id FROM outbox '
+                    'ORDER BY created - rank DESC, id DESC '
+                    'LIMIT -1 OFFSET ?)',
+                    (self.max_entries,),
+                )
+                self._removed += max(0, cursor.rowcount)
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        return entries
+
+    def claim(self, limit=100, before=None):
+        """Lease entries which are due.
+
+        Entries older than ``max_age`` are given up on the way. Up to a
+        ``RECOVERY_SHARE``-th of ``limit`` is kept for recoveries, and either
+        lane takes what the other leaves.
+
+        Args:
+            limit (int): Maximum number of entries to lease.
+            before (float): Only lease entries due by this time. None for
+                now.
+
+        Returns:
+            list. Leased entries as returned by :meth:`put`, problems before
+            recoveries, and best ranked first within each.
+        """
+
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = self._connection.execute(
+                    'DELETE FROM outbox WHERE created < ?',
+                    (now - self.max_age,),
+                )
+                self._removed += max(0, cursor.rowcount)
+
+                due = min(now, before or now)
+                recoveries = self._select(
+                    self.RECOVERY_LANE,
+                    due,
+                    limit // self.RECOVERY_SHARE,
+                )
+                problems = self._select(
+                    self.PROBLEM_LANE,
+                    due,
+                    limit - len(recoveries),
+                )
+                if len(problems) + len(recoveries) < limit:
+                    recoveries = self._select(
+                        self.RECOVERY_LANE,
+                        due,
+                        limit - len(problems),
+                    )
+                rows = problems + recoveries
+
+                self._connection.executemany(
+                    'UPDATE outbox SET due = ?, leased = 1 WHERE id = ?',
+                    [(now + self.lease, row[0]) for row in rows],
+                )
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        return [
+            {
+                'id': row[0],
+                'created': row[1],
+                'attempts': row[2],
+                'args': json.loads(row[3]),
+            }
+            for row in rows
+        ]
+
+    def _select(self, lane, due, limit):
+        """Select the best ranked entries of a lane which are due.
+
+        Args:
+            lane (int): Lane of the entries.
+            due (float): Time the entries are due by.
+            limit (int): Maximum number of entries.
+
+        Returns:
+            list. Rows of the ID, creation time, attempts and runtime
+            parameters of the entries.
+        """
+
+        if limit <= 0:
+            return []
+
+        return self._connection.execute(
+            'SELECT id, created, attempts, args FROM outbox '
+            'WHERE lane = ? AND due <= ? ORDER BY rank LIMIT ?',
+            (lane, due, limit),
+        ).fetchall()
+
+    def cancel(self, args):
+        """Give up the problems a recovery resolves.
+
+        Only problems waiting for a retry, or whose lease expired, are given
+        up: one being sent may already have been.
+
+        Args:
+            args (dict): Runtime parameters of the recovery, for a single
+                room.
+
+        Returns:
+            float. Time the earliest problem given up was created, None if
+            there was none.
+        """
+
+        now = time.time()
+        created = None
+
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._connection.execute(
+                    'SELECT id, created, args FROM outbox '
+                    'WHERE pair = ? AND (leased = 0 OR due <= ?)',
+                    (get_pair_key(args), now),
+                ).fetchall()
+
+                ids = []
+                for row in rows:
+                    problem_args = json.loads(row[2])
+                    if problem_args['room'] == args['room'] and \
+                            problem_args['auth_token'] == args['auth_token']:
+                        ids.append((row[0],))
+                        if created is None or row[1] < created:
+                            created = row[1]
+
+                self._connection.executemany(
+                    'DELETE FROM outbox WHERE id = ?',
+                    ids,
+                )
+                self._removed += len(ids)
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        return created
+
+    def done(self, entry_id):
+        """Remove an entry, sent or given up.
+
+        Args:
+            entry_id (int): ID of the entry.
+        """
+
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM outbox WHERE id = ?',
+                (entry_id,),
+            )
+            self._removed += 1
+
+    def retry(self, entry, retry_after=None):
+        """Schedule the next attempt of an entry.
+
+        Args:
+            entry (dict): Entry as returned by :meth:`put` or :meth:`claim`.
+            retry_after (float): Seconds to wait as told by the server. None
+                if not told.
+
+        Returns:
+            bool. True if scheduled, False if the alert was given up.
+        """
+
+        attempts = entry['attempts'] + 1
+        now = time.time()
+
+        if attempts >= self.max_attempts or \
+                now - entry['created'] >= self.max_age:
+            self.done(entry['id'])
+            return False
+
+        due = now + get_backoff(attempts, retry_after=retry_after)
+
+        with self._lock:
+            self._connection.execute(
+                'UPDATE outbox SET due = ?, attempts = ?, leased = 0 '
+                'WHERE id = ?',
+                (due, attempts, entry['id']),
+            )
+
+        return True
+
+    def next_due(self):
+        """Get when the next entry is due.
+
+        Returns:
+            float. Time the next entry is due, None if there is none.
+        """
+
+        with self._lock:
+            return self._connection.execute(
+                'SELECT MIN(due) FROM outbox'
+            ).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM outbox'
+            ).fetchone()[0]
+
+    def compact(self, threshold=1000):
+        """Give the space of removed entries back to the file system.
+
+        Runs once at least ``threshold`` entries were removed since the last
+        compaction.
+
+        Args:
+            threshold (int): Number of removed entries to wait for.
+        """
+
+        with self._lock:
+            if self._removed < threshold:
+                return
+            self._removed = 0
+            self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._connection.execute('VACUUM')
+
+    def close(self):
+        """Close the database."""
+
+        with self._lock:
+            self._connection.close()
+
+
+def parse_address(string, host='127.0.0.1'):
+    """Parse ``[HOST:]PORT``.
+
+    Args:
+        string (str): Address to parse.
+        host (str): Host when none is given.
+
+    Returns:
+        A tuple of the host and the port.
+
+    Raises:
+        * ValueError: Raised when the port is not a number.
+    """
+
+    (given_host, _, port) = string.rpartition(':')
+    return (given_host or host, int(port))
+
+
+class Metrics(object):
+    """Metrics of delivering alerts, for Prometheus or StatsD.
+
+    Keeps a histogram of the seconds every phase of delivering an alert
+    takes, counts deliveries by room, HTTP status and outcome, and tracks the
+    depth of the queues of buffered modes. Phases are:
+
+    ======== =========================================================
+    phase    seconds taken by
+    parse    parsing the commandline
+    request  building the requests of an alert
+    dns      resolving the host of the API
+    connect  connecting to it
+    tls      the TLS handshake
+    response sending a request and receiving its response
+    ======== =========================================================
+
+    Outcomes are ``success``, ``failure``, ``queued`` for a retry,
+    ``dropped`` by routing, ``cancelled`` along with the problem a recovery
+    resolves, ``suppressed`` as a repetition and ``coalesced`` into a
+    digest.
+
+    Components given None instead of metrics record nothing at all. With a
+    StatsD address, every sample is also kept until :meth:`push` sends it.
+    """
+
+    PREFIX = 'zabbix_media_hipchat'
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, statsd=None):
+        """Initialize metrics.
+
+        Args:
+            statsd (tuple): Host and port of the StatsD server to push to.
+                None not to push.
+        """
+
+        self.statsd = statsd
+        self._histograms = {}
+        self._counters = {}
+        self._queues = {}
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds):
+        """Record the seconds a phase took.
+
+        Args:
+            phase (str): Name of the phase.
+            seconds (float): Seconds taken.
+        """
+
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = {
+                    'buckets': [0] * len(self.BUCKETS),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+            for (index, bound) in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+            if self.statsd is not None:
+                self._samples.append('%s.phase.%s:%.3f|ms' % (
+                    self.PREFIX,
+                    phase,
+                    seconds * 1000,
+                ))
+
+    def count(self, result):
+        """Count a delivery to a room.
+
+        Args:
+            result (dict): Result as returned by :meth:`Dispatcher.deliver`.
+        """
+
+        if result.get('dropped'):
+            outcome = 'dropped'
+        elif result.get('cancelled'):
+            outcome = 'cancelled'
+        elif result.get('suppressed'):
+            outcome = 'suppressed'
+        elif result.get('coalesced'):
+            outcome = 'coalesced'
+        elif not result['error']:
+            outcome = 'success'
+        elif result.get('queued'):
+            outcome = 'queued'
+        else:
+            outcome = 'failure'
+
+        status = str(result['status']).lower()
+        key = (result['room'], status, outcome)
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+            if self.statsd is not None:
+                self._samples.append('%s.deliveries.%s.%s.%s:1|c' % (
+                    self.PREFIX,
+                    outcome,
+                    status,
+                    re.sub(r'[^0-9A-Za-z_-]', '_', result['room']),
+                ))
+
+    def track_queue(self, name, function):
+        """Track the depth of a queue.
+
+        Args:
+            name (str): Name of the queue.
+            function: Function returning the number of items in the queue,
+                called whenever metrics are reported.
+        """
+
+        with self._lock:
+            self._queues[name] = function
+
+    def format_prometheus(self):
+        """Format metrics in the Prometheus text exposition format.
+
+        Returns:
+            str. Metrics.
+        """
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            queues = sorted(self._queues.items())
+
+        name = self.PREFIX + '_phase_seconds'
+        lines = [
+            '# HELP %s Seconds taken by each phase of delivering alerts.' % (
+                name,
+            ),
+            '# TYPE %s histogram' % name,
+        ]
+        for (phase, histogram) in histograms:
+            for (index, bound) in enumerate(self.BUCKETS):
+                lines.append('%s_bucket{phase="%s",le="%r"} %d' % (
+                    name,
+                    phase,
+                    bound,
+                    histogram['buckets'][index],
+                ))
+            lines.append('%s_bucket{phase="%s",le="+Inf"} %d' % (
+                name,
+                phase,
+                histogram['count'],
+            ))
+            lines.append('%s_sum{phase="%s"} %r' % (
+                name,
+                phase,
+                histogram['sum'],
+            ))
+            lines.append('%s_count{phase="%s"} %d' % (
+                name,
+                phase,
+                histogram['count'],
+            ))
+
+        lines.extend([
+            '# HELP %s_deliveries_total Alerts delivered to a room by HTTP '
+            'status and outcome.' % self.PREFIX,
+            '# TYPE %s_deliveries_total counter' % self.PREFIX,
+        ])
+        for ((room, status, outcome), count) in counters:
+            lines.append(
+                '%s_deliveries_total{room="%s",status="%s",outcome="%s"} '
+                '%d' % (
+                    self.PREFIX,
+                    escape_label(room),
+                    status,
+                    outcome,
+                    count,
+                )
+            )
+
+        lines.extend([
+            '# HELP %s_queue_depth Alerts waiting in a queue.' % self.PREFIX,
+            '# TYPE %s_queue_depth gauge' % self.PREFIX,
+        ])
+        for (queue, function) in queues:
+            lines.append('%s_queue_depth{queue="%s"} %d' % (
+                self.PREFIX,
+                queue,
+                function(),
+            ))
+
+        return '\n'.join(lines) + '\n'
+
+    def pop_statsd(self):
+        """Take the samples kept for StatsD.
+
+        Returns:
+            list. Lines of the StatsD protocol, including the depth of every
+            queue.
+        """
+
+        with self._lock:
+            samples = self._samples
+            self._samples = []
+            queues = sorted(self._queues.items())
+
+        for (name, function) in queues:
+            samples.append('%s.queue.%s:%d|g' % (
+                self.PREFIX,
+                name,
+                function(),
+            ))
+
+        return samples
+
+    def push(self, size=512):
+        """Send the samples kept to StatsD.
+
+        Failures are ignored, as metrics are not worth failing alerts for.
+
+        Args:
+            size (int): Maximum size of a datagram.
+        """
+
+        packets = []
+        for line in self.pop_statsd():
+            line = line.encode('utf-8')
+            if packets and len(packets[-1]) + 1 + len(line) <= size:
+                packets[-1] += b'\n' + line
+            else:
+                packets.append(line)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for packet in packets:
+                sock.sendto(packet, self.statsd)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+
+def escape_label(value):
+    """Escape a label value of the Prometheus text exposition format.
+
+    Args:
+        value (str): Value of the label.
+
+    Returns:
+        str. Escaped value.
+    """
+
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n',
+        '\\n',
+    )
+
+
+def serve_metrics(address, metrics):
+    """Serve metrics to Prometheus in a background thread.
+
+    Args:
+        address (tuple): Host and port to listen on.
+        metrics (Metrics): Metrics to serve.
+
+    Returns:
+        Server serving the metrics, to ``shutdown`` and ``server_close``.
+
+    Raises:
+        * socket.error: Raised when the address can not be listened on.
+    """
+
+    # pylint: disable=import-error
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler
+
+    try:
+        from BaseHTTPServer import HTTPServer
+    except ImportError:
+        from http.server import HTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        """Respond to scrapes with the metrics."""
+
+        def do_GET(self):
+            """Respond with the metrics."""
+
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = metrics.format_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header(
+                'Content-Type',
+                'text/plain; version=0.0.4; charset=utf-8',
+            )
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            """Do not log scrapes."""
+
+    server = HTTPServer(address, MetricsRequestHandler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+TRACER = None
+
+
+def set_tracer(tracer):
+    """Install the tracer spans are recorded with.
+
+    Args:
+        tracer (Tracer): Tracer to record spans with. None to stop tracing.
+    """
+
+    global TRACER  # pylint: disable=global-statement
+    TRACER = tracer
+
+
+def trace(name, attributes=None, parent=None, start=None, kind='internal'):
+    """Record a span around a stage of delivering alerts.
+
+    Usable as a context manager whether tracing or not, so that stages are
+    traced with a ``with`` statement. The span ends when the statement
+    does, failing when it raises an exception.
+
+    Args:
+        name (str): Name of the stage.
+        attributes (dict): Attributes of the span.
+        parent (Span): Parent of the span. None for the span the current
+            thread is in, if any.
+        start (float): Time the stage started at, in seconds since the
+            epoch. None for now.
+        kind (str): Kind of the span, ``internal`` or ``client``.
+
+    Returns:
+        Span. Span to enter. A :class:`NullSpan` when not tracing.
+    """
+
+    if TRACER is None:
+        return NULL_SPAN
+    return TRACER.span(name, attributes, parent, start, kind)
+
+
+def get_trace_attributes(args):
+    """Get attributes to trace the delivery of an alert with.
+
+    Args:
+        args (dict): Runtime parameters as returned by :func:`get_arguments`.
+
+    Returns:
+        dict. Attributes identifying the alert.
+    """
+
+    attributes = {'hipchat.rooms': len(get_destinations(args))}
+    if 'eventid' in args:
+        attributes['zabbix.event_id'] = args['eventid']
+    return attributes
+
+
+def new_trace_id():
+    """Generate a random trace ID.
+
+    Returns:
+        str. 32 hexadecimal digits.
+    """
+
+    import binascii
+
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class NullSpan(object):
+    """Span recording nothing, used when not tracing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        """Do nothing.
+
+        Args:
+            key (str): Name of the attribute.
+            value: Value of the attribute.
+        """
+
+    def set_error(self, message):
+        """Do nothing.
+
+        Args:
+            message (str): Description of the failure.
+        """
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """Stage of delivering alerts, from entering to exiting it."""
+
+    def __init__(self, tracer, name, trace_id, parent_id, start, kind,
+                 attributes):
+        """Initialize span.
+
+        Args:
+            tracer (Tracer): Tracer the span ends up in.
+            name (str): Name of the stage.
+            trace_id (str): ID of the trace of the span.
+            parent_id (str): ID of the parent span. None for a root span.
+            start (float): Start time in seconds since the epoch.
+            kind (str): Kind of the span, ``internal`` or ``client``.
+            attributes (dict): Attributes of the span.
+        """
+
+        import binascii
+
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self.parent_id = parent_id
+        self.start = start
+        self.end = None
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.error is None:
+            self.error = '%s: %s' % (exc_type.__name__, exc_value)
+        self.end = time.time()
+        self.tracer.pop(self)
+        return False
+
+    def set_attribute(self, key, value):
+        """Set an attribute of the span.
+
+        Args:
+            key (str): Name of the attribute.
+            value: Value of the attribute, a str, bool, int or float.
+        """
+
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        """Mark the stage as failed.
+
+        Args:
+            message (str): Description of the failure.
+        """
+
+        self.error = message
+
+
+class Tracer(object):
+    """Record spans around the stages of delivering alerts.
+
+    Spans are nested under the span the thread creating them is in, unless
+    given a parent. Once a root span ends, the spans recorded under it are
+    handed to :meth:`export`, which subclasses implement.
+    """
+
+    def __init__(self, trace_id=None):
+        """Initialize tracer.
+
+        Args:
+            trace_id (str): ID of the trace every root span belongs to. None
+                for a trace per root span.
+        """
+
+        self.trace_id = trace_id
+        self._spans = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, name, attributes=None, parent=None, start=None,
+             kind='internal'):
+        """Create a span.
+
+        Args:
+            name (str): Name of the stage.
+            attributes (dict): Attributes of the span.
+            parent (Span): Parent of the span. None for the span the current
+                thread is in, if any.
+            start (float): Start time in seconds since the epoch. None for
+                now.
+            kind (str): Kind of the span, ``internal`` or ``client``.
+
+        Returns:
+            Span. Span to enter.
+        """
+
+        if parent is None:
+            parent = self.current()
+
+        if parent is not None:
+            (trace_id, parent_id) = (parent.trace_id, parent.span_id)
+        else:
+            (trace_id, parent_id) = (self.trace_id or new_trace_id(), None)
+
+        if start is None:
+            start = time.time()
+
+        return Span(self, name, trace_id, parent_id, start, kind, attributes)
+
+    def current(self):
+        """Get the span the current thread is in.
+
+        Returns:
+            Span. Innermost span entered by the thread, None if none.
+        """
+
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return None
+
+    def push(self, span):
+        """Enter a span in the current thread.
+
+        Args:
+            span (Span): Span entered.
+        """
+
+        if getattr(self._local, 'stack', None) is None:
+            self._local.stack = []
+        self._local.stack.append(span)
+
+    def pop(self, span):
+        """Exit a span in the current thread, exporting its trace when root.
+
+        Args:
+            span (Span): Span exited.
+        """
+
+        self._local.stack.remove(span)
+
+        with self._lock:
+            spans = self._spans.setdefault(span.trace_id, [])
+            spans.append(span)
+            if span.parent_id is None:
+                del self._spans[span.trace_id]
+            else:
+                spans = None
+
+        if spans:
+            self.export(spans)
+
+    def export(self, spans):
+        """Export the spans recorded under a root span.
+
+        Args:
+            spans (list): Spans of the root span, the root span last.
+        """
+
+        raise NotImplementedError
+
+
+class OTLPTracer(Tracer):
+    """Export spans as OTLP JSON.
+
+    Every root span is exported along with the spans under it as the body of
+    an OTLP/HTTP ``ExportTraceServiceRequest``, either appended to a file
+    as a line of JSON, or posted to a collector. Failing to export does not
+    fail the alert.
+    """
+
+    KINDS = {'internal': 1, 'client': 3}
+
+    def __init__(self, destination, trace_id=None, timeout=5.0):
+        """Initialize tracer.
+
+        Args:
+            destination (str): Path of the file to append spans to, or URL
+                of the OTLP/HTTP traces endpoint of a collector.
+            trace_id (str): ID of the trace every root span belongs to. None
+                for a trace per root span.
+            timeout (float): Timeout in seconds for posting to a collector.
+        """
+
+        Tracer.__init__(self, trace_id)
+        self.destination = destination
+        self.timeout = timeout
+
+    def export(self, spans):
+        """Append spans to the file, or post them to the collector.
+
+        Args:
+            spans (list): Spans of the root span, the root span last.
+        """
+
+        body = json.dumps(self.format(spans), sort_keys=True)
+
+        try:
+            if self.destination.startswith(('http://', 'https://')):
+                import_http()
+                request = HipChatRequest(self.destination)
+                request.add_data(body.encode('utf-8'))
+                request.add_header('Content-Type', 'application/json')
+                build_opener().open(request, timeout=self.timeout).read()
+            else:
+                stream = open(self.destination, 'a')
+                try:
+                    stream.write(body + '\n')
+                finally:
+                    stream.close()
+        except (EnvironmentError, URLError):
+            sys.stderr.write(
+                'Failed to export spans: %s\n' % sys.exc_info()[1]
+            )
+
+    def format(self, spans):
+        """Format spans as an OTLP ``ExportTraceServiceRequest``.
+
+        Args:
+            spans (list): Spans to format.
+
+        Returns:
+            dict. Request body, as a dict ready for JSON encoding.
+        """
+
+        return {
+            'resourceSpans': [{
+                'resource': {
+                    'attributes': self.format_attributes({
+                        'service.name': 'zabbix-media-hipchat',
+                        'service.version': __version__,
+                    }),
+                },
+                'scopeSpans': [{
+                    'scope': {
+                        'name': 'zabbix_media_hipchat',
+                        'version': __version__,
+                    },
+                    'spans': [self.format_span(span) for span in spans],
+                }],
+            }],
+        }
+
+    def format_span(self, span):
+        """Format a span as an OTLP ``Span``.
+
+        Args:
+            span (Span): Span to format.
+
+        Returns:
+            dict. Span, as a dict ready for JSON encoding.
+        """
+
+        dictionary = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': self.KINDS[span.kind],
+            'startTimeUnixNano': str(int(span.start * 1e9)),
+            'endTimeUnixNano': str(int(span.end * 1e9)),
+            'attributes': self.format_attributes(span.attributes),
+            'status': {'code': 1},
+        }
+
+        if span.parent_id is not None:
+            dictionary['parentSpanId'] = span.parent_id
+        if span.error is not None:
+            dictionary['status'] = {'code': 2, 'message': span.error}
+
+        return dictionary
+
+    def format_attributes(self, attributes):
+        """Format attributes as OTLP ``KeyValue`` pairs.
+
+        Args:
+            attributes (dict): Attributes to format.
+
+        Returns:
+            list. Attributes, sorted by name, ready for JSON encoding.
+        """
+
+        pairs = []
+
+        for (key, value) in sorted(attributes.items()):
+            if isinstance(value, bool):
+                value = {'boolValue': value}
+            elif isinstance(value, int):
+                value = {'intValue': str(value)}
+            elif isinstance(value, float):
+                value = {'doubleValue': value}
+            else:
+                value = {'stringValue': str(value)}
+            pairs.append({'key': key, 'value': value})
+
+        return pairs
 
 
 if __name__ == '__main__':
@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the room notification API of HipChat, for tests and benchmarks.
+"""
+
+import math
+import optparse
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+
+try:
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import HTTPServer
+
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'exponential', 'lognormal')
+
+
+def main():
+    """Main function.
+
+    Serves the mock API until interrupted, after writing the endpoint to
+    point ``--endpoint`` of the alert script at to stdout. With
+    ``--timings``, the timing of every request is written to a file once
+    interrupted.
+    """
+
+    option_parser = get_option_parser()
+    (options, _) = option_parser.parse_args()
+
+    try:
+        rate_limit = None
+        if options.rate_limit:
+            (requests, _, seconds) = options.rate_limit.partition('/')
+            rate_limit = (int(requests), float(seconds))
+    except ValueError:
+        option_parser.error('malformed --rate-limit')
+
+    try:
+        rooms = {}
+        for pair in (options.rooms or '').split(','):
+            if pair:
+                (name, _, room_id) = pair.partition('=')
+                rooms[name] = int(room_id)
+    except ValueError:
+        option_parser.error('malformed --rooms')
+
+    tokens = None
+    if options.tokens:
+        tokens = options.tokens.split(',')
+
+    server = MockHipChatServer(
+        (options.host, options.port),
+        latency=options.latency,
+        error_rate=options.error_rate,
+        throttle_rate=options.throttle_rate,
+        certfile=options.certfile,
+        keyfile=options.keyfile,
+        tokens=tokens,
+        rate_limit=rate_limit,
+        reset_rate=options.reset_rate,
+        latency_distribution=options.latency_distribution,
+        rooms=rooms,
+    )
+
+    sys.stdout.write(server.endpoint + '\n')
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    if options.timings:
+        with open(options.timings, 'w') as stream:
+            for timing in server.timings:
+                stream.write(json.dumps(timing, sort_keys=True) + '\n')
+
+
+def get_option_parser():
+    """Build commandline option parser.
+
+    Returns:
+        optparse.OptionParser. Option parser for the commandline.
+    """
+
+    option_parser = optparse.OptionParser(
+        description='Serve a stand-in for the HipChat room notification API.',
+    )
+
+    option_parser.add_option(
+        '--host',
+        dest='host',
+        default='127.0.0.1',
+        help='address to listen on.',
+    )
+    option_parser.add_option(
+        '--port',
+        dest='port',
+        type='int',
+        default=0,
+        help='port to listen on. 0 for any free port.',
+    )
+    option_parser.add_option(
+        '--latency',
+        dest='latency',
+        type='float',
+        default=0.0,
+        metavar='SECONDS',
+        help='mean of the seconds to wait before responding.',
+    )
+    option_parser.add_option(
+        '--latency-distribution',
+        dest='latency_distribution',
+        type='choice',
+        choices=LATENCY_DISTRIBUTIONS,
+        default='constant',
+        metavar='|'.join(LATENCY_DISTRIBUTIONS),
+        help='distribution of the seconds to wait before responding. '
+             '[default: %default]',
+    )
+    option_parser.add_option(
+        '--error-rate',
+        dest='error_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests to fail with a 5xx status.',
+    )
+    option_parser.add_option(
+        '--throttle-rate',
+        dest='throttle_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests to fail with 429 Too Many Requests.',
+    )
+    option_parser.add_option(
+        '--reset-rate',
+        dest='reset_rate',
+        type='float',
+        default=0.0,
+        metavar='RATE',
+        help='fraction of requests to reset the connection of without '
+             'responding.',
+    )
+    option_parser.add_option(
+        '--rate-limit',
+        dest='rate_limit',
+        metavar='REQUESTS/SECONDS',
+        help='allow every token REQUESTS per window of SECONDS, telling '
+             'what is left in X-Ratelimit-* headers, e.g. 100/300 like '
+             'HipChat.',
+    )
+    option_parser.add_option(
+        '--tokens',
+        dest='tokens',
+        metavar='TOKEN[,TOKEN...]',
+        help='only accept these bearer tokens. Any is accepted if not '
+             'given.',
+    )
+    option_parser.add_option(
+        '--rooms',
+        dest='rooms',
+        metavar='NAME=ID[,NAME=ID...]',
+        help='rooms to be looked up by name.',
+    )
+    option_parser.add_option(
+        '--timings',
+        dest='timings',
+        metavar='PATH',
+        help='write the timing of every request to PATH as lines of JSON '
+             'once interrupted.',
+    )
+    option_parser.add_option(
+        '--certfile',
+        dest='certfile',
+        metavar='PATH',
+        help='serve HTTPS with the certificate in PATH.',
+    )
+    option_parser.add_option(
+        '--keyfile',
+        dest='keyfile',
+        metavar='PATH',
+        help='private key of `--certfile`, unless in the same file.',
+    )
+
+    return option_parser
+
+
+def validate_body(body):
+    """Validate the body of a notification request the way HipChat does.
+
+    Args:
+        body (bytes): Body of the request.
+
+    Returns:
+        str. Description of what is wrong with the body, None if nothing.
+    """
+
+    try:
+        notification = json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return 'Body is not valid JSON'
+
+    if not isinstance(notification, dict):
+        return 'Body is not a JSON object'
+
+    message = notification.get('message')
+    if not isinstance(message, STRING_TYPES) or \
+            not 1 <= len(message) <= 10000:
+        return 'message has to be 1 to 10000 characters'
+
+    if notification.get('color', 'yellow') not in MockHipChatServer.COLORS:
+        return 'color is not one of %s' % ', '.join(MockHipChatServer.COLORS)
+
+    if not isinstance(notification.get('notify', False), bool):
+        return 'notify is not a boolean'
+
+    if notification.get('message_format', 'html') not in ('html', 'text'):
+        return 'message_format is not one of html, text'
+
+    return None
+
+
+class MockHipChatHandler(BaseHTTPRequestHandler):
+    """Respond to requests as configured on the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Respond to a room lookup."""
+
+        self.handle_request(b'')
+
+    def do_POST(self):
+        """Respond to a notification request."""
+
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(self.rfile.read(length))
+
+    def handle_request(self, body):
+        """Respond to a request, or reset its connection.
+
+        Args:
+            body (bytes): Body of the request.
+        """
+
+        started = time.time()
+        response = self.server.respond(
+            self.command,
+            self.path,
+            self.headers,
+            body,
+        )
+
+        if response is None:
+            # Closing with a zero linger time resets the connection.
+            self.connection.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_LINGER,
+                struct.pack('ii', 1, 0),
+            )
+            self.connection.close()
+            self.close_connection = True
+            self.server.record(self.command, self.path, None, started)
+            return
+
+        (status, headers, response_body) = response
+        self.send_response(status)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+        self.server.record(self.command, self.path, status, started)
+
+    def log_message(self, *args):
+        """Do not log requests."""
+
+
+class MockHipChatServer(ThreadingMixIn, HTTPServer):
+    """Stand-in for the room notification API of HipChat.
+
+    Responds to ``POST /v2/room/<room>/notification`` with 204 No Content,
+    after a latency drawn from ``latency_distribution`` with a mean of
+    ``latency`` seconds. Requests are validated the way HipChat does: a
+    request without a bearer token, or with one not in ``tokens`` when
+    given, fails with 401, and one whose body is not a valid notification
+    with 400. ``GET /v2/room/<room>`` looks a room of ``rooms`` up by name
+    or ID.
+
+    With ``rate_limit``, every token is allowed a number of requests per
+    window, told by ``X-Ratelimit-*`` headers on every response, and gets
+    429 Too Many Requests once used up. On top of that, a random
+    ``throttle_rate`` of requests fails with 429 and a ``Retry-After``
+    header, a random ``error_rate`` with a 5xx status, and a random
+    ``reset_rate`` has its connection reset without response.
+
+    The status of every response is counted in :attr:`statuses`, and every
+    request is recorded in :attr:`timings`.
+    """
+
+    daemon_threads = True
+
+    allow_reuse_address = True
+
+    ERROR_STATUSES = (500, 502, 503)
+
+    COLORS = ('yellow', 'green', 'red', 'purple', 'gray', 'random')
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0,
+                 error_rate=0.0, throttle_rate=0.0, certfile=None,
+                 keyfile=None, seed=None, tokens=None, rate_limit=None,
+                 reset_rate=0.0, latency_distribution='constant',
+                 rooms=None):
+        """Initialize server and start listening.
+
+        Args:
+            address (tuple): Host and port to listen on.
+            latency (float): Mean of the seconds to wait before responding.
+            error_rate (float): Fraction of requests to fail with a 5xx
+                status.
+            throttle_rate (float): Fraction of requests to fail with 429.
+            certfile (str): Path of the certificate to serve HTTPS with.
+                None to serve plain HTTP.
+            keyfile (str): Path of the private key of the certificate, None
+                when in ``certfile``.
+            seed: Seed of the random choices, for reproducible runs.
+            tokens (list): Bearer tokens accepted. None to accept any.
+            rate_limit (tuple): Number of requests every token is allowed
+                per window, and seconds of the window. None for no limit.
+            reset_rate (float): Fraction of requests to reset the
+                connection of.
+            latency_distribution (str): One of
+                :data:`LATENCY_DISTRIBUTIONS`.
+            rooms (dict): ID of every room which can be looked up, by name.
+
+        Raises:
+            * ValueError: Raised when the latency distribution is unknown.
+        """
+
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(latency_distribution)
+
+        HTTPServer.__init__(self, address, MockHipChatHandler)
+
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.reset_rate = reset_rate
+        self.tokens = None if tokens is None else set(tokens)
+        self.rate_limit = rate_limit
+        self.rooms = rooms or {}
+        self.statuses = {}
+        self.timings = []
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self._windows = {}
+
+        scheme = 'http'
+        if certfile:
+            import ssl
+
+            context = ssl.SSLContext(
+                getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23),
+            )
+            context.load_cert_chain(certfile, keyfile)
+            # The handshake happens in the thread handling the connection.
+            self.socket = context.wrap_socket(
+                self.socket,
+                server_side=True,
+                do_handshake_on_connect=False,
+            )
+            scheme = 'https'
+
+        self.endpoint = '%s://%s:%d/v2/room/%%s/notification' % (
+            scheme,
+            'localhost' if certfile else self.server_address[0],
+            self.server_address[1],
+        )
+
+    def respond(self, method, path, headers, body):
+        """Decide the response to a request.
+
+        Args:
+            method (str): Method of the request.
+            path (str): Path of the request.
+            headers: Headers of the request. Anything with ``get``.
+            body (bytes): Body of the request.
+
+        Returns:
+            A tuple of the status, a list of headers as tuples of the name
+            and value, and the body. None to reset the connection.
+        """
+
+        parts = path.split('/')
+        if method == 'POST' and len(parts) == 5 and parts[3] and \
+                parts[:3] == ['', 'v2', 'room'] and parts[4] == 'notification':
+            lookup = False
+        elif method == 'GET' and len(parts) == 4 and parts[3] and \
+                parts[:3] == ['', 'v2', 'room']:
+            lookup = True
+        else:
+            return self.fail(404, [], 'Not Found')
+
+        authorization = headers.get('Authorization') or ''
+        (scheme, _, token) = authorization.partition(' ')
+        if scheme.lower() != 'bearer' or not token or \
+                self.tokens is not None and token not in self.tokens:
+            return self.fail(401, [], 'Invalid OAuth session')
+
+        rate_limit_headers = []
+        if self.rate_limit is not None:
+            (rate_limit_headers, allowed) = self.take(token)
+            if not allowed:
+                return self.fail(
+                    429,
+                    rate_limit_headers,
+                    'Rate Limit Exceeded',
+                )
+
+        if not lookup:
+            content_type = (headers.get('Content-Type') or '').split(';')[0]
+            if content_type.strip().lower() != 'application/json':
+                return self.fail(400, rate_limit_headers, 'Not JSON')
+            error = validate_body(body)
+            if error is not None:
+                return self.fail(400, rate_limit_headers, error)
+
+        with self.lock:
+            draw = self.random.random()
+            error_status = self.random.choice(self.ERROR_STATUSES)
+            latency = self.draw_latency()
+
+        if latency:
+            time.sleep(latency)
+
+        if draw < self.throttle_rate:
+            return self.fail(
+                429,
+                rate_limit_headers + [('Retry-After', '1')],
+                'Too Many Requests',
+            )
+        if draw < self.throttle_rate + self.error_rate:
+            return self.fail(error_status, rate_limit_headers, 'Error')
+        if draw < self.throttle_rate + self.error_rate + self.reset_rate:
+            return self.count(None, None)
+
+        if lookup:
+            return self.look_up(unquote(parts[3]), rate_limit_headers)
+        return self.count(204, (204, rate_limit_headers, b''))
+
+    def look_up(self, room, headers):
+        """Respond to the lookup of a room.
+
+        Args:
+            room (str): Name or ID of the room.
+            headers (list): Headers of the response.
+
+        Returns:
+            A tuple as returned by :meth:`respond`.
+        """
+
+        for (name, room_id) in self.rooms.items():
+            if room in (name, str(room_id)):
+                body = json.dumps({'id': room_id, 'name': name})
+                return self.count(200, (
+                    200,
+                    headers + [('Content-Type', 'application/json')],
+                    body.encode('utf-8'),
+                ))
+        return self.fail(404, headers, 'Room not found')
+
+    def draw_latency(self):
+        """Draw the seconds to wait before responding.
+
+        Called with :attr:`lock` held, as it draws from :attr:`random`.
+
+        Returns:
+            float. Seconds to wait.
+        """
+
+        if not self.latency or self.latency_distribution == 'constant':
+            return self.latency
+        if self.latency_distribution == 'uniform':
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_distribution == 'exponential':
+            return self.random.expovariate(1 / self.latency)
+        # Heavy tailed, with a sigma of 1 and the given mean.
+        return self.random.lognormvariate(math.log(self.latency) - 0.5, 1)
+
+    def take(self, token):
+        """Take a request from the window of a token.
+
+        Args:
+            token (str): Bearer token of the request.
+
+        Returns:
+            A tuple of the ``X-Ratelimit-*`` headers, and whether the request
+            is allowed.
+        """
+
+        (requests, seconds) = self.rate_limit
+        now = time.time()
+
+        with self.lock:
+            window = self._windows.get(token)
+            if window is None or window['reset'] <= now:
+                window = self._windows[token] = {
+                    'remaining': requests,
+                    'reset': now + seconds,
+                }
+            allowed = window['remaining'] > 0
+            if allowed:
+                window['remaining'] -= 1
+            headers = [
+                ('X-Ratelimit-Limit', str(requests)),
+                ('X-Ratelimit-Remaining', str(window['remaining'])),
+                ('X-Ratelimit-Reset', str(int(math.ceil(window['reset'])))),
+            ]
+
+        return (headers, allowed)
+
+    def fail(self, status, headers, message):
+        """Respond with an error in the format of HipChat.
+
+        Args:
+            status (int): HTTP status of the response.
+            headers (list): Headers of the response.
+            message (str): Description of the error.
+
+        Returns:
+            A tuple as returned by :meth:`respond`.
+        """
+
+        body = json.dumps({'error': {'code': status, 'message': message}})
+        return self.count(status, (
+            status,
+            headers + [('Content-Type', 'application/json')],
+            body.encode('utf-8'),
+        ))
+
+    def count(self, status, response):
+        """Count the status of a response.
+
+        Args:
+            status (int): HTTP status of the response, None when the
+                connection is reset.
+            response: Response to return.
+
+        Returns:
+            ``response``.
+        """
+
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return response
+
+    def record(self, method, path, status, started):
+        """Record the timing of a request.
+
+        Args:
+            method (str): Method of the request.
+            path (str): Path of the request.
+            status (int): HTTP status of the response, None when the
+                connection was reset.
+            started (float): Time the request was read at.
+        """
+
+        timing = {
+            'method': method,
+            'path': path,
+            'status': status,
+            'started': started,
+            'elapsed': time.time() - started,
+        }
+        with self.lock:
+            self.timings.append(timing)
+
+    def start(self):
+        """Serve in a daemon thread.
+
+        Returns:
+            threading.Thread. Thread serving requests.
+        """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    main()